@@ -0,0 +1,86 @@
+"""
+Benchmark the grouped, batched linear algebra of the KLS postprocessing and the rank adaption
+
+The QRs of the K/L postprocessing and the SVDs of the rank adaption are timed for all DLRT layers
+of a network, once layer by layer and once with dlrt.GroupedLinalg (batched over layers with the
+same shape and rank, with and without the thread pool for the remaining layers).
+
+Usage: python benchmarks/batched_linalg.py [--arch resnet18 resnet50] [--device cuda]
+"""
+from __future__ import annotations
+
+import argparse
+
+import torch
+from models import get_model
+from rich.console import Console
+from rich.table import Table
+from utils import time_fn
+
+import dlrt
+
+console = Console(width=140)
+
+
+def build(args, arch, batched, threads):
+    torch.manual_seed(args.seed)
+    model = get_model(arch, num_classes=args.num_classes).to(args.device)
+    net = dlrt.DLRTNetwork(
+        model,
+        rank_percent=args.rank_percent,
+        adaptive=True,
+        dense_last_layer=True,
+        batched_linalg=batched,
+        linalg_threads=threads,
+    )
+    net.set_layer_case("k")
+    net.run_preprocess("k")
+    net.run_preprocess("l")
+    return net
+
+
+def run(args):
+    if args.torch_threads:
+        torch.set_num_threads(args.torch_threads)
+    modes = {
+        "per layer": (False, 1),
+        "batched": (True, 1),
+        f"batched + {args.threads} threads": (True, args.threads),
+    }
+    table = Table(title=f"grouped linear algebra ({args.device})")
+    for col in ["arch", "layers", "mode", "kl_postprocess [ms]", "rank_adaption [ms]", "speedup"]:
+        table.add_column(col)
+    for arch in args.arch:
+        base = None
+        for mode, (batched, threads) in modes.items():
+            net = build(args, arch, batched, threads)
+            post = time_fn(lambda: net.run_postprocess("kl"), args.device, repeats=args.repeats)
+            # skip -> the ranks stay the same, every repeat does the same work
+            ra = time_fn(lambda: net.run_rank_adaption(skip=True), args.device, repeats=args.repeats)
+            base = post + ra if base is None else base
+            table.add_row(
+                arch,
+                str(len(net._dlrt_layers())),
+                mode,
+                f"{1e3 * post:.2f}",
+                f"{1e3 * ra:.2f}",
+                f"{base / (post + ra):.2f}x",
+            )
+            if batched and args.report:
+                net.linalg.print_report()
+            net.close()
+    console.print(table)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--arch", nargs="+", default=["resnet18", "resnet50"])
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--num-classes", type=int, default=1000)
+    parser.add_argument("--rank-percent", type=float, default=None)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--torch-threads", type=int, default=None, help="torch intra-op threads")
+    parser.add_argument("--repeats", type=int, default=10)
+    parser.add_argument("--report", action="store_true", help="print the group statistics")
+    parser.add_argument("--seed", type=int, default=42)
+    run(parser.parse_args())
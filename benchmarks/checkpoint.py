@@ -0,0 +1,157 @@
+"""
+Check and benchmark the compact checkpoints of DLRTTrainer
+
+A model is trained on synthetic data for --steps steps, and a compact checkpoint is saved after
+--save-at steps. A second trainer (same model and settings, different initialization) loads the
+checkpoint and trains the remaining steps. Reported are the max difference of the losses and of
+the weights (U S Vt, the dense parameters) to the uninterrupted run, and the size and write time
+of the compact checkpoint against torch.save of the full state dicts of the model and optimizer.
+
+The optimizer state of the factors is stored at the rank of the checkpoint. The trainer zeroes the
+factors and their optimizer state beyond the rank after every rank adaption, nothing is lost and
+the resume is bit-exact with momentum too.
+
+Usage: python benchmarks/checkpoint.py [--arch toynet resnet18] [--steps 20] [--save-at 10]
+"""
+from __future__ import annotations
+
+import argparse
+import os
+import tempfile
+import time
+
+import torch
+import torch.nn as nn
+from models import get_model
+from models import synthetic_data
+from rich.console import Console
+from rich.table import Table
+
+import dlrt
+
+console = Console(width=140)
+
+
+def build(args, arch, seed):
+    torch.manual_seed(seed)
+    return dlrt.DLRTTrainer(
+        torch_model=get_model(arch, num_classes=args.num_classes).to(args.device),
+        optimizer_name="SGD",
+        optimizer_kwargs={"lr": args.lr, "momentum": args.momentum},
+        criterion=nn.CrossEntropyLoss(),
+        adaptive=True,
+        mixed_precision=False,
+        dense_last_layer=True,
+        pretrain_count=args.pretrain_count,
+        compact_factors=args.compact_factors,
+        compact_patience=args.compact_patience,
+    )
+
+
+def train(trainer, images, labels, steps, batch_size) -> list:
+    losses = []
+    for _ in range(steps):
+        b = (trainer.counter * batch_size) % images.shape[0]
+        out = trainer.train_step_abs(images[b : b + batch_size], labels[b : b + batch_size])
+        losses.append(out[-1].loss.item())
+    return losses
+
+
+@torch.no_grad()
+def weights(trainer) -> dict:
+    # dense weight of every DLRT layer (U S Vt, independent of the padding of the factors)
+    #   and all other parameters
+    ret = {}
+    for name, module in trainer.dlrt_model.dlrt_model.named_modules():
+        if hasattr(module, "dlrt"):
+            if hasattr(module, "fullweight"):
+                ret[name] = module.fullweight.clone()
+            else:
+                first, second = module.inference_factors()
+                ret[name] = second @ first
+    for name, p in trainer.dlrt_model.dlrt_model.named_parameters():
+        if name.rpartition(".")[0] not in ret:
+            ret[name] = p.detach().clone()
+    return ret
+
+
+def full_checkpoint(trainer, path) -> float:
+    # all parameters and buffers at rmax, optimizer state of all parameters
+    start = time.perf_counter()
+    torch.save(
+        {
+            "model": trainer.dlrt_model.dlrt_model.state_dict(),
+            "optimizer": trainer.optimizer.state_dict(),
+            "counter": trainer.counter,
+        },
+        path,
+    )
+    return time.perf_counter() - start
+
+
+def run(args):
+    images, labels = synthetic_data(args.num_samples, args.num_classes, seed=0, device=args.device)
+    table = Table(title=f"compact checkpoints ({args.device}, saved after {args.save_at} steps)")
+    for col in [
+        "arch",
+        "mean rank / rmax",
+        "full [MB]",
+        "compact [MB]",
+        "full write [ms]",
+        "compact write [ms]",
+        "max loss diff",
+        "max weight diff",
+    ]:
+        table.add_column(col)
+    with tempfile.TemporaryDirectory() as tmp:
+        for arch in args.arch:
+            compact_path = os.path.join(tmp, f"{arch}_compact.pt")
+            full_path = os.path.join(tmp, f"{arch}_full.pt")
+
+            reference = build(args, arch, args.seed)
+            ref_losses = train(reference, images, labels, args.save_at, args.batch_size)
+            # write times: median of a few writes (first write warms up the file system)
+            compact_time = sorted(reference.save_checkpoint(compact_path) for _ in range(3))[1]
+            full_time = sorted(full_checkpoint(reference, full_path) for _ in range(3))[1]
+            layers = [m for m in reference.dlrt_model.dlrt_model.modules() if hasattr(m, "dlrt")]
+            ranks = sum(m.low_rank for m in layers) / len(layers)
+            rmax = sum(m.rmax for m in layers) / len(layers)
+            ref_losses += train(reference, images, labels, args.steps - args.save_at, args.batch_size)
+
+            # different seed -> all weights of the resumed run come from the checkpoint
+            resumed = build(args, arch, args.seed + 1)
+            resumed.load_checkpoint(compact_path)
+            losses = train(resumed, images, labels, args.steps - args.save_at, args.batch_size)
+            loss_diff = max(abs(a - b) for a, b in zip(losses, ref_losses[args.save_at :]))
+            ref_weights, res_weights = weights(reference), weights(resumed)
+            weight_diff = max((ref_weights[n] - res_weights[n]).abs().max().item() for n in ref_weights)
+
+            table.add_row(
+                arch,
+                f"{ranks:.1f} / {rmax:.1f}",
+                f"{os.path.getsize(full_path) / 2**20:.2f}",
+                f"{os.path.getsize(compact_path) / 2**20:.2f}",
+                f"{full_time * 1e3:.1f}",
+                f"{compact_time * 1e3:.1f}",
+                f"{loss_diff:.2e}",
+                f"{weight_diff:.2e}",
+            )
+    console.print(table)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--arch", nargs="+", default=["toynet", "resnet18"])
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--num-samples", type=int, default=512)
+    parser.add_argument("--num-classes", type=int, default=10)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--steps", type=int, default=20)
+    parser.add_argument("--save-at", type=int, default=10)
+    parser.add_argument("--lr", type=float, default=0.01)
+    parser.add_argument("--momentum", type=float, default=0.9)
+    parser.add_argument("--pretrain-count", type=int, default=-1)
+    parser.add_argument("--compact-factors", action="store_true")
+    parser.add_argument("--compact-patience", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=42)
+    run(parser.parse_args())
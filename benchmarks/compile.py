@@ -0,0 +1,105 @@
+"""
+Benchmark torch.compile of DLRT networks with and without rank buckets
+
+A model is trained with DLRTTrainer, once eagerly and once compiled for every rank bucket
+(None -> exact ranks). The number of compiled graphs, the number of rank changes, the time of the
+whole run (incl. compilation) and the steady state throughput (last half of the steps) are reported.
+Runs on the CPU with the inductor backend (needs a C++ compiler).
+
+Usage: python benchmarks/compile.py [--arch toynet] [--buckets 0 8 16 32] [--device cuda]
+"""
+from __future__ import annotations
+
+import argparse
+import time
+
+import torch
+import torch.nn as nn
+from models import get_model
+from models import synthetic_data
+from rich.console import Console
+from rich.table import Table
+from utils import sync
+
+import dlrt
+
+console = Console(width=140)
+
+
+def run_one(args, bucket, compiled, data):
+    torch.manual_seed(args.seed)
+    torch._dynamo.reset()
+    model = get_model(args.arch, num_classes=args.num_classes).to(args.device)
+    trainer = dlrt.DLRTTrainer(
+        torch_model=model,
+        optimizer_name="SGD",
+        optimizer_kwargs={"lr": args.lr, "momentum": 0.9},
+        criterion=nn.CrossEntropyLoss(),
+        adaptive=True,
+        mixed_precision=False,
+        dense_last_layer=True,
+        integrator=args.integrator,
+        rank_bucket=bucket or None,
+        compile_model=compiled,
+        compile_backend=args.backend,
+    )
+    images, labels = data
+    layers = trainer.dlrt_model._dlrt_layers()
+    ranks = [layer.low_rank for layer in layers]
+    rank_changes, steady, steady_samples = 0, 0.0, 0
+    sync(args.device)
+    start = time.perf_counter()
+    for step in range(args.steps):
+        sl = slice((step * args.batch_size) % images.shape[0], None)
+        t0 = time.perf_counter()
+        trainer.train_step_abs(images[sl][: args.batch_size], labels[sl][: args.batch_size])
+        sync(args.device)
+        if step >= args.steps // 2:
+            steady += time.perf_counter() - t0
+            steady_samples += args.batch_size
+        new_ranks = [layer.low_rank for layer in layers]
+        rank_changes += sum(a != b for a, b in zip(ranks, new_ranks))
+        ranks = new_ranks
+    return {
+        "compiles": trainer.dlrt_model.num_compiles,
+        "rank changes": rank_changes,
+        "total [s]": time.perf_counter() - start,
+        "samples/s": steady_samples / steady,
+    }
+
+
+def run(args):
+    torch._dynamo.config.cache_size_limit = args.cache_size_limit
+    data = synthetic_data(args.num_samples, args.num_classes, seed=0, device=args.device)
+    table = Table(title=f"torch.compile of {args.arch} ({args.backend}, {args.device}, {args.steps} steps)")
+    for col in ["mode", "rank bucket", "graphs compiled", "rank changes", "total [s]", "steady samples/s"]:
+        table.add_column(col)
+    runs = [("eager", None, False)] + [("compiled", b, True) for b in args.buckets]
+    for mode, bucket, compiled in runs:
+        res = run_one(args, bucket, compiled, data)
+        table.add_row(
+            mode,
+            str(bucket or "-"),
+            str(res["compiles"]) if compiled else "-",
+            str(res["rank changes"]),
+            f"{res['total [s]']:.1f}",
+            f"{res['samples/s']:.1f}",
+        )
+    console.print(table)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--arch", default="toynet")
+    parser.add_argument("--buckets", nargs="+", type=int, default=[0, 8, 16, 32], help="0 -> exact ranks")
+    parser.add_argument("--integrator", default="sequential")
+    parser.add_argument("--backend", default="inductor")
+    parser.add_argument("--cache-size-limit", type=int, default=64, help="torch._dynamo recompile limit")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--num-samples", type=int, default=2048)
+    parser.add_argument("--num-classes", type=int, default=10)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--steps", type=int, default=40)
+    parser.add_argument("--lr", type=float, default=0.01)
+    parser.add_argument("--seed", type=int, default=42)
+    run(parser.parse_args())
@@ -0,0 +1,136 @@
+"""
+Benchmark the forward implementations of the DLRT conv layers
+
+Compares the default "conv" forward (convolution with the r columns of the V/L factor as kernels,
+then a 1x1 convolution with the U/K factor) with the "unfold" forward (im2col with F.unfold, then
+matrix products) of DLRTConv2dAdaptive for the K, L and S cases. Reported are the forward +
+backward time, the memory saved for the backward pass (both devices), the peak memory of the
+forward + backward (CUDA only) and the max difference between the two outputs.
+
+Usage: python benchmarks/conv_forward.py [--device cuda] [--channels 64 256] [--batch-sizes 32]
+"""
+from __future__ import annotations
+
+import argparse
+import itertools
+
+import torch
+from rich.console import Console
+from rich.table import Table
+from utils import time_fn
+
+from dlrt.conv import DLRTConv2dAdaptive
+
+console = Console(width=140)
+
+
+def saved_bytes(fn) -> int:
+    # bytes of the tensors autograd keeps for the backward pass (unique storages)
+    storages = {}
+
+    def pack(t):
+        storages[t.untyped_storage().data_ptr()] = t.untyped_storage().nbytes()
+        return t
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+        out = fn()
+    del out
+    return sum(storages.values())
+
+
+def peak_bytes(fn, device) -> int | None:
+    if torch.device(device).type != "cuda":
+        return None
+    torch.cuda.synchronize(device)
+    torch.cuda.reset_peak_memory_stats(device)
+    base = torch.cuda.memory_allocated(device)
+    fn().sum().backward()
+    torch.cuda.synchronize(device)
+    return torch.cuda.max_memory_allocated(device) - base
+
+
+def run(args):
+    table = Table(title=f"DLRTConv2dAdaptive forward + backward ({args.device})")
+    for col in [
+        "channels",
+        "batch",
+        "hw",
+        "rank",
+        "case",
+        "conv [ms]",
+        "unfold [ms]",
+        "saved conv / unfold [MB]",
+        "peak conv / unfold [MB]",
+        "max diff",
+    ]:
+        table.add_column(col)
+    for (channels, batch, hw, rank_fraction) in itertools.product(
+        args.channels,
+        args.batch_sizes,
+        args.sizes,
+        args.ranks,
+    ):
+        layer = DLRTConv2dAdaptive(
+            channels,
+            channels,
+            kernel_size=args.kernel_size,
+            stride=args.stride,
+            padding=args.kernel_size // 2,
+            dilation=args.dilation,
+            pretrain=False,
+            device=args.device,
+        )
+        # fraction of the initial rank (the S case uses twice the rank)
+        layer.low_rank = max(1, int(rank_fraction * layer.low_rank))
+        layer.set_dlrt_requires_grad(True)
+        x = torch.randn(batch, channels, hw, hw, device=args.device)
+        for case in ["k", "l", "s"]:
+            layer.change_training_case(case)
+            times, saved, peak, outs = {}, {}, {}, {}
+            for impl in ["conv", "unfold"]:
+                layer.forward_impl = impl
+
+                def fwd():
+                    return layer(x)
+
+                def fn():
+                    fwd().sum().backward()
+
+                times[impl] = time_fn(fn, device=args.device, repeats=args.repeats)
+                saved[impl] = saved_bytes(fwd) / 2**20
+                peak[impl] = peak_bytes(fwd, args.device)
+                with torch.no_grad():
+                    outs[impl] = fwd()
+            layer.zero_grad(set_to_none=True)
+            peak_str = "-"
+            if peak["conv"] is not None:
+                peak_str = f"{peak['conv'] / 2**20:.1f} / {peak['unfold'] / 2**20:.1f}"
+            table.add_row(
+                str(channels),
+                str(batch),
+                str(hw),
+                str(layer.low_rank),
+                case,
+                f"{times['conv'] * 1e3:.2f}",
+                f"{times['unfold'] * 1e3:.2f}",
+                f"{saved['conv']:.1f} / {saved['unfold']:.1f}",
+                peak_str,
+                f"{(outs['conv'] - outs['unfold']).abs().max().item():.1e}",
+            )
+    console.print(table)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--channels", type=int, nargs="+", default=[64, 256])
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[32])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[32], help="input height = width")
+    parser.add_argument(
+        "--ranks", type=float, nargs="+", default=[0.25, 1.0], help="fraction of initial rank"
+    )
+    parser.add_argument("--kernel-size", type=int, default=3)
+    parser.add_argument("--stride", type=int, default=1)
+    parser.add_argument("--dilation", type=int, default=1)
+    parser.add_argument("--repeats", type=int, default=5)
+    run(parser.parse_args())
@@ -0,0 +1,60 @@
+"""
+Benchmark the Python overhead of dispatching the per-step commands to the DLRT layers
+
+The per-step commands of DLRTNetwork (set_layer_case, run_preprocess, ...) are dispatched through
+the cached layer registry. This is compared to the recursive walk over the module tree which was
+used before. The command is a cheap one (change_training_case) -> the timing is the dispatch cost.
+
+Usage: python benchmarks/dispatch.py [--arch resnet18 resnet152]
+"""
+from __future__ import annotations
+
+import argparse
+
+import torch
+from models import get_model
+from rich.console import Console
+from rich.table import Table
+from utils import time_fn
+
+import dlrt
+
+console = Console(width=140)
+
+
+def recursive_walk(module, command, kwargs):
+    # reference: the old DLRTNetwork.__run_command_on_dlrt_layers
+    if hasattr(module, "dlrt"):
+        getattr(module, command)(**kwargs)
+    for name, child in module.named_children():
+        recursive_walk(child, command, kwargs)
+
+
+def run(args):
+    table = Table(title="DLRT layer dispatch (change_training_case, per call)")
+    for col in ["arch", "modules", "DLRT layers", "tree walk [us]", "registry [us]", "speedup"]:
+        table.add_column(col)
+    for arch in args.arch:
+        torch.manual_seed(0)
+        net = dlrt.DLRTNetwork(get_model(arch, num_classes=10), adaptive=True, dense_last_layer=True)
+        kwargs = {"case": "k"}
+        walk = time_fn(
+            lambda: recursive_walk(net.dlrt_model, "change_training_case", kwargs), repeats=args.repeats
+        )
+        registry = time_fn(lambda: net.set_layer_case("k"), repeats=args.repeats)
+        table.add_row(
+            arch,
+            str(len(list(net.dlrt_model.modules()))),
+            str(len(net._dlrt_layers())),
+            f"{1e6 * walk:.1f}",
+            f"{1e6 * registry:.1f}",
+            f"{walk / registry:.1f}x",
+        )
+    console.print(table)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--arch", nargs="+", default=["toynet", "resnet18", "resnet50", "resnet152"])
+    parser.add_argument("--repeats", type=int, default=50)
+    run(parser.parse_args())
@@ -0,0 +1,331 @@
+"""
+Benchmark the communication of distributed DLRT training on local CPU processes (gloo)
+
+For every model and synchronization mode, --world-size processes are spawned on this machine
+(torch.distributed with the gloo backend, no GPUs, SLURM, or MPI needed) and train through
+DLRTTrainer on synthetic data (every process gets its share of a global batch). After --warmup
+steps, --steps steps are measured:
+
+- the time of every phase of a training step (preprocessing, forward + backward + optimizer
+  step, postprocessing, rank adaption, the rest), mean over the steps, mean and max over the
+  processes
+- the number of collectives and bytes sent per step and phase (the calls of torch.distributed
+  and the gradient buckets of DDP)
+- the divergence of the processes after the last step: max difference of the dense weights of the
+  DLRT layers (and of all other parameters) to process 0, number of layers with different ranks
+
+Modes (keyword arguments of DLRTTrainer):
+    ddp: the DDP wrapper of DLRTNetwork
+    phase: phase_grad_sync (PhaseGradReducer instead of DDP)
+    phase+sync: phase_grad_sync and sync_dlrt_layers (the layer state is averaged)
+    phase+shard: phase_grad_sync and shard_linalg (QRs/SVDs split between the processes)
+
+The results are written as JSON (--output, default: stdout) to track communication regressions.
+
+Usage: python benchmarks/distributed.py [--arch toynet resnet18] [--world-size 2] [--output out.json]
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import platform
+import socket
+import tempfile
+import time
+from collections import defaultdict
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import torch.nn as nn
+from torch.distributed.algorithms.ddp_comm_hooks import default_hooks
+from torch.nn.parallel import DistributedDataParallel
+from models import get_model
+from models import synthetic_data
+from rich.console import Console
+from rich.table import Table
+
+import dlrt
+
+console = Console(width=140)
+
+MODES = {
+    "ddp": {},
+    "phase": {"phase_grad_sync": True},
+    "phase+sync": {"phase_grad_sync": True, "sync_dlrt_layers": True},
+    "phase+shard": {"phase_grad_sync": True, "shard_linalg": True},
+}
+PHASES = ("preprocess", "forward_backward", "postprocess", "rank_adaption", "other")
+COLLECTIVES = ("all_reduce", "broadcast", "all_gather", "all_gather_into_tensor", "reduce_scatter_tensor")
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class PhaseRecorder:
+    """
+    Time the phases of the training steps and count the collectives issued in them. The phase
+    methods of the trainer and the network, and the collectives of torch.distributed are wrapped
+    (nothing is counted outside of a phase).
+    """
+
+    def __init__(self, trainer):
+        self.phase = None
+        self.enabled = False
+        self.times = defaultdict(float)
+        self.collectives = defaultdict(int)
+        self.bytes = defaultdict(int)
+        net = trainer.dlrt_model
+        self._wrap(net, "run_preprocess", "preprocess")
+        self._wrap(trainer, "_forward_backward_step", "forward_backward")
+        self._wrap(net, "run_postprocess", "postprocess")
+        self._wrap(net, "run_rank_adaption", "rank_adaption")
+        for name in COLLECTIVES:
+            self._count(name)
+        if isinstance(net.kmodel, DistributedDataParallel):
+            # the gradient buckets of DDP are all-reduced in C++, counted with a communication hook
+            net.kmodel.register_comm_hook(None, self._ddp_hook)
+
+    def _wrap(self, obj, method: str, phase: str):
+        fn = getattr(obj, method)
+
+        def timed(*args, **kwargs):
+            if not self.enabled or self.phase is not None:
+                return fn(*args, **kwargs)
+            self.phase = phase
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.times[phase] += time.perf_counter() - start
+                self.phase = None
+
+        setattr(obj, method, timed)
+
+    def _count(self, name: str):
+        fn = getattr(dist, name)
+
+        def counted(tensor, *args, **kwargs):
+            if self.enabled:
+                phase = self.phase or "other"
+                self.collectives[phase] += 1
+                # all_gather(tensor_list, tensor): the bytes sent are the ones of the local tensor
+                sent = args[0] if isinstance(tensor, list) else tensor
+                self.bytes[phase] += sent.nbytes
+            return fn(tensor, *args, **kwargs)
+
+        setattr(dist, name, counted)
+
+    def _ddp_hook(self, state, bucket):
+        if self.enabled:
+            phase = self.phase or "other"
+            self.collectives[phase] += 1
+            self.bytes[phase] += bucket.buffer().nbytes
+        return default_hooks.allreduce_hook(dist.group.WORLD, bucket)
+
+    def step(self, fn):
+        phases = [p for p in PHASES if p != "other"]
+        before = {p: self.times[p] for p in phases}
+        self.enabled = True
+        start = time.perf_counter()
+        fn()
+        total = time.perf_counter() - start
+        self.enabled = False
+        # other: the rest of this step (counter, prints, compact_factors)
+        self.times["other"] += total - sum(self.times[p] - before[p] for p in phases)
+        self.times["step"] += total
+
+    def report(self, steps: int) -> dict:
+        self.collectives["step"] = sum(self.collectives[p] for p in PHASES)
+        self.bytes["step"] = sum(self.bytes[p] for p in PHASES)
+        return {
+            phase: {
+                "ms": 1e3 * self.times[phase] / steps,
+                "collectives": self.collectives[phase] / steps,
+                "bytes": self.bytes[phase] / steps,
+            }
+            for phase in (*PHASES, "step")
+        }
+
+
+@torch.no_grad()
+def divergence(trainer) -> dict:
+    # max difference to process 0 (its tensors are broadcast, not counted)
+    net = trainer.dlrt_model
+    layers = net._dlrt_layers()
+    weight_diff, param_diff, scale = 0.0, 0.0, 0.0
+    for layer in layers:
+        first, second = layer.inference_factors()
+        w = second @ first
+        ref = w.clone()
+        dist.broadcast(ref, src=0)
+        weight_diff = max(weight_diff, (w - ref).abs().max().item())
+        scale = max(scale, ref.abs().max().item())
+    dlrt_params = {id(p) for layer in layers for p in layer.parameters()}
+    for p in net.dlrt_model.parameters():
+        if id(p) in dlrt_params:
+            continue
+        ref = p.detach().clone()
+        dist.broadcast(ref, src=0)
+        param_diff = max(param_diff, (p - ref).abs().max().item())
+    # the largest difference of any process (process 0 compares to itself)
+    diffs = torch.tensor([weight_diff, param_diff], dtype=torch.float64)
+    dist.all_reduce(diffs, op=dist.ReduceOp.MAX)
+    weight_diff, param_diff = diffs.tolist()
+    ranks = torch.tensor([getattr(layer, "low_rank", -1) for layer in layers], dtype=torch.int64)
+    gathered = [torch.empty_like(ranks) for _ in range(dist.get_world_size())]
+    dist.all_gather(gathered, ranks)
+    gathered = torch.stack(gathered)
+    spread = gathered.amax(0) - gathered.amin(0)
+    return {
+        "max_weight_diff": weight_diff,
+        "max_rel_weight_diff": weight_diff / scale if scale else 0.0,
+        "max_param_diff": param_diff,
+        "layers_with_different_ranks": int((spread > 0).sum()),
+        "max_rank_spread": int(spread.max()) if len(layers) else 0,
+        "ranks": gathered[0].tolist(),
+    }
+
+
+def worker(rank: int, args, arch: str, mode: str, port: int, out_path: str):
+    os.environ.update(MASTER_ADDR="127.0.0.1", MASTER_PORT=str(port))
+    torch.set_num_threads(args.threads)
+    dist.init_process_group("gloo", rank=rank, world_size=args.world_size)
+    try:
+        torch.manual_seed(args.seed)
+        trainer = dlrt.DLRTTrainer(
+            torch_model=get_model(arch, num_classes=args.num_classes),
+            optimizer_name="SGD",
+            optimizer_kwargs={"lr": args.lr, "momentum": 0.9},
+            criterion=nn.CrossEntropyLoss(),
+            adaptive=True,
+            mixed_precision=False,
+            dense_last_layer=True,
+            integrator=args.integrator,
+            batched_linalg=args.batched_linalg,
+            **MODES[mode],
+        )
+        world = args.world_size
+        global_batch = args.batch_size * world
+        images, labels = synthetic_data(global_batch * 8, args.num_classes, seed=args.seed)
+        recorder = PhaseRecorder(trainer)
+
+        def step():
+            b = (trainer.counter * global_batch) % images.shape[0]
+            x, y = images[b : b + global_batch], labels[b : b + global_batch]
+            trainer.train_step_abs(x[rank::world], y[rank::world])
+
+        for _ in range(args.warmup):
+            step()
+        for _ in range(args.steps):
+            recorder.step(step)
+        local = recorder.report(args.steps)
+        everyone = [None] * world
+        dist.all_gather_object(everyone, local)
+        div = divergence(trainer)
+        if rank == 0:
+            phases = {}
+            for phase in local:
+                ms = [r[phase]["ms"] for r in everyone]
+                phases[phase] = {
+                    "mean_ms": sum(ms) / world,
+                    "max_ms": max(ms),
+                    "collectives": local[phase]["collectives"],
+                    "bytes": local[phase]["bytes"],
+                }
+            result = {
+                "arch": arch,
+                "mode": mode,
+                "trainer_kwargs": MODES[mode],
+                "world_size": world,
+                "batch_size_per_process": args.batch_size,
+                "integrator": args.integrator,
+                "batched_linalg": args.batched_linalg,
+                "steps": args.steps,
+                "phases": phases,
+                "divergence": div,
+            }
+            with open(out_path, "w") as f:
+                json.dump(result, f)
+    finally:
+        dist.destroy_process_group()
+
+
+def run(args) -> dict:
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for arch in args.arch:
+            for mode in args.modes:
+                out_path = os.path.join(tmp, f"{arch}_{mode}.json")
+                mp.spawn(worker, args=(args, arch, mode, free_port(), out_path), nprocs=args.world_size)
+                with open(out_path) as f:
+                    results.append(json.load(f))
+    return {
+        "meta": {
+            "torch": torch.__version__,
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+            "threads_per_process": args.threads,
+            "backend": "gloo",
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "results": results,
+    }
+
+
+def print_table(report: dict):
+    table = Table(title=f"distributed DLRT training ({report['meta']['backend']}, CPU)")
+    for col in ["arch", "mode", "procs", "step [ms]", *[f"{p} [ms]" for p in PHASES[:-1]]]:
+        table.add_column(col)
+    for col in ["colls / step", "MB / step", "max weight diff", "rank diffs"]:
+        table.add_column(col)
+    for res in report["results"]:
+        phases = res["phases"]
+        table.add_row(
+            res["arch"],
+            res["mode"],
+            str(res["world_size"]),
+            f"{phases['step']['max_ms']:.1f}",
+            *[f"{phases[p]['max_ms']:.1f}" for p in PHASES[:-1]],
+            f"{phases['step']['collectives']:.1f}",
+            f"{phases['step']['bytes'] / 2**20:.2f}",
+            f"{res['divergence']['max_weight_diff']:.2e}",
+            str(res["divergence"]["layers_with_different_ranks"]),
+        )
+    console.print(table)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--arch", nargs="+", default=["toynet", "resnet18"])
+    parser.add_argument("--modes", nargs="+", default=list(MODES), choices=list(MODES))
+    parser.add_argument("--world-size", type=int, default=2)
+    parser.add_argument("--threads", type=int, default=None, help="torch threads per process")
+    parser.add_argument("--num-classes", type=int, default=10)
+    parser.add_argument("--batch-size", type=int, default=32, help="per process")
+    parser.add_argument("--steps", type=int, default=5)
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument(
+        "--integrator", default="sequential", choices=["sequential", "parallel", "parallel-folded"]
+    )
+    parser.add_argument("--batched-linalg", action="store_true")
+    parser.add_argument("--lr", type=float, default=0.05)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", default=None, help="JSON file (default: stdout)")
+    args = parser.parse_args()
+    if args.threads is None:
+        args.threads = max(1, (os.cpu_count() or 1) // args.world_size)
+    if args.threads * args.world_size > (os.cpu_count() or 1):
+        console.print(f"[yellow]{args.world_size} x {args.threads} threads oversubscribe the CPUs")
+    report = run(args)
+    print_table(report)
+    if args.output is None:
+        print(json.dumps(report, indent=2))
+    else:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
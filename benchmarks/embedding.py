@@ -0,0 +1,158 @@
+"""
+Benchmark DLRTEmbedding against a dense nn.Embedding
+
+For every vocabulary size, the dense embedding and the K, L and S cases of DLRTEmbedding are
+trained on random token batches (SGD with momentum, dense or sparse gradients). Reported are the
+stored values (parameters and buffers, also relative to the dense table, and the part which is
+active at the current rank), the memory of the gradients and the optimizer state after a step, the
+forward + backward + optimizer step time, and the eval lookup throughput. The peak memory of a
+training step is reported on CUDA.
+
+Usage: python benchmarks/embedding.py [--device cuda] [--vocab-sizes 50000 250000] [--dim 512]
+"""
+from __future__ import annotations
+
+import argparse
+import itertools
+
+import torch
+import torch.nn as nn
+from rich.console import Console
+from rich.table import Table
+from utils import time_fn
+
+from dlrt.embedding import DLRTEmbedding
+
+console = Console(width=140)
+
+
+def nbytes(t) -> int:
+    if t.is_sparse:
+        t = t.coalesce()
+        return t.indices().nbytes + t.values().nbytes
+    return t.nbytes
+
+
+def state_bytes(module, optimizer) -> int:
+    # gradients and optimizer state of all parameters
+    total = sum(nbytes(p.grad) for p in module.parameters() if p.grad is not None)
+    for state in optimizer.state.values():
+        total += sum(nbytes(v) for v in state.values() if torch.is_tensor(v))
+    return total
+
+
+def stored_bytes(module) -> int:
+    return sum(t.nbytes for t in module.parameters()) + sum(t.nbytes for t in module.buffers())
+
+
+def active_bytes(layer) -> int:
+    # values of the current K/L step: the num_embeddings x r and r x dim factors and r x r of S
+    if not isinstance(layer, DLRTEmbedding):
+        return layer.weight.nbytes
+    r = layer.low_rank
+    return (r * (layer.num_embeddings + layer.embedding_dim) + r * r) * layer.s.element_size()
+
+
+def peak_bytes(fn, device) -> int | None:
+    if torch.device(device).type != "cuda":
+        return None
+    torch.cuda.synchronize(device)
+    torch.cuda.reset_peak_memory_stats(device)
+    base = torch.cuda.memory_allocated(device)
+    fn()
+    torch.cuda.synchronize(device)
+    return torch.cuda.max_memory_allocated(device) - base
+
+
+def run(args):
+    table = Table(
+        title=f"DLRTEmbedding vs nn.Embedding (dim {args.dim}, {args.batch_size} tokens, {args.device})"
+    )
+    for col in [
+        "vocab",
+        "grads",
+        "layer",
+        "rank",
+        "stored [MB]",
+        "stored / dense",
+        "active [MB]",
+        "grad + optim [MB]",
+        "peak [MB]",
+        "train step [ms]",
+        "eval [M lookups/s]",
+    ]:
+        table.add_column(col)
+    for vocab, sparse in itertools.product(args.vocab_sizes, map(bool, args.sparse)):
+        torch.manual_seed(args.seed)
+        tokens = torch.randint(0, vocab, (args.batch_size,), device=args.device)
+        dense = nn.Embedding(vocab, args.dim, sparse=sparse, device=args.device)
+        dlrt_layer = DLRTEmbedding(
+            vocab, args.dim, sparse=sparse, low_rank_percent=args.rank_percent, device=args.device
+        )
+        grads = "sparse" if sparse else "dense"
+        dense_bytes = stored_bytes(dense)
+        for name, layer, case in [
+            ("nn.Embedding", dense, None),
+            ("DLRT k", dlrt_layer, "k"),
+            ("DLRT l", dlrt_layer, "l"),
+            ("DLRT s", dlrt_layer, "s"),
+        ]:
+            if case is not None:
+                layer.change_training_case(case)
+                getattr(layer, f"{case}_preprocess")()
+            optimizer = torch.optim.SGD(
+                [p for p in layer.parameters() if p.requires_grad], lr=1e-3, momentum=0.9
+            )
+
+            def step(optimizer=optimizer):
+                optimizer.zero_grad(set_to_none=True)
+                layer(tokens).square().mean().backward()
+                optimizer.step()
+
+            step_time = time_fn(step, device=args.device, repeats=args.repeats)
+            state = state_bytes(layer, optimizer)
+            peak = peak_bytes(step, args.device)
+            layer.zero_grad(set_to_none=True)
+
+            def lookup():
+                with torch.no_grad():
+                    layer(tokens)
+
+            if case is not None:
+                # eval forward of the DLRT layers is the K case
+                layer.change_training_case("k")
+                layer.k_preprocess()
+            lookup_time = time_fn(lookup, device=args.device, repeats=args.repeats)
+            if case is not None:
+                layer.change_training_case(case)
+            table.add_row(
+                str(vocab),
+                grads,
+                name,
+                "-" if case is None else str(2 * layer.low_rank if case == "s" else layer.low_rank),
+                f"{stored_bytes(layer) / 2**20:.1f}",
+                f"{stored_bytes(layer) / dense_bytes:.2f}",
+                f"{active_bytes(layer) / 2**20:.1f}",
+                f"{state / 2**20:.1f}",
+                "-" if peak is None else f"{peak / 2**20:.1f}",
+                f"{step_time * 1e3:.2f}",
+                f"{args.batch_size / lookup_time / 1e6:.1f}",
+            )
+    console.print(table)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--vocab-sizes", type=int, nargs="+", default=[50_000, 100_000, 250_000])
+    parser.add_argument("--dim", type=int, default=512)
+    parser.add_argument("--batch-size", type=int, default=8192, help="tokens per lookup")
+    parser.add_argument(
+        "--rank-percent", type=float, default=None, help="DLRTEmbedding low_rank_percent (None -> dim // 16)"
+    )
+    parser.add_argument(
+        "--sparse", type=int, nargs="+", default=[0, 1], help="gradient types, 0: dense, 1: sparse"
+    )
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=42)
+    run(parser.parse_args())
@@ -0,0 +1,75 @@
+"""
+Benchmark the inference export of trained DLRT networks
+
+A model is trained for a few steps on synthetic data, exported with
+DLRTNetwork.export_inference, and compared to the DLRT training model and the dense model with
+the same weights (stored values, FLOPs, latency). The exported model is checked against the DLRT
+model and can be saved with torch.save or as TorchScript.
+
+Usage: python benchmarks/export.py [--arch toynet resnet18] [--save /tmp/model.pt] [--torchscript]
+"""
+from __future__ import annotations
+
+import argparse
+
+import torch
+import torch.nn as nn
+from models import get_model
+from models import synthetic_data
+from rich.console import Console
+
+import dlrt
+
+console = Console(width=140)
+
+
+def run(args):
+    images, labels = synthetic_data(args.num_samples, args.num_classes, seed=0, device=args.device)
+    for arch in args.arch:
+        torch.manual_seed(args.seed)
+        trainer = dlrt.DLRTTrainer(
+            torch_model=get_model(arch, num_classes=args.num_classes).to(args.device),
+            optimizer_name="SGD",
+            optimizer_kwargs={"lr": args.lr, "momentum": 0.9},
+            criterion=nn.CrossEntropyLoss(),
+            adaptive=True,
+            mixed_precision=False,
+            dense_last_layer=True,
+        )
+        for b in range(0, images.shape[0], args.batch_size):
+            trainer.train_step_abs(images[b : b + args.batch_size], labels[b : b + args.batch_size])
+
+        network = trainer.dlrt_model
+        exported = network.export_inference(dense_threshold=args.dense_threshold)
+        example = images[: args.batch_size]
+        console.rule(arch)
+        network.inference_report(exported, example)
+        # eval forward of the DLRT model uses the K case (K = U @ S)
+        network.eval()
+        network.set_layer_case("k")
+        network.run_preprocess("k")
+        with torch.no_grad():
+            expected = network.dlrt_model(example)
+            diff = (exported(example) - expected).abs().max().item()
+        console.print(
+            f"max abs difference to the DLRT model: {diff:.3e} (max abs output {expected.abs().max():.3e})"
+        )
+        if args.save:
+            path = f"{arch}_{args.save}"
+            dlrt.save_inference(exported, path, example_input=example[:1], torchscript=args.torchscript)
+            console.print(f"saved to {path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--arch", nargs="+", default=["toynet", "resnet18"])
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--num-samples", type=int, default=512)
+    parser.add_argument("--num-classes", type=int, default=10)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--lr", type=float, default=0.01)
+    parser.add_argument("--dense-threshold", type=float, default=1.0)
+    parser.add_argument("--save", default=None, help="file name suffix to save the exported models to")
+    parser.add_argument("--torchscript", action="store_true")
+    parser.add_argument("--seed", type=int, default=42)
+    run(parser.parse_args())
@@ -0,0 +1,114 @@
+"""
+Benchmark the sequential (K, L, S) and parallel low-rank integrators of DLRTTrainer
+
+For every integrator, a model is trained on synthetic CIFAR shaped data, the training throughput
+(samples/sec) and the holdout accuracy are reported.
+
+Usage: python benchmarks/integrators.py [--arch toynet resnet18] [--device cuda]
+"""
+from __future__ import annotations
+
+import argparse
+import time
+
+import torch
+import torch.nn as nn
+from models import get_model
+from models import synthetic_data
+from rich.console import Console
+from rich.table import Table
+from utils import sync
+
+import dlrt
+
+console = Console(width=140)
+
+PASSES = {"sequential": 3, "parallel": 2, "parallel-folded": 1}
+
+
+@torch.no_grad()
+def evaluate(trainer, images, labels, batch_size):
+    # the K forward with K = U @ S is the current weight
+    trainer.dlrt_model.eval()
+    trainer.dlrt_model.set_layer_case("k")
+    trainer.dlrt_model.run_preprocess("k")
+    correct = 0
+    for i in range(0, images.shape[0], batch_size):
+        out = trainer.dlrt_model(images[i : i + batch_size], "k")
+        correct += (out.argmax(dim=1) == labels[i : i + batch_size]).sum()
+    trainer.dlrt_model.train()
+    return 100.0 * correct.item() / images.shape[0]
+
+
+def run_one(args, arch, integrator, train, test):
+    torch.manual_seed(args.seed)
+    model = get_model(arch, num_classes=args.num_classes).to(args.device)
+    trainer = dlrt.DLRTTrainer(
+        torch_model=model,
+        optimizer_name="SGD",
+        optimizer_kwargs={"lr": args.lr, "momentum": 0.9},
+        criterion=nn.CrossEntropyLoss(),
+        adaptive=True,
+        mixed_precision=False,
+        rank_percent=args.rank_percent,
+        split_batch="repeat",
+        dense_last_layer=True,
+        integrator=integrator,
+    )
+    images, labels = train
+    num_batches = images.shape[0] // args.batch_size
+    samples, elapsed = 0, 0.0
+    for epoch in range(args.epochs):
+        for b in range(num_batches):
+            sl = slice(b * args.batch_size, (b + 1) * args.batch_size)
+            sync(args.device)
+            t0 = time.perf_counter()
+            ret = trainer.train_step_abs(images[sl], labels[sl])
+            sync(args.device)
+            if epoch > 0 or b >= args.warmup:
+                elapsed += time.perf_counter() - t0
+                samples += args.batch_size
+    return {
+        "samples/s": samples / elapsed,
+        "loss": ret[3].loss.item(),
+        "acc": evaluate(trainer, *test, args.batch_size),
+    }
+
+
+def run(args):
+    train = synthetic_data(args.num_samples, args.num_classes, seed=0, device=args.device)
+    test = synthetic_data(args.num_samples // 4, args.num_classes, seed=1, device=args.device)
+    table = Table(title=f"DLRT integrators ({args.device})")
+    for col in ["arch", "integrator", "passes/batch", "samples/s", "speedup", "train loss", "holdout acc@1"]:
+        table.add_column(col)
+    for arch in args.arch:
+        base = None
+        for integrator in args.integrators:
+            res = run_one(args, arch, integrator, train, test)
+            base = res["samples/s"] if base is None else base
+            table.add_row(
+                arch,
+                integrator,
+                str(PASSES[integrator]),
+                f"{res['samples/s']:.1f}",
+                f"{res['samples/s'] / base:.2f}x",
+                f"{res['loss']:.4f}",
+                f"{res['acc']:.2f}",
+            )
+    console.print(table)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--arch", nargs="+", default=["toynet", "resnet18"])
+    parser.add_argument("--integrators", nargs="+", default=list(PASSES), choices=list(PASSES))
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--num-samples", type=int, default=2048)
+    parser.add_argument("--num-classes", type=int, default=10)
+    parser.add_argument("--batch-size", type=int, default=128)
+    parser.add_argument("--epochs", type=int, default=3)
+    parser.add_argument("--warmup", type=int, default=2, help="untimed steps at the start")
+    parser.add_argument("--lr", type=float, default=0.01)
+    parser.add_argument("--rank-percent", type=float, default=None)
+    parser.add_argument("--seed", type=int, default=42)
+    run(parser.parse_args())
@@ -0,0 +1,296 @@
+"""
+Microbenchmark the DLRT layers against nn.Linear / nn.Conv2d
+
+For every shape, batch size, and rank, the phases of a KLS step of DLRTLinearAdaptive,
+DLRTLinearFixed, DLRTConv2dAdaptive, and DLRTConv2dFixed are timed separately: the
+preprocessing, forward, and backward of the K, L, and S cases, the K/L postprocessing (QRs), and
+the rank adaption (SVD, adaptive layers only). The dense layer of the same shape is timed for the
+forward and backward. Reported per layer are the ratios to the dense layer:
+
+    forward ratio: eval forward (K case) / dense forward
+    step ratio: all phases of a KLS step / dense forward + backward
+
+-> the largest rank with a ratio below 1 is the break-even point of the layer.
+
+The ranks are fractions of min(in, out) (conv: min(out_channels, in_channels * kernel size)), at most
+0.5 (the S step trains 2 * rank). DLRTConv2dFixed derives its rank from its shape (0.5), it is only
+run for that rank.
+
+The results are written as JSON (--output). With --baseline (a previous --output), every phase is
+compared to the baseline and the ones which are more than --threshold slower (and at least --min-ms)
+are reported as regressions, the exit code is 1 if there are any.
+
+Usage: python benchmarks/layers.py [--device cuda] [--output new.json] [--baseline old.json]
+"""
+from __future__ import annotations
+
+import argparse
+import itertools
+import json
+import platform
+import sys
+import time
+
+import torch
+import torch.nn as nn
+from rich.console import Console
+from rich.table import Table
+from utils import time_fn
+
+from dlrt.conv import DLRTConv2dAdaptive
+from dlrt.conv import DLRTConv2dFixed
+from dlrt.linear import DLRTLinearAdaptive
+from dlrt.linear import DLRTLinearFixed
+
+console = Console(width=140)
+
+# phases of a KLS step, in order (the postprocessing needs the K and L steps, the S step needs the
+#   postprocessing)
+PHASES = (
+    "k_preprocess",
+    "k_forward",
+    "k_backward",
+    "l_preprocess",
+    "l_forward",
+    "l_backward",
+    "k_postprocess",
+    "l_postprocess",
+    "s_preprocess",
+    "s_forward",
+    "s_backward",
+    "rank_adaption",
+)
+
+
+def linear_layers(features: int, rank: int, device) -> dict:
+    adaptive = DLRTLinearAdaptive(features, features, low_rank_percent=1.0, pretrain=False, device=device)
+    adaptive.low_rank = rank
+    return {
+        "DLRTLinearAdaptive": adaptive,
+        "DLRTLinearFixed": DLRTLinearFixed(features, features, low_rank=rank, device=device),
+    }
+
+
+def conv_layers(channels: int, kernel: int, rank: int, device) -> dict:
+    kwargs = {"kernel_size": kernel, "padding": kernel // 2, "device": device}
+    adaptive = DLRTConv2dAdaptive(channels, channels, pretrain=False, **kwargs)
+    adaptive.low_rank = rank
+    ret = {"DLRTConv2dAdaptive": adaptive}
+    fixed = DLRTConv2dFixed(channels, channels, **kwargs)
+    if fixed.low_rank == rank:
+        ret["DLRTConv2dFixed"] = fixed
+    return ret
+
+
+def time_backward(layer, x, device, repeats) -> float:
+    graph = {}
+
+    def forward():
+        layer.zero_grad(set_to_none=True)
+        graph["out"] = layer(x).square().mean()
+
+    return time_fn(lambda: graph["out"].backward(), device=device, repeats=repeats, setup=forward)
+
+
+def time_dense(layer, x, device, repeats) -> dict:
+    layer.requires_grad_(True)
+    with torch.no_grad():
+        fwd = time_fn(lambda: layer(x), device=device, repeats=repeats)
+    return {"forward": fwd, "backward": time_backward(layer, x, device, repeats)}
+
+
+def time_dlrt(layer, x, device, repeats) -> dict:
+    times = {}
+    for case in ("k", "l"):
+        layer.change_training_case(case)
+        preprocess = getattr(layer, f"{case}_preprocess")
+        times[f"{case}_preprocess"] = time_fn(preprocess, device=device, repeats=repeats)
+        preprocess()
+        with torch.no_grad():
+            times[f"{case}_forward"] = time_fn(lambda: layer(x), device=device, repeats=repeats)
+        times[f"{case}_backward"] = time_backward(layer, x, device, repeats)
+    for case in ("k", "l"):
+        times[f"{case}_postprocess"] = time_fn(
+            getattr(layer, f"{case}_postprocess"), device=device, repeats=repeats
+        )
+    layer.change_training_case("s")
+    # s_preprocess of the fixed layers is not idempotent (it moves the bases), restore them
+    state = {k: v.clone() for k, v in layer.state_dict().items()}
+    restore = lambda: layer.load_state_dict(state)  # noqa: E731
+    times["s_preprocess"] = time_fn(layer.s_preprocess, device=device, repeats=repeats, setup=restore)
+    layer.s_preprocess()
+    with torch.no_grad():
+        times["s_forward"] = time_fn(lambda: layer(x), device=device, repeats=repeats)
+    times["s_backward"] = time_backward(layer, x, device, repeats)
+    if hasattr(layer, "rank_adaption_prepare") and layer.rank_adaption_svd_input() is not None:
+        # the rank adaption changes the rank -> restore the factors and the rank before every call
+        state = {k: v.clone() for k, v in layer.state_dict().items()}
+        rank = layer.low_rank
+
+        def restore():
+            layer.load_state_dict(state)
+            layer.low_rank = rank
+
+        times["rank_adaption"] = time_fn(layer.rank_adaption, device=device, repeats=repeats, setup=restore)
+        restore()
+    # eval forward: K case
+    layer.change_training_case("k")
+    layer.k_preprocess()
+    with torch.no_grad():
+        times["eval_forward"] = time_fn(lambda: layer(x), device=device, repeats=repeats)
+    layer.zero_grad(set_to_none=True)
+    return times
+
+
+def configs(args):
+    # (kind, shape string, batch, min dim, dense layer, DLRT layers of a rank, input)
+    dev = args.device
+    for feats, batch in itertools.product(args.features, args.batch_sizes):
+        yield (
+            "linear",
+            f"{feats}x{feats}",
+            batch,
+            feats,
+            nn.Linear(feats, feats, device=dev),
+            lambda rank, feats=feats: linear_layers(feats, rank, dev),
+            torch.randn(batch, feats, device=dev),
+        )
+    k, size = args.kernel_size, args.image_size
+    for chans, batch in itertools.product(args.channels, args.conv_batch_sizes):
+        yield (
+            "conv2d",
+            f"{chans}x{chans}x{k}x{k}@{size}",
+            batch,
+            chans,
+            nn.Conv2d(chans, chans, k, padding=k // 2, device=dev),
+            lambda rank, chans=chans: conv_layers(chans, k, rank, dev),
+            torch.randn(batch, chans, size, size, device=dev),
+        )
+
+
+def run(args) -> list:
+    results = []
+    torch.manual_seed(args.seed)
+    for kind, shape, batch, min_dim, dense_layer, dlrt_fn, x in configs(args):
+        dense = time_dense(dense_layer, x, args.device, args.repeats)
+        for frac in args.ranks:
+            rank = max(1, int(frac * min_dim))
+            for name, layer in dlrt_fn(rank).items():
+                times = time_dlrt(layer, x, args.device, args.repeats)
+                step = sum(times[p] for p in PHASES if p in times)
+                results.append(
+                    {
+                        "layer": name,
+                        "kind": kind,
+                        "shape": shape,
+                        "batch": batch,
+                        "rank_fraction": frac,
+                        "rank": layer.low_rank,
+                        "times_ms": {p: 1e3 * t for p, t in times.items()},
+                        "dense_ms": {p: 1e3 * t for p, t in dense.items()},
+                        "forward_ratio": times["eval_forward"] / dense["forward"],
+                        "step_ratio": step / (dense["forward"] + dense["backward"]),
+                    }
+                )
+    return results
+
+
+def _key(res: dict) -> tuple:
+    return res["layer"], res["shape"], res["batch"], res["rank_fraction"]
+
+
+def compare(results: list, baseline: list, threshold: float, min_ms: float) -> list:
+    # phases which are more than `threshold` (fraction) and at least `min_ms` slower than the baseline
+    old = {_key(res): res for res in baseline}
+    regressions = []
+    for res in results:
+        if _key(res) not in old:
+            continue
+        for phase, ms in res["times_ms"].items():
+            base = old[_key(res)]["times_ms"].get(phase)
+            if base is not None and ms > base * (1 + threshold) and ms - base >= min_ms:
+                regressions.append({"key": list(_key(res)), "phase": phase, "baseline_ms": base, "ms": ms})
+    return regressions
+
+
+def print_tables(results: list, regressions: list):
+    table = Table(title="DLRT layers vs dense (times in ms)")
+    for col in ["layer", "shape", "batch", "rank", "k fwd+bwd", "postprocess", "s fwd+bwd"]:
+        table.add_column(col)
+    for col in ["rank adaption", "eval fwd", "dense fwd+bwd", "fwd ratio", "step ratio"]:
+        table.add_column(col)
+    for res in results:
+        t, d = res["times_ms"], res["dense_ms"]
+        table.add_row(
+            res["layer"].removeprefix("DLRT"),
+            res["shape"],
+            str(res["batch"]),
+            str(res["rank"]),
+            f"{t['k_forward'] + t['k_backward']:.3f}",
+            f"{t['k_postprocess'] + t['l_postprocess']:.3f}",
+            f"{t['s_forward'] + t['s_backward']:.3f}",
+            f"{t['rank_adaption']:.3f}" if "rank_adaption" in t else "-",
+            f"{t['eval_forward']:.3f}",
+            f"{d['forward'] + d['backward']:.3f}",
+            f"{res['forward_ratio']:.2f}",
+            f"{res['step_ratio']:.2f}",
+        )
+    console.print(table)
+    if regressions:
+        table = Table(title="regressions")
+        for col in ["layer", "shape", "batch", "rank fraction", "phase", "baseline [ms]", "now [ms]"]:
+            table.add_column(col)
+        for reg in regressions:
+            table.add_row(
+                *map(str, reg["key"]), reg["phase"], f"{reg['baseline_ms']:.3f}", f"{reg['ms']:.3f}"
+            )
+        console.print(table)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--features", type=int, nargs="+", default=[256, 1024])
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[64, 512])
+    parser.add_argument("--channels", type=int, nargs="+", default=[64, 128])
+    parser.add_argument("--conv-batch-sizes", type=int, nargs="+", default=[16])
+    parser.add_argument("--kernel-size", type=int, default=3)
+    parser.add_argument("--image-size", type=int, default=16)
+    parser.add_argument(
+        "--ranks", type=float, nargs="+", default=[0.05, 0.1, 0.25, 0.5], help="fractions of min(in, out)"
+    )
+    parser.add_argument("--repeats", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", default=None, help="JSON file for the results")
+    parser.add_argument("--baseline", default=None, help="JSON file of a previous run to compare to")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed slowdown (fraction)")
+    parser.add_argument("--min-ms", type=float, default=0.05, help="ignore slowdowns below this")
+    args = parser.parse_args()
+    if max(args.ranks) > 0.5:
+        parser.error("rank fractions must be at most 0.5")
+
+    results = run(args)
+    regressions = []
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f)["results"], args.threshold, args.min_ms)
+    print_tables(results, regressions)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(
+                {
+                    "meta": {
+                        "torch": torch.__version__,
+                        "python": platform.python_version(),
+                        "machine": platform.machine(),
+                        "device": args.device,
+                        "threads": torch.get_num_threads(),
+                        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                    },
+                    "results": results,
+                    "regressions": regressions,
+                },
+                f,
+                indent=2,
+            )
+    sys.exit(1 if regressions else 0)
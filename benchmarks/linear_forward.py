@@ -0,0 +1,88 @@
+"""
+Benchmark the evaluation orders of the DLRTLinearAdaptive forward pass
+
+Compares the dense path (build the in x out weight, then one GEMM) with the factored path
+(chain of rank-r GEMMs, never allocates the dense weight) for the K and S cases. The "auto" mode
+picks the cheaper of the two from the FLOP count.
+
+Usage: python benchmarks/linear_forward.py [--device cuda] [--backward]
+"""
+from __future__ import annotations
+
+import argparse
+import itertools
+
+import torch
+from rich.console import Console
+from rich.table import Table
+from utils import time_fn
+
+from dlrt.linear import _chain_order
+from dlrt.linear import DLRTLinearAdaptive
+
+console = Console(width=140)
+
+
+def run(args):
+    table = Table(title=f"DLRTLinearAdaptive forward ({args.device})")
+    for col in [
+        "in x out",
+        "batch",
+        "rank",
+        "case",
+        "dense [ms]",
+        "factored [ms]",
+        "auto [ms]",
+        "factored order",
+        "winner",
+    ]:
+        table.add_column(col)
+    for (feats, batch, rank_percent) in itertools.product(args.features, args.batch_sizes, args.ranks):
+        layer = DLRTLinearAdaptive(
+            feats,
+            feats,
+            low_rank_percent=rank_percent,
+            pretrain=False,
+            device=args.device,
+        )
+        layer.set_dlrt_requires_grad(args.backward)
+        x = torch.randn(batch, feats, device=args.device)
+        for case in ["k", "s"]:
+            layer.change_training_case(case)
+            times = {}
+            for mode in ["dense", "factored", "auto"]:
+                layer.forward_mode = mode
+
+                def fn():
+                    out = layer(x)
+                    if args.backward:
+                        out.sum().backward()
+
+                with torch.set_grad_enabled(args.backward):
+                    times[mode] = time_fn(fn, device=args.device, repeats=args.repeats)
+            r = layer.low_rank if case == "k" else 2 * layer.low_rank
+            inner = [r] if case == "k" else [r, r]
+            order = _chain_order((batch, feats, *inner, feats), allow_dense=False)
+            table.add_row(
+                f"{feats} x {feats}",
+                str(batch),
+                str(layer.low_rank),
+                case,
+                f"{times['dense'] * 1e3:.3f}",
+                f"{times['factored'] * 1e3:.3f}",
+                f"{times['auto'] * 1e3:.3f}",
+                str(order),
+                min(times, key=times.get),
+            )
+    console.print(table)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--features", type=int, nargs="+", default=[512, 2048])
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 32, 256, 4096])
+    parser.add_argument("--ranks", type=float, nargs="+", default=[0.1, 0.5, 1.0])
+    parser.add_argument("--repeats", type=int, default=10)
+    parser.add_argument("--backward", action="store_true", help="time forward + backward")
+    run(parser.parse_args())
@@ -0,0 +1,43 @@
+from __future__ import annotations
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+__all__ = ["ToyNet", "get_model", "synthetic_data"]
+
+
+class ToyNet(nn.Module):
+    # same as the ToyNet in networks/dlrt_cnn.py (without the mpi/mlflow imports)
+    def __init__(self, num_classes: int = 100):
+        super().__init__()
+        self.fc0 = nn.Linear(3072, 16 * 5 * 5)
+        self.fc1 = nn.Linear(16 * 5 * 5, 120)
+        self.fc3 = nn.Linear(120, num_classes)
+
+    def forward(self, x):
+        x = torch.flatten(x, 1)  # flatten all dimensions except batch
+        x = F.relu(self.fc0(x))
+        x = F.relu(self.fc1(x))
+        x = self.fc3(x)
+        return x
+
+
+def get_model(arch: str, num_classes: int = 100) -> nn.Module:
+    if arch == "toynet":
+        return ToyNet(num_classes=num_classes)
+    import torchvision.models as models
+
+    return models.__dict__[arch](num_classes=num_classes)
+
+
+def synthetic_data(num_samples: int, num_classes: int = 100, seed: int = 0, device="cpu"):
+    """
+    CIFAR shaped random images, labeled by a fixed random linear teacher so that the accuracy
+    is meaningful
+    """
+    gen = torch.Generator().manual_seed(seed)
+    images = torch.randn(num_samples, 3, 32, 32, generator=gen)
+    teacher = torch.randn(3 * 32 * 32, num_classes, generator=torch.Generator().manual_seed(1234))
+    labels = torch.argmax(images.flatten(1) @ teacher, dim=1)
+    return images.to(device), labels.to(device)
@@ -0,0 +1,35 @@
+from __future__ import annotations
+
+import time
+
+import torch
+
+__all__ = ["sync", "time_fn"]
+
+
+def sync(device):
+    if torch.device(device).type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def time_fn(fn, device="cpu", warmup: int = 3, repeats: int = 10, setup=None) -> float:
+    """
+    Time a function call (seconds per call, median over `repeats`). `setup` is called (untimed)
+    before every call, e.g. to restore a state which `fn` changes or to build a graph for a backward
+    """
+    for _ in range(warmup):
+        if setup is not None:
+            setup()
+        fn()
+    sync(device)
+    times = []
+    for _ in range(repeats):
+        if setup is not None:
+            setup()
+            sync(device)
+        t0 = time.perf_counter()
+        fn()
+        sync(device)
+        times.append(time.perf_counter() - t0)
+    times.sort()
+    return times[len(times) // 2]
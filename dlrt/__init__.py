@@ -6,8 +6,16 @@ __email__ = "daniel.coquelin@gmail.com"
 __version__ = "0.1.0"
 
 from .basic import *
+from .checkpoint import *
 from .conv import *
+from .cost import *
+from .distributed import *
+from .embedding import *
+from .export import *
+from .history import *
+from .linalg import *
 from .linear import *
 from .network import *
+from .profiling import *
 from .trainer import *
 from .transformer import *
@@ -1,9 +1,167 @@
 from __future__ import annotations
 
+import itertools
+import math
+
+import torch
 import torch.nn as nn
+from torch import Tensor
+
+from .distributed import BucketedAllReduce
 
 __all__ = ["DLRTModule"]
 
+TRUNCATION_CRITERIA = ("absolute", "relative", "energy")
+
+
+def truncation_rank(
+    sing: torch.Tensor,
+    eps: float,
+    criterion: str = "relative",
+    min_rank: int = 1,
+    max_rank: int = None,
+    default: int = None,
+) -> torch.Tensor:
+    """
+    Get the rank to truncate the (descending) singular values `sing` to. The smallest rank r for
+    which the cut tail ||sing[r:]|| is below the threshold is chosen. This is a single vectorized
+    operation, the result stays on the device of `sing` (no host sync).
+
+    Parameters
+    ----------
+    sing
+        singular values, sorted descending along the last dimension (leading dimensions are
+        batch dimensions, e.g. the groups of a grouped convolution)
+    eps
+        threshold, depends on `criterion`
+    criterion
+        - absolute: ||sing[r:]|| < eps
+        - relative: ||sing[r:]|| < eps * ||sing||
+        - energy: ||sing[r:]||**2 < eps * ||sing||**2 (at most a fraction `eps` of the energy is cut)
+    min_rank, max_rank
+        the rank is clamped to these
+    default
+        rank to use if no tail can be cut, default: len(sing)
+
+    Returns
+    -------
+    int64 tensor with the new rank (0-dim for a 1D `sing`, else one rank per batch entry)
+    """
+    # tail[..., j] = ||sing[..., j:]||**2, non-increasing
+    tail = torch.cumsum(sing.flip(-1).pow(2), dim=-1).flip(-1)
+    if criterion == "absolute":
+        threshold = eps**2
+    elif criterion == "relative":
+        threshold = eps**2 * tail[..., :1]
+    elif criterion == "energy":
+        threshold = eps * tail[..., :1]
+    else:
+        raise ValueError(f"criterion must be one of {TRUNCATION_CRITERIA}, not: {criterion}")
+    # number of tails above the threshold == index of the first tail which can be cut
+    rank = (tail >= threshold).sum(-1)
+    if default is not None:
+        rank = rank.masked_fill(rank == sing.shape[-1], default)
+    return rank.clamp(min=min_rank, max=max_rank)
+
+
+def truncation_threshold(sing: torch.Tensor, eps: float, criterion: str = "relative") -> torch.Tensor:
+    """
+    Tolerance of `truncation_rank` as a bound on the norm of the cut tail ||sing[r:]||, on the
+    device of `sing` (one value per batch entry)
+    """
+    norm = sing.norm(dim=-1)
+    if criterion == "absolute":
+        return torch.full_like(norm, eps)
+    elif criterion == "relative":
+        return eps * norm
+    elif criterion == "energy":
+        return eps**0.5 * norm
+    raise ValueError(f"criterion must be one of {TRUNCATION_CRITERIA}, not: {criterion}")
+
+
+def _linalg_input(a: Tensor, dtype: torch.dtype = None) -> Tensor:
+    # half precision has no QR/SVD kernels and would lose the orthogonality of the bases
+    #   -> the decompositions run in at least fp32 (or in `dtype` if it is given)
+    if dtype is None:
+        dtype = torch.float32 if a.dtype in (torch.float16, torch.bfloat16) else a.dtype
+    return a.to(dtype)
+
+
+def qr(a: Tensor, dtype: torch.dtype = None) -> Tensor:
+    """
+    Q of the reduced QR decomposition of `a` (batched over the leading dims), computed in `dtype`
+    (default: at least fp32) and returned in the dtype of `a`
+    """
+    return torch.linalg.qr(_linalg_input(a, dtype))[0].to(a.dtype)
+
+
+def svd(a: Tensor, dtype: torch.dtype = None, full_matrices: bool = False) -> tuple[Tensor, Tensor, Tensor]:
+    """
+    SVD of `a` (batched over the leading dims), computed in `dtype` (default: at least fp32).
+    The singular vectors are returned in the dtype of `a`, the singular values in the dtype of the
+    decomposition (the rank truncation compares them in full precision).
+    """
+    u, sing, vh = torch.linalg.svd(_linalg_input(a, dtype), full_matrices=full_matrices)
+    return u.to(a.dtype), sing, vh.to(a.dtype)
+
+
+def _leading_block(t: Tensor, shape, clone: bool = True) -> Tensor:
+    # copy (or view, if not clone) of the leading block of `shape` of t
+    if not t.is_sparse:
+        block = t[tuple(slice(0, sz) for sz in shape)]
+        return block.clone() if clone else block
+    # sparse gradients/optimizer state (DLRTEmbedding with sparse=True) cannot be sliced
+    for dim, sz in enumerate(shape):
+        t = t.narrow_copy(dim, 0, sz)
+    return t
+
+
+def _expand_block(t: Tensor, shape) -> Tensor:
+    # inverse of _leading_block: zeros of `shape` with t as the leading block
+    if tuple(t.shape) == tuple(shape):
+        return t
+    if not t.is_sparse:
+        out = t.new_zeros(shape)
+        out[tuple(slice(0, sz) for sz in t.shape)] = t
+        return out
+    # not coalesced: summing duplicate indices here would round differently than the optimizer
+    values = t._values().new_zeros((t._values().shape[0], *shape[t.sparse_dim() :]))
+    values[(slice(None), *(slice(0, sz) for sz in t._values().shape[1:]))] = t._values()
+    return torch.sparse_coo_tensor(t._indices(), values, shape, is_coalesced=t.is_coalesced())
+
+
+def _zero_beyond_block(t: Tensor, shape):
+    # zero everything of t outside of its leading block of `shape` (in place)
+    if t.is_sparse:
+        # sparse optimizer state (DLRTEmbedding with sparse=True): the sparse dims are whole
+        values = t._values()
+        for dim, sz in enumerate(shape[t.sparse_dim() :], start=1):
+            values.narrow(dim, sz, values.shape[dim] - sz).zero_()
+        return
+    for dim, sz in enumerate(shape):
+        t.narrow(dim, sz, t.shape[dim] - sz).zero_()
+
+
+def _shrink_parameter(module: nn.Module, name: str, shape, optimizer=None):
+    # replace a parameter with the leading block of `shape`
+    #   a new parameter is needed, autograd caches the shape of the old one. the optimizer
+    #   param_groups and state are moved to the new parameter
+    old = getattr(module, name)
+    new = nn.Parameter(_leading_block(old.detach(), shape), requires_grad=old.requires_grad)
+    if old.grad is not None:
+        new.grad = _leading_block(old.grad, shape)
+    setattr(module, name, new)
+    if optimizer is None:
+        return
+    for group in optimizer.param_groups:
+        group["params"] = [new if p is old else p for p in group["params"]]
+    if old in optimizer.state:
+        state = optimizer.state.pop(old)
+        for key, val in state.items():
+            if torch.is_tensor(val) and val.shape == old.shape:
+                state[key] = _leading_block(val, shape)
+        optimizer.state[new] = state
+
 
 class DLRTModule(nn.Module):
     # parent class to abstract some methods
@@ -14,6 +172,16 @@ class DLRTModule(nn.Module):
         self.prev_case = "s"
         self.fixed = fixed
         self.basic_number_weights = None
+        # number of rank adaptions since the rank last changed
+        self.rank_stable_steps = 0
+        # forward rank is rounded up to a multiple of this (None -> exact rank), see low_rank
+        self.rank_bucket = None
+        # precision of the QRs and SVDs (None -> at least fp32), see set_linalg_dtype
+        self.linalg_dtype = None
+        # singular values of the last rank adaption (on the device), read by the rank history
+        self.last_singular_values = None
+        # rank beyond which the factors and their optimizer state are zero (None -> unknown)
+        self._zeroed_rank = None
 
     def k_preprocess(self):
         ...
@@ -30,24 +198,257 @@ class DLRTModule(nn.Module):
     def s_preprocess(self):
         ...
 
+    def kl_preprocess(self):
+        # parallel integrator: K and L are trained in the same pass (to be overwritten)
+        ...
+
+    def kl_postprocess(self):
+        self.k_postprocess()
+        self.l_postprocess()
+
+    def postprocess_qr_input(self, case: str):
+        # matrix which is orthogonalized in the k/l postprocessing (the QR is batched across layers
+        #   by the GroupedLinalg engine), None -> the layer does its own postprocessing
+        return None
+
+    def postprocess_from_qr(self, case: str, q):
+        # set the augmented basis from the Q of postprocess_qr_input(case)
+        ...
+
+    def postprocess_tensors(self, case: str):
+        # views of everything the `case` postprocessing writes (k, l, kl, kls), copied from the
+        #   process which ran it if the linear algebra is sharded, None -> every process runs it
+        return None
+
     def rank_adaption(self):
         # to be overwritten (if needed in the not-fixed case)
         ...
 
+    def rank_adaption_svd_input(self):
+        # matrix whose SVD is used for the rank adaption, None -> no rank adaption
+        return None
+
+    def rank_adaption_from_svd(self, u2, sing, vh2, skip=False):
+        # rank_adaption_prepare with the SVD already computed
+        return None
+
+    def rank_adaption_prepare(self, skip=False):
+        # first half of the rank adaption: SVD of S and the new rank (on the device)
+        #   to be overwritten (if needed in the not-fixed case), None -> nothing to apply
+        return None
+
+    def rank_adaption_apply(self, new_rank: int):
+        # second half of the rank adaption: truncate the factors to the new rank
+        ...
+
+    def _factor_shapes(self, rmax: int) -> dict:
+        # shapes of all rank-dependent parameters for a given rmax
+        #   to be overwritten by the adaptive layers, empty -> layer cannot be compacted
+        return {}
+
+    @property
+    def low_rank(self) -> int:
+        return self._low_rank
+
+    @low_rank.setter
+    def low_rank(self, rank: int):
+        self._low_rank = rank
+        self._update_forward_rank()
+
+    def _update_forward_rank(self):
+        # forward_rank: rank the factors are sliced to in the forward. With a rank bucket, this is
+        #   the rank rounded up to a multiple of the bucket and the bases are zero-padded beyond the
+        #   rank. It is a plain int (not computed in the forward) -> torch.compile only guards on
+        #   the bucketed value and can reuse its graphs while the rank stays in the bucket
+        if not self.rank_bucket:
+            self.forward_rank = self.low_rank
+            return
+        rank = -(-self.low_rank // self.rank_bucket) * self.rank_bucket
+        self.forward_rank = min(rank, self._max_forward_rank())
+
+    def _max_forward_rank(self) -> int:
+        # largest rank the factors can be sliced to in all forward cases
+        return self.rmax
+
+    def _zero_rank_padding(self):
+        # zero the bases beyond the current rank (to be overwritten by the adaptive layers)
+        ...
+
+    @torch.no_grad()
+    def set_rank_bucket(self, bucket: int | None):
+        """
+        Round the rank used in the forward up to a multiple of `bucket` (None -> exact rank)
+        """
+        if bucket is not None and bucket < 1:
+            raise ValueError(f"rank bucket must be positive, currently: {bucket}")
+        self.rank_bucket = bucket
+        self._update_forward_rank()
+        if bucket:
+            self._zero_rank_padding()
+
+    def set_linalg_dtype(self, dtype: torch.dtype | None):
+        """
+        Run the QRs of the postprocessing and the SVDs of the rank adaption in `dtype` (e.g.
+        torch.float64). None -> the dtype of the factors, but at least fp32
+        """
+        self.linalg_dtype = dtype
+
+    def _min_rmax(self, low_rank: int) -> int:
+        # smallest rmax which can hold the factors for the given low_rank
+        return low_rank
+
+    def compacted_rmax(self, margin: float = 0.1, patience: int = 100) -> int | None:
+        """
+        Get the rmax which the factors can be shrunk to (current rank + growth margin).
+        The current rmax is returned if the rank has not been stable for `patience` rank adaptions.
+        None is returned if the layer cannot be compacted.
+        """
+        if not self._factor_shapes(1):
+            return None
+        if getattr(self, "pretrain", False) or self.rank_stable_steps < patience:
+            return self.rmax
+        new_rmax = self._min_rmax(self.low_rank + math.ceil(margin * self.low_rank))
+        return min(self.rmax, new_rmax)
+
+    @torch.no_grad()
+    def shrink_to_fit(self, rmax: int, optimizer=None) -> bool:
+        """
+        Reallocate all factors to the given rmax. The factors are replaced by new parameters, the
+        optimizer (if given) is remapped to them and their gradients and optimizer state are cut
+        down as well. If the model is wrapped in DDP, it must be re-wrapped after this
+        (see `DLRTNetwork.compact_factors`).
+
+        Returns
+        -------
+        if the factors were reallocated
+        """
+        shapes = self._factor_shapes(rmax)
+        if not shapes or rmax >= self.rmax:
+            return False
+        if rmax < self._min_rmax(self.low_rank):
+            raise ValueError(f"rmax {rmax} is too small for the current rank {self.low_rank}")
+        for name, shape in shapes.items():
+            _shrink_parameter(self, name, shape, optimizer)
+        self.rmax = rmax
+        self._update_forward_rank()
+        return True
+
+    def checkpoint_shapes(self) -> dict:
+        """
+        Shapes of the leading blocks of the parameters/buffers of this layer (not of its DLRT
+        sub-layers) which are saved in a compact checkpoint, see `dlrt.checkpoint`. Everything else
+        is rebuilt by the pre-/postprocessing of the next step. Default: all of them, whole.
+        """
+        named = itertools.chain(self.named_parameters(recurse=False), self.named_buffers(recurse=False))
+        return {name: tuple(t.shape) for name, t in named}
+
+    def optimizer_state_shapes(self) -> dict:
+        """
+        Shapes of the leading blocks of the optimizer state (momentum etc.) of the parameters of this
+        layer which are saved in a compact checkpoint. Default: all of them, whole.
+        """
+        return {name: tuple(p.shape) for name, p in self.named_parameters(recurse=False)}
+
+    @torch.no_grad()
+    def zero_beyond_rank(self, optimizer=None, force: bool = False):
+        """
+        Zero the trained factors and their optimizer state (momentum etc., if `optimizer` is given)
+        outside of the `optimizer_state_shapes` blocks, i.e. in the directions which were dropped by
+        the rank adaption. Nothing beyond the rank carries over when the rank grows back, and the
+        compact checkpoints hold all of the optimizer state. `force`: the factors were set
+        elsewhere (init, end of the pretraining, checkpoint), otherwise only a shrunk rank is zeroed.
+        """
+        rank = getattr(self, "low_rank", None)
+        # outside of the blocks, the gradients are zero -> it stays zero while the rank does not
+        #   shrink (a rank bucket trains the padding, it is zeroed every time)
+        unchanged = not force and rank is not None and getattr(self, "forward_rank", rank) == rank
+        if unchanged and self._zeroed_rank is not None and rank >= self._zeroed_rank:
+            self._zeroed_rank = rank
+            return
+        state = optimizer.state if optimizer is not None else {}
+        for name, shape in self.optimizer_state_shapes().items():
+            p = getattr(self, name)
+            if tuple(shape) == tuple(p.shape):
+                continue
+            _zero_beyond_block(p, shape)
+            for val in state.get(p, {}).values():
+                if torch.is_tensor(val) and val.shape == p.shape:
+                    _zero_beyond_block(val, shape)
+        self._zeroed_rank = rank
+
+    def checkpoint_meta(self) -> dict:
+        # rank and phase of the layer, restored before the tensors
+        meta = {"train_case": self.train_case, "rank_stable_steps": self.rank_stable_steps}
+        for key in ("low_rank", "rmax", "pretrain"):
+            if hasattr(self, key):
+                meta[key] = getattr(self, key)
+        return meta
+
+    @torch.no_grad()
+    def load_checkpoint_state(self, meta: dict, tensors: dict, optimizer=None):
+        """
+        Restore the layer from the `checkpoint_meta` and `checkpoint_shapes` tensors of a compact
+        checkpoint. The full-width buffers are rebuilt (zero beyond the saved blocks). If the
+        checkpoint has a smaller rmax (compacted factors), the factors are shrunk first and
+        `optimizer` is remapped to the new parameters.
+        """
+        if meta.get("pretrain", False) and not getattr(self, "pretrain", False):
+            raise ValueError("the checkpoint is in pretraining, the layer is not")
+        if getattr(self, "pretrain", False) and not meta.get("pretrain", False):
+            # past the pretraining: the factors come from the checkpoint, not from the SVD
+            self.pretrain = False
+            del self.fullweight
+        self.train_case = meta["train_case"]
+        self.rank_stable_steps = meta["rank_stable_steps"]
+        if "low_rank" in meta:
+            self.low_rank = meta["low_rank"]
+        if "rmax" in meta and meta["rmax"] != self.rmax:
+            if not self.shrink_to_fit(meta["rmax"], optimizer=optimizer):
+                raise ValueError(f"cannot restore rmax {meta['rmax']} into a layer with rmax {self.rmax}")
+        for name, t in tensors.items():
+            target = getattr(self, name)
+            target.copy_(_expand_block(t.to(target.device), target.shape))
+        if self.rank_bucket:
+            self._zero_rank_padding()
+
     def stop_pretraining(self):
         # stop pretraining and convert layers to DLRT layers
         # - shows bad performance in initial tests
         ...
 
+    def sync_tensors(self) -> list[Tensor]:
+        """
+        Views of the state which is synchronized between the processes: the active blocks of the
+        `checkpoint_shapes` (e.g. U[:, :r], S[:r, :r], Vt[:r], and the bias), everything else is
+        rebuilt from them by the pre-/postprocessing.
+        """
+        return [
+            _leading_block(getattr(self, name).detach(), shape, clone=False)
+            for name, shape in self.checkpoint_shapes().items()
+        ]
+
+    @torch.no_grad()
     def all_reduce(self, method: str = "average"):
         # reduce the parameters across the parameter space (i.e. average them across the processes)
-        #   only does something if working in parallel
-        ...
+        #   only does something if working in parallel. DLRTNetwork syncs all layers at once
+        #   (sync_dlrt_layers), this is for a single layer
+        if method != "average":
+            raise ValueError(f"invalid all reduce method: {method}")
+        reducer = BucketedAllReduce()
+        reducer.add(self.sync_tensors())
+        reducer.wait()
 
     def set_dlrt_requires_grad(self, requires):
         # sets the dlrt params to either require grads or not.
         ...
 
+    def inference_factors(self) -> tuple[Tensor, Tensor]:
+        """
+        Factors of the current weight for inference: W = second @ first in the torch layout, with
+        first: rank x in and second: out x rank (for convolutions in = in_channels * kernel size)
+        """
+        raise NotImplementedError(f"{type(self).__name__} cannot be exported for inference")
+
     def get_rank_percentage(self):
         """
         Get the percentage of ranks being used compared to the number of weights in a dense layer
@@ -56,8 +457,8 @@ class DLRTModule(nn.Module):
 
     def change_training_case(self, case):
         # switch -> if current train case is k/l, do post for
-        if case not in ["k", "l", "s", "pretrain"]:
-            raise ValueError(f"case must be one of k, l, s, or pretrain, not: {case}")
+        if case not in ["k", "l", "s", "kl", "kls", "pretrain"]:
+            raise ValueError(f"case must be one of k, l, s, kl, kls, or pretrain, not: {case}")
         self.train_case = case
         self.training = True
 
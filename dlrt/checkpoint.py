@@ -0,0 +1,376 @@
+from __future__ import annotations
+
+import copy
+import os
+import queue
+import threading
+import time
+
+import torch
+
+from .basic import _expand_block
+from .basic import _leading_block
+
+__all__ = [
+    "AsyncCheckpointWriter",
+    "atomic_save",
+    "compact_state_dict",
+    "load_compact_state_dict",
+    "load_checkpoint",
+    "save_checkpoint",
+]
+
+CHECKPOINT_VERSION = 1
+
+
+def _dlrt_layers(network) -> dict:
+    return {name: module for name, module in network.dlrt_model.named_modules() if hasattr(module, "dlrt")}
+
+
+def _layer_of(name: str, layers: dict):
+    # DLRT layer which directly owns the parameter/buffer `name` (None -> dense part of the model)
+    owner, _, attr = name.rpartition(".")
+    layer = layers.get(owner)
+    return (layer, attr) if layer is not None else (None, name)
+
+
+@torch.no_grad()
+def compact_state_dict(network, optimizer=None) -> dict:
+    """
+    State of a DLRTNetwork (and its optimizer) with the DLRT layers stored at their current rank.
+
+    Every DLRT layer stores the leading blocks of its `checkpoint_shapes` (e.g. U[:, :r], S[:r, :r],
+    Vt[:r], and the bias) and its rank/phase metadata, the optimizer state of the factors is cut to
+    `optimizer_state_shapes` (it is zero beyond them, see `DLRTNetwork.zero_beyond_rank`). The
+    dense part of the model and its optimizer state are stored whole. The size of the checkpoint
+    scales with the ranks, not with rmax.
+
+    Parameters
+    ----------
+    network: DLRTNetwork
+    optimizer: torch.optim.Optimizer
+        optimizer of the network parameters, optional
+    """
+    return _compact_state(network, optimizer, clone=True)
+
+
+def _compact_state(network, optimizer, clone: bool) -> dict:
+    # clone=False: the tensors are views of the training state (copied by AsyncCheckpointWriter)
+    layers = _dlrt_layers(network)
+    layer_state = {}
+    for name, layer in layers.items():
+        tensors = {
+            attr: _leading_block(getattr(layer, attr).detach(), shape, clone=clone)
+            for attr, shape in layer.checkpoint_shapes().items()
+        }
+        layer_state[name] = {"meta": layer.checkpoint_meta(), "tensors": tensors}
+
+    dense = {}
+    for name, t in network.dlrt_model.state_dict(keep_vars=True).items():
+        if _layer_of(name, layers)[0] is None:
+            dense[name] = t.detach().clone() if clone else t.detach()
+
+    state = {
+        "version": CHECKPOINT_VERSION,
+        "layers": layer_state,
+        "dense": dense,
+        "network": {"pretrain_count": network.pretrain_count},
+    }
+    if optimizer is not None:
+        state["optimizer"] = _optimizer_state(network, optimizer, layers, clone)
+    return state
+
+
+def _optimizer_state(network, optimizer, layers, clone: bool) -> dict:
+    names = {p: name for name, p in network.dlrt_model.named_parameters()}
+    groups = []
+    state = {}
+    for group in optimizer.param_groups:
+        # parameters which are not in the model anymore (e.g. the fullweight after the pretraining)
+        #   have no name, their state is not saved
+        groups.append({**{k: v for k, v in group.items() if k != "params"}, "params": []})
+        for p in group["params"]:
+            name = names.get(p)
+            groups[-1]["params"].append(name)
+            if name is None or p not in optimizer.state:
+                continue
+            layer, attr = _layer_of(name, layers)
+            shape = tuple(p.shape)
+            if layer is not None:
+                shape = layer.optimizer_state_shapes().get(attr)
+                if shape is None:
+                    # state of this parameter is rebuilt/irrelevant between steps
+                    continue
+            state[name] = {
+                key: _leading_block(val, shape, clone=clone)
+                if torch.is_tensor(val) and val.shape == p.shape
+                else val
+                for key, val in optimizer.state[p].items()
+            }
+    return {"param_groups": groups, "state": state}
+
+
+@torch.no_grad()
+def load_compact_state_dict(network, state: dict, optimizer=None):
+    """
+    Restore a DLRTNetwork (and its optimizer) from `compact_state_dict`. The network must be built
+    from the same model with the same settings, the full-width buffers of the DLRT layers are
+    rebuilt (zero beyond the saved blocks). Layers which were compacted in the checkpoint are
+    shrunk to the same rmax, `optimizer` is remapped to their new parameters.
+    """
+    if state.get("version") != CHECKPOINT_VERSION:
+        raise ValueError(f"unsupported checkpoint version: {state.get('version')}")
+    layers = _dlrt_layers(network)
+    if set(layers) != set(state["layers"]):
+        raise ValueError(
+            f"the DLRT layers of the checkpoint and the network differ: "
+            f"{sorted(set(layers) ^ set(state['layers']))}",
+        )
+    for name, layer in layers.items():
+        saved = state["layers"][name]
+        layer.load_checkpoint_state(saved["meta"], saved["tensors"], optimizer=optimizer)
+    network.pretrain_count = state["network"]["pretrain_count"]
+
+    model_state = network.dlrt_model.state_dict(keep_vars=True)
+    for name, t in state["dense"].items():
+        model_state[name].copy_(t)
+    if optimizer is not None and "optimizer" in state:
+        _load_optimizer_state(network, optimizer, state["optimizer"])
+    # the factors beyond the ranks are not in the checkpoint, they are zero in the saved network
+    network.zero_beyond_rank(optimizer, force=True)
+    # the layers might have new parameters (shrunk) -> rebuild the cached layer commands
+    network.invalidate_layers()
+
+
+def _load_optimizer_state(network, optimizer, state: dict):
+    params = dict(network.dlrt_model.named_parameters())
+    if len(state["param_groups"]) != len(optimizer.param_groups):
+        raise ValueError("the parameter groups of the checkpoint and the optimizer differ")
+    for group, saved in zip(optimizer.param_groups, state["param_groups"]):
+        group.update({k: v for k, v in saved.items() if k != "params"})
+    optimizer.state.clear()
+    for name, saved in state["state"].items():
+        p = params[name]
+        # the blocks which were cut to the rank (same number of dims as the parameter) are padded
+        optimizer.state[p] = {
+            key: _expand_block(val.to(p.device), p.shape)
+            if torch.is_tensor(val) and val.dim() == p.dim()
+            else val
+            for key, val in saved.items()
+        }
+
+
+def save_checkpoint(trainer, path, writer: AsyncCheckpointWriter = None, on_done=None, **extra) -> float:
+    """
+    Save a compact checkpoint of a DLRTTrainer: network and optimizer (see `compact_state_dict`),
+    the step counter, the gradient scalers, and the keyword arguments in `extra` (e.g. the epoch).
+    The file is written with `atomic_save`.
+
+    Parameters
+    ----------
+    trainer: DLRTTrainer
+    path
+    writer: AsyncCheckpointWriter
+        if given, the state is only copied to the staging buffers of the writer and written in the
+        background (training can continue right away)
+    on_done
+        called with `path` once the file is complete (by the worker thread with a writer)
+
+    Returns
+    -------
+    seconds for which the training is stopped (writing the checkpoint, or the copy with a writer)
+    """
+    start = time.perf_counter()
+    state = _compact_state(trainer.dlrt_model, trainer.optimizer, clone=writer is None)
+    state["trainer"] = {
+        "counter": trainer.counter,
+        "scalers": {case: getattr(trainer, f"{case}scaler").state_dict() for case in trainer.scaler_cases},
+    }
+    state["extra"] = extra
+    if writer is None:
+        atomic_save(state, path)
+        if on_done is not None:
+            on_done(path)
+    else:
+        writer.save(state, path, on_done=on_done)
+    return time.perf_counter() - start
+
+
+def load_checkpoint(trainer, path, map_location=None) -> dict:
+    """
+    Restore a DLRTTrainer from `save_checkpoint`. The trainer must be built from the same model
+    with the same settings.
+
+    Returns
+    -------
+    the `extra` keyword arguments of `save_checkpoint`
+    """
+    state = torch.load(path, map_location=map_location, weights_only=False)
+    load_compact_state_dict(trainer.dlrt_model, state, trainer.optimizer)
+    trainer.counter = state["trainer"]["counter"]
+    for case, scaler_state in state["trainer"]["scalers"].items():
+        if scaler_state:
+            getattr(trainer, f"{case}scaler").load_state_dict(scaler_state)
+    return state["extra"]
+
+
+def atomic_save(obj, path):
+    """
+    torch.save `obj` to a temporary file next to `path`, fsync it, and rename it to `path`. A
+    crash while writing leaves the previous file at `path` intact.
+    """
+    path = os.fspath(path)
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        torch.save(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    # the rename itself is only durable once the directory is synced
+    fd = os.open(os.path.dirname(path) or ".", os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class AsyncCheckpointWriter:
+    """
+    Write checkpoints in a background thread while the training continues.
+
+    `save` copies the tensors of a state (nested dicts/lists/tuples) into staging buffers and
+    returns, the worker thread serializes the copy with `atomic_save`. The training only stops for
+    the copy: CUDA tensors are copied to pinned host memory on the current stream (ordered before
+    any later update of the tensors), the worker waits for the copy to finish. The staging buffers
+    are reused by the next checkpoint with the same structure.
+
+    At most `max_pending` checkpoints are staged at the same time (memory: `max_pending` copies of
+    the state), `save` blocks until a set of buffers is free. Errors of the worker are raised by the
+    next `save`, `wait`, or `close`.
+
+    Parameters
+    ----------
+    max_pending: int
+        number of checkpoints which can be staged/written at the same time
+    pin_memory: bool
+        stage CUDA tensors in pinned host memory (asynchronous copies), default: if CUDA is available
+    """
+
+    def __init__(self, max_pending: int = 1, pin_memory: bool = None):
+        if max_pending < 1:
+            raise ValueError(f"max_pending must be at least 1, currently: {max_pending}")
+        self.pin_memory = torch.cuda.is_available() if pin_memory is None else pin_memory
+        # one dict of staging buffers (key: position in the state) per pending checkpoint
+        self._free = queue.Queue()
+        for _ in range(max_pending):
+            self._free.put({})
+        self._jobs = queue.Queue()
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name="checkpoint-writer", daemon=True)
+        self._thread.start()
+
+    def save(self, state, path, on_done=None) -> float:
+        """
+        Stage `state` and write it to `path` in the background, `on_done(path)` is called by the
+        worker once the file is complete (e.g. to copy the best model).
+
+        Returns
+        -------
+        seconds for which the caller was stopped (waiting for free buffers + copy)
+        """
+
+        def write(staged):
+            atomic_save(staged, path)
+            if on_done is not None:
+                on_done(path)
+
+        return self.submit(write, state)
+
+    def submit(self, fn, state) -> float:
+        """
+        Stage `state` and call `fn(staged)` in the worker thread, e.g. to post-process the copy
+        before writing it. The staged tensors are reused afterwards, `fn` must not keep them.
+        """
+        self._raise_error()
+        if not self._thread.is_alive():
+            raise RuntimeError("the checkpoint writer is closed")
+        start = time.perf_counter()
+        buffers = self._free.get()
+        used = set()
+        staged, cuda = self._stage(state, buffers, (), used)
+        # drop the buffers of tensors which are not in the state anymore (e.g. after a rank change)
+        for key in set(buffers) - used:
+            del buffers[key]
+        event = None
+        if cuda:
+            event = torch.cuda.Event()
+            event.record()
+        self._jobs.put((fn, staged, event, buffers))
+        return time.perf_counter() - start
+
+    def _stage(self, obj, buffers: dict, key: tuple, used: set):
+        # copy of obj, the tensors are copied into (reused) CPU buffers. returns (copy, any CUDA copy)
+        if torch.is_tensor(obj):
+            obj = obj.detach()
+            if obj.layout != torch.strided:
+                # sparse tensors change their number of values, they are not staged
+                return obj.cpu().clone(), False
+            used.add(key)
+            buf = buffers.get(key)
+            if buf is None or buf.shape != obj.shape or buf.dtype != obj.dtype:
+                buf = torch.empty(obj.shape, dtype=obj.dtype, pin_memory=self.pin_memory and obj.is_cuda)
+                buffers[key] = buf
+            buf.copy_(obj, non_blocking=obj.is_cuda)
+            return buf, obj.is_cuda
+        if isinstance(obj, dict):
+            items = [(k, self._stage(v, buffers, key + (k,), used)) for k, v in obj.items()]
+            return {k: v for k, (v, _) in items}, any(c for _, (_, c) in items)
+        if isinstance(obj, (list, tuple)):
+            items = [self._stage(v, buffers, key + (i,), used) for i, v in enumerate(obj)]
+            return type(obj)(v for v, _ in items), any(c for _, c in items)
+        return copy.deepcopy(obj), False
+
+    def _run(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                self._jobs.task_done()
+                return
+            fn, staged, event, buffers = job
+            try:
+                if event is not None:
+                    event.synchronize()
+                fn(staged)
+            except Exception as e:  # noqa: B902
+                self._error = e
+            finally:
+                del staged
+                self._free.put(buffers)
+                self._jobs.task_done()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError("writing a checkpoint failed") from error
+
+    def wait(self):
+        """
+        Block until all submitted checkpoints are written.
+        """
+        self._jobs.join()
+        self._raise_error()
+
+    def close(self):
+        """
+        Write the pending checkpoints and stop the worker thread.
+        """
+        if self._thread.is_alive():
+            self._jobs.put(None)
+            self._thread.join()
+        self._raise_error()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
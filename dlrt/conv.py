@@ -20,20 +20,40 @@ from torch import Tensor
 from torch.nn import common_types
 
 from .basic import DLRTModule
+from .basic import TRUNCATION_CRITERIA
+from .basic import qr
+from .basic import svd
+from .basic import truncation_rank
 
 console = Console(width=140)
 
-__all__ = ["DLRTConv2d", "DLRTConv2dAdaptive", "DLRTConv2dFixed"]
-
-
-def DLRTConv2d(
+__all__ = [
+    "DLRTConv1d",
+    "DLRTConv1dAdaptive",
+    "DLRTConv1dFixed",
+    "DLRTConv2d",
+    "DLRTConv2dAdaptive",
+    "DLRTConv2dFixed",
+    "DLRTConv3d",
+    "DLRTConv3dAdaptive",
+    "DLRTConv3dFixed",
+]
+
+# conv: convolution with the rank-r factor as kernels, then a 1x1 convolution
+# unfold: im2col (F.unfold) and matrix products (B x C*kh*kw x H*W intermediate)
+_FORWARD_IMPLS = ("conv", "unfold")
+_CONV_FNS = {1: F.conv1d, 2: F.conv2d, 3: F.conv3d}
+
+
+def _dlrt_conv(
+    ndim: int,
     adaptive: bool,
     in_channels: int,
     out_channels: int,
-    kernel_size: common_types._size_2_t,
-    stride: common_types._size_2_t = 1,
-    padding: str | common_types._size_2_t = 0,
-    dilation: common_types._size_2_t = 1,
+    kernel_size: common_types._size_any_t,
+    stride: common_types._size_any_t = 1,
+    padding: str | common_types._size_any_t = 0,
+    dilation: common_types._size_any_t = 1,
     groups: int = 1,
     bias: bool = True,
     padding_mode: str = "zeros",
@@ -44,9 +64,12 @@ def DLRTConv2d(
     convert_from_weights: Tensor = None,
     existing_bias: Tensor = None,
     pretrain: bool = True,
+    truncation: str = "relative",
+    forward_impl: str = "conv",
 ):
+    adaptive_cls, fixed_cls = _CONV_CLASSES[ndim]
     if adaptive:
-        return DLRTConv2dAdaptive(
+        return adaptive_cls(
             in_channels,
             out_channels,
             kernel_size,
@@ -63,9 +86,11 @@ def DLRTConv2d(
             # convert_from_weights=convert_from_weights,
             # existing_bias=existing_bias,
             pretrain=pretrain,
+            truncation=truncation,
+            forward_impl=forward_impl,
         )
     else:
-        return DLRTConv2dFixed(
+        return fixed_cls(
             in_channels,
             out_channels,
             kernel_size,
@@ -81,9 +106,25 @@ def DLRTConv2d(
             convert_from_weights=convert_from_weights,
             existing_bias=existing_bias,
             # pretrain=pretrain,  TODO
+            forward_impl=forward_impl,
         )
 
 
+def DLRTConv1d(adaptive: bool, *args, **kwargs):
+    # adaptive or fixed rank DLRT Conv1d, same arguments as DLRTConv2d
+    return _dlrt_conv(1, adaptive, *args, **kwargs)
+
+
+def DLRTConv2d(adaptive: bool, *args, **kwargs):
+    # adaptive or fixed rank DLRT Conv2d, see _dlrt_conv for the arguments
+    return _dlrt_conv(2, adaptive, *args, **kwargs)
+
+
+def DLRTConv3d(adaptive: bool, *args, **kwargs):
+    # adaptive or fixed rank DLRT Conv3d, same arguments as DLRTConv2d
+    return _dlrt_conv(3, adaptive, *args, **kwargs)
+
+
 def _ntuple(n, name="parse"):
     def parse(x):
         if isinstance(x, collections.abc.Iterable):
@@ -138,6 +179,8 @@ class _ConvNd(DLRTModule):
     low_rank: int
     rmax: int
     convert_from_weights: Tensor
+    # number of spatial dimensions, set by the Conv1d/2d/3d classes
+    _ndim: int
 
     def __init__(
         self,
@@ -160,14 +203,22 @@ class _ConvNd(DLRTModule):
         convert_from_weights: torch.Tensor = None,
         # existing_bias: Tensor = None,
         pretrain: bool = True,
+        forward_impl: str = "conv",
     ) -> None:
         # from torch =================================================================
         factory_kwargs = {"device": device, "dtype": dtype}
         super().__init__()
+        if forward_impl not in _FORWARD_IMPLS:
+            raise ValueError(f"forward_impl must be one of {_FORWARD_IMPLS}, not: {forward_impl}")
+        self.forward_impl = forward_impl
         if in_channels % groups != 0:
             raise ValueError("in_channels must be divisible by groups")
         if out_channels % groups != 0:
             raise ValueError("out_channels must be divisible by groups")
+        if groups > 1 and forward_impl == "unfold":
+            raise ValueError("forward_impl='unfold' does not support groups")
+        if self._ndim != 2 and forward_impl == "unfold":
+            raise ValueError("forward_impl='unfold' is only supported for 2D convolutions")
         valid_padding_strings = {"same", "valid"}
         if isinstance(padding, str):
             if padding not in valid_padding_strings:
@@ -221,14 +272,18 @@ class _ConvNd(DLRTModule):
         self.fixed_rank = fixed_rank
         kernel_size_number = np.prod(self.kernel_size)
         self.kernel_size_number = kernel_size_number
+        # grouped convolution: every group has its own factors for its out_group x in_kern block
+        #   of the weight. they are stacked along a leading group dimension (no group dimension for
+        #   groups == 1) -> K/L/S, the QRs and the SVDs are batched over the groups
+        self.group_shape = (groups,) if groups > 1 else ()
+        self.out_group = out_channels // groups
+        self.in_kern = int(in_channels // groups * kernel_size_number)
 
         self.basic_number_weights = in_channels * (out_channels // groups + kernel_size_number)
         # a, b = in_channels, (out_channels // groups + kernel_size_number)
 
         # TODO: fix me!
-        self.low_rank = int(
-            min([self.out_channels, self.in_channels * self.kernel_size_number]) / 2,
-        )
+        self.low_rank = int(min([self.out_group, self.in_kern]) / 2)
         self.rmax = self.low_rank * 2
         # print("rmax", self.rmax, self.out_channels, self.in_channels * self.kernel_size_number)
 
@@ -282,6 +337,64 @@ class _ConvNd(DLRTModule):
                 requires_grad=False,
             )
 
+    def _padded(self, input: Tensor) -> tuple[Tensor, str | tuple[int, ...]]:
+        # non-zero padding modes are applied before the convolution (same as torch)
+        if self.padding_mode == "zeros":
+            return input, self.padding
+        padding = _ntuple(self._ndim)(0)
+        return F.pad(input, self._reversed_padding_repeated_twice, mode=self.padding_mode), padding
+
+    def _conv(self, input: Tensor, weight: Tensor, bias: Tensor | None = None) -> Tensor:
+        input, padding = self._padded(input)
+        conv = _CONV_FNS[self._ndim]
+        return conv(input, weight, bias, self.stride, padding, self.dilation, self.groups)
+
+    def _kernel(self, first: Tensor) -> Tensor:
+        # factor ([groups x] in_kern x r) -> groups * r kernels (in_channels // groups x *kernel_size)
+        return first.mT.reshape(-1, self.in_channels // self.groups, *self.kernel_size)
+
+    def _expand(self, reduced: Tensor, second: Tensor, bias: Tensor | None = None) -> Tensor:
+        # 1x1 (1x1x1, ...) (grouped) convolution with the factor [groups x] out_group x r
+        second = second.reshape(-1, second.shape[-1], *(1,) * self._ndim)
+        return _CONV_FNS[self._ndim](reduced, second, bias, groups=self.groups)
+
+    def _factored_conv(self, input: Tensor, first: Tensor, second: Tensor, bias: Tensor | None = None):
+        # convolution with W = second @ first.T (per group) without the unfolded input:
+        #   r-channel convolution with the columns of first as kernels, then 1x1 convolution with second
+        return self._expand(self._conv(input, self._kernel(first)), second, bias)
+
+    def _unfold(self, input: Tensor) -> tuple[Tensor, int, int]:
+        # unfolded input (batch x out_h * out_w x in_channels * kh * kw) and the output size
+        input, padding = self._padded(input)
+        shp2, shp3 = input.shape[-2:]
+        pad0, dil0, kern0 = padding[0], self.dilation[0], self.kernel_size[0]
+        pad1, dil1, kern1 = padding[1], self.dilation[1], self.kernel_size[1]
+        stride0 = self.stride[0]
+        stride1 = self.stride[1]
+        out_h = int((shp2 + 2 * pad0 - dil0 * (kern0 - 1) - 1) // stride0) + 1
+        out_w = int((shp3 + 2 * pad1 - dil1 * (kern1 - 1) - 1) // stride1) + 1
+        # out_h = int(np.floor(((input.shape[2] + 2 * self.padding[0] - self.dilation[0] * (
+        #                 self.kernel_size[0] - 1) - 1) / self.stride[0]) + 1))
+        # out_w = int(np.floor(((input.shape[3] + 2 * self.padding[1] - self.dilation[1] * (
+        #                   self.kernel_size[1] - 1) - 1) / self.stride[1]) + 1))
+        inp_unf = F.unfold(
+            input,
+            self.kernel_size,
+            dilation=self.dilation,
+            padding=padding,
+            stride=self.stride,
+        ).transpose(1, 2)
+        return inp_unf, out_h, out_w
+
+    def _init_factor(self, factor: Tensor):
+        # same init for every group as for an ungrouped factor (fan_in = last dimension)
+        nn.init.kaiming_uniform_(factor.view(-1, factor.shape[-1]), a=math.sqrt(5))
+
+    def _flat_factors(self, first: Tensor, second: Tensor) -> tuple[Tensor, Tensor]:
+        # stacked group factors -> torch layout of a grouped convolution
+        #   first: groups * r x in_kern, second: out_channels x r
+        return first.reshape(-1, first.shape[-1]), second.reshape(-1, second.shape[-1])
+
     def extra_repr(self):
         s = (
             f"{self.in_channels}, {self.out_channels}, kernel_size={self.kernel_size}, "
@@ -309,15 +422,15 @@ class _ConvNd(DLRTModule):
             self.padding_mode = "zeros"
 
 
-class DLRTConv2dFixed(_ConvNd):
+class _FixedConvNd(_ConvNd):
     def __init__(
         self,
         in_channels: int,
         out_channels: int,
-        kernel_size: common_types._size_2_t,
-        stride: common_types._size_2_t = 1,
-        padding: str | common_types._size_2_t = 0,
-        dilation: common_types._size_2_t = 1,
+        kernel_size: common_types._size_any_t,
+        stride: common_types._size_any_t = 1,
+        padding: str | common_types._size_any_t = 0,
+        dilation: common_types._size_any_t = 1,
         groups: int = 1,
         bias: bool = True,
         padding_mode: str = "zeros",
@@ -326,6 +439,7 @@ class DLRTConv2dFixed(_ConvNd):
         low_rank_percent=None,
         convert_from_weights: torch.Tensor = None,
         existing_bias: Tensor = None,
+        forward_impl: str = "conv",
     ) -> None:
         """
         Initializer for the convolutional low rank layer (filterwise), extention of the classical Pytorch's convolutional layer.
@@ -343,19 +457,22 @@ class DLRTConv2dFixed(_ConvNd):
         fixed : flag variable, True if the rank has to be fixed (KLS training on this layer)
         load_weights : variables to load (Pytorch standard, to finish)
         dtype : Type of the tensors (Pytorch standard, to finish)
+        forward_impl : 'conv' (rank-r convolution, then 1x1 convolution) or 'unfold' (im2col)
         """
         # TODO: fix init
         #   TODO: maybe remove this and simply use adaptive instead but just dont call the adapt
         factory_kwargs = {"device": device, "dtype": dtype}
+        ntuple = _ntuple(self._ndim)
         super().__init__(
             in_channels=in_channels,
             out_channels=out_channels,
-            kernel_size=kernel_size,
-            stride=stride,
-            padding=padding,
-            dilation=dilation,
+            # same as torch.nn.ConvNd: ints -> (int, ) * ndim
+            kernel_size=ntuple(kernel_size),
+            stride=ntuple(stride),
+            padding=padding if isinstance(padding, str) else ntuple(padding),
+            dilation=ntuple(dilation),
             transposed=False,
-            output_padding=_pair(0),
+            output_padding=ntuple(0),
             groups=groups,
             bias=bias,
             padding_mode=padding_mode,
@@ -364,6 +481,7 @@ class DLRTConv2dFixed(_ConvNd):
             # ====================== DLRT params =========================================
             low_rank_percent=low_rank_percent,
             fixed_rank=False,
+            forward_impl=forward_impl,
         )
 
         self.train_case = "k"
@@ -374,41 +492,42 @@ class DLRTConv2dFixed(_ConvNd):
                 requires_grad=False,
             )
         # n, m = self.out_channels, self.in_channels * self.kernel_size_number
-        in_kern = self.in_channels * self.kernel_size_number
+        # per group: out_group x in_kern (in_kern = in_channels // groups * prod(kernel_size))
+        g, out, in_kern = self.group_shape, self.out_group, self.in_kern
         self.u = nn.Parameter(
-            torch.empty((self.out_channels, self.low_rank), **factory_kwargs),
+            torch.empty((*g, out, self.low_rank), **factory_kwargs),
             requires_grad=False,
         )
         self.u_hat = nn.Parameter(
-            torch.empty((self.out_channels, self.low_rank), **factory_kwargs),
+            torch.empty((*g, out, self.low_rank), **factory_kwargs),
             requires_grad=False,
         )
         self.v = nn.Parameter(
-            torch.empty((in_kern, self.low_rank), **factory_kwargs),
+            torch.empty((*g, in_kern, self.low_rank), **factory_kwargs),
             requires_grad=False,
         )
         self.v_hat = nn.Parameter(
-            torch.empty((in_kern, self.low_rank), **factory_kwargs),
+            torch.empty((*g, in_kern, self.low_rank), **factory_kwargs),
             requires_grad=False,
         )
         self.s_hat = nn.Parameter(
-            torch.empty((self.low_rank, self.low_rank), **factory_kwargs),
+            torch.empty((*g, self.low_rank, self.low_rank), **factory_kwargs),
             requires_grad=True,
         )
         self.k = nn.Parameter(
-            torch.empty((self.out_channels, self.low_rank), **factory_kwargs),
+            torch.empty((*g, out, self.low_rank), **factory_kwargs),
             requires_grad=True,
         )
         self.l = nn.Parameter(  # noqa: E741
-            torch.empty((in_kern, self.low_rank), **factory_kwargs),
+            torch.empty((*g, in_kern, self.low_rank), **factory_kwargs),
             requires_grad=True,
         )
         self.n_hat = torch.nn.Parameter(
-            torch.empty((self.low_rank, self.low_rank), **factory_kwargs),
+            torch.empty((*g, self.low_rank, self.low_rank), **factory_kwargs),
             requires_grad=False,
         )
         self.m_hat = torch.nn.Parameter(
-            torch.empty((self.low_rank, self.low_rank), **factory_kwargs),
+            torch.empty((*g, self.low_rank, self.low_rank), **factory_kwargs),
             requires_grad=False,
         )
         # todo: convert from full rank
@@ -416,17 +535,17 @@ class DLRTConv2dFixed(_ConvNd):
 
     @torch.no_grad()
     def reset_parameters(self):
-        nn.init.kaiming_uniform_(self.u, a=math.sqrt(5))
+        self._init_factor(self.u)
         # nn.init.kaiming_uniform_(self.weight, a=math.sqrt(5))
-        nn.init.kaiming_uniform_(self.s_hat, a=math.sqrt(5))
-        nn.init.kaiming_uniform_(self.v, a=math.sqrt(5))
+        self._init_factor(self.s_hat)
+        self._init_factor(self.v)
 
-        nn.init.kaiming_uniform_(self.u_hat, a=math.sqrt(5))
-        nn.init.kaiming_uniform_(self.v_hat, a=math.sqrt(5))
-        nn.init.kaiming_uniform_(self.k, a=math.sqrt(5))
-        nn.init.kaiming_uniform_(self.l, a=math.sqrt(5))
-        nn.init.kaiming_uniform_(self.n_hat, a=math.sqrt(5))
-        nn.init.kaiming_uniform_(self.m_hat, a=math.sqrt(5))
+        self._init_factor(self.u_hat)
+        self._init_factor(self.v_hat)
+        self._init_factor(self.k)
+        self._init_factor(self.l)
+        self._init_factor(self.n_hat)
+        self._init_factor(self.m_hat)
 
         if self.bias is not None:
             weight = torch.empty(
@@ -441,37 +560,30 @@ class DLRTConv2dFixed(_ConvNd):
                 nn.init.uniform_(self.bias, -bound, bound)
             del weight
 
-    def forward(self, input):
+    def forward(self, input: Tensor) -> Tensor:
         """
         forward phase for the convolutional layer. It has to contain the three different
         phases for the steps 'K','L' and 'S' in order to be optimizable using dlrt.
 
         """
+        if self.forward_impl == "unfold":
+            return self._forward_unfold(input)
+        if self.train_case == "k":
+            return self._factored_conv(input, self.v, self.k, self.bias)
+        elif self.train_case == "l":
+            return self._factored_conv(input, self.l, self.u, self.bias)
+        elif self.train_case == "kl":
+            ret = self._factored_conv(input, self.v, self.k, self.bias)
+            # the l-step values cancel out, only adds the gradients for L
+            lout = self._factored_conv(input.detach(), self.l, self.u)
+            return ret + (lout - lout.detach())
+        elif self.train_case == "s":
+            return self._factored_conv(input, self.v, self.u @ self.s_hat, self.bias)
+        raise ValueError(f"Invalude step value: {self.train_case}")
 
-        # batch_size = input.shape[0]
-        batch_size, shp1, shp2, shp3 = tuple(input.shape)
-        pad0, dil0, kern0 = self.padding[0], self.dilation[0], self.kernel_size[0]
-        pad1, dil1, kern1 = self.padding[1], self.dilation[1], self.kernel_size[1]
-        stride0 = self.stride[0]
-        stride1 = self.stride[1]
-        out_h = int((shp2 + 2 * pad0 - dil0 * (kern0 - 1) - 1) // stride0) + 1
-        out_w = int((shp3 + 2 * pad1 - dil1 * (kern1 - 1) - 1) // stride1) + 1
-
-        # out_h = int(np.floor(((input.shape[2] + 2 * self.padding[0] - self.dilation[0] * (
-        #                 self.kernel_size[0] - 1) - 1) / self.stride[0]) + 1))
-        # out_w = int(np.floor(((input.shape[3] + 2 * self.padding[1] - self.dilation[1] * (
-        #                   self.kernel_size[1] - 1) - 1) / self.stride[1]) + 1))
-
-        inp_unf = (
-            F.unfold(
-                input,
-                self.kernel_size,
-                padding=self.padding,
-                stride=self.stride,
-            )
-            .to(input.device)
-            .transpose(1, 2)
-        )
+    def _forward_unfold(self, input: Tensor) -> Tensor:
+        batch_size = input.shape[0]
+        inp_unf, out_h, out_w = self._unfold(input)
         if self.train_case == "k":
             # print(inp_unf.shape, self.v.shape, self.k.T.shape)
             out_unf = inp_unf @ self.v @ self.k.T
@@ -479,6 +591,11 @@ class DLRTConv2dFixed(_ConvNd):
         elif self.train_case == "l":
             out_unf = inp_unf @ self.l @ self.u.T
             # out_unf = torch.linalg.multi_dot([inp_unf.transpose(1, 2), self.l, self.u.T])
+        elif self.train_case == "kl":
+            out_unf = inp_unf @ self.v @ self.k.T
+            # the l-step values cancel out, only adds the gradients for L
+            lout = inp_unf.detach() @ self.l @ self.u.T
+            out_unf = out_unf + (lout - lout.detach())
         elif self.train_case == "s":
             out_unf = inp_unf @ torch.linalg.multi_dot(
                 [self.v, self.s_hat.T, self.u.T],
@@ -493,6 +610,11 @@ class DLRTConv2dFixed(_ConvNd):
         out_unf.transpose_(1, 2)
         return out_unf.view(batch_size, self.out_channels, out_h, out_w)
 
+    @torch.no_grad()
+    def inference_factors(self) -> tuple[Tensor, Tensor]:
+        # W = U @ S @ V.T (out x in_kern) -> first = S @ V.T, second = U
+        return self._flat_factors(self.s_hat @ self.v.mT, self.u)
+
     def _change_params_requires_grad(self, requires_grad):
         self.k.requires_grad = requires_grad
         self.s_hat.requires_grad = requires_grad
@@ -514,41 +636,48 @@ class DLRTConv2dFixed(_ConvNd):
 
     @torch.no_grad()
     def k_postprocess(self):
-        u_hat, _ = torch.linalg.qr(self.k)
+        u_hat = qr(self.k, self.linalg_dtype)
         # TESTING: setting M and U with 'undoing' the k preprocess
-        self.m_hat.set_(u_hat.T @ self.u)
+        self.m_hat.set_(u_hat.mT @ self.u)
         self.u.set_(u_hat)
 
     @torch.no_grad()
     def l_preprocess(self):
         self._change_params_requires_grad(False)
-        self.l.set_(self.v @ self.s_hat.T)
+        self.l.set_(self.v @ self.s_hat.mT)
         self.l.requires_grad = True
 
+    @torch.no_grad()
+    def kl_preprocess(self):
+        self.k_preprocess()
+        self.l_preprocess()
+        self.k.requires_grad = True
+
     @torch.no_grad()
     def l_postprocess(self):
-        v_hat, _ = torch.linalg.qr(self.l)
-        self.n_hat.set_(v_hat.T @ self.v)
+        v_hat = qr(self.l, self.linalg_dtype)
+        self.n_hat.set_(v_hat.mT @ self.v)
         self.v.data = v_hat
 
     @torch.no_grad()
     def s_preprocess(self):
         self._change_params_requires_grad(False)
-        self.s_hat.set_(torch.linalg.multi_dot([self.m_hat, self.s_hat, self.n_hat.T]))
+        # multi_dot has no batch dimensions (grouped factors)
+        self.s_hat.set_((self.m_hat @ self.s_hat) @ self.n_hat.mT)
         self.s_hat.requires_grad = True
         if self.bias is not None:
             self.bias.requires_grad = True
 
 
-class DLRTConv2dAdaptive(_ConvNd):
+class _AdaptiveConvNd(_ConvNd):
     def __init__(
         self,
         in_channels: int,
         out_channels: int,
-        kernel_size: common_types._size_2_t,
-        stride: common_types._size_2_t = 1,
-        padding: str | common_types._size_2_t = 0,
-        dilation: common_types._size_2_t = 1,
+        kernel_size: common_types._size_any_t,
+        stride: common_types._size_any_t = 1,
+        padding: str | common_types._size_any_t = 0,
+        dilation: common_types._size_any_t = 1,
         groups: int = 1,
         bias: bool = True,
         padding_mode: str = "zeros",
@@ -557,6 +686,8 @@ class DLRTConv2dAdaptive(_ConvNd):
         low_rank_percent=None,
         eps_adapt: float = 0.01,
         pretrain: bool = True,
+        truncation: str = "relative",
+        forward_impl: str = "conv",
     ) -> None:
         """
         Initializer for the convolutional low rank layer (filterwise), extention of the classical Pytorch's convolutional layer.
@@ -573,17 +704,23 @@ class DLRTConv2dAdaptive(_ConvNd):
                 it is an int then it's either the starting rank for adaptive or the fixed rank for the layer.
         load_weights : variables to load (Pytorch standard, to finish)
         dtype : Type of the tensors (Pytorch standard, to finish)
+        truncation : criterion for the rank adaption ('absolute', 'relative', or 'energy'), see basic.truncation_rank
+        forward_impl : 'conv' (rank-r convolution, then 1x1 convolution) or 'unfold' (im2col)
         """
+        if truncation not in TRUNCATION_CRITERIA:
+            raise ValueError(f"truncation must be one of {TRUNCATION_CRITERIA}, not: {truncation}")
         factory_kwargs = {"device": device, "dtype": dtype}
+        ntuple = _ntuple(self._ndim)
         super().__init__(
             in_channels=in_channels,
             out_channels=out_channels,
-            kernel_size=kernel_size,
-            stride=stride,
-            padding=padding,
-            dilation=dilation,
+            # same as torch.nn.ConvNd: ints -> (int, ) * ndim
+            kernel_size=ntuple(kernel_size),
+            stride=ntuple(stride),
+            padding=padding if isinstance(padding, str) else ntuple(padding),
+            dilation=ntuple(dilation),
             transposed=False,
-            output_padding=_pair(0),
+            output_padding=ntuple(0),
             groups=groups,
             bias=bias,
             padding_mode=padding_mode,
@@ -593,14 +730,17 @@ class DLRTConv2dAdaptive(_ConvNd):
             low_rank_percent=low_rank_percent,
             fixed_rank=False,
             pretrain=pretrain,
+            forward_impl=forward_impl,
         )
         self.train_case = "k"
         self.eps_adapt = eps_adapt
+        self.truncation = truncation
 
-        in_kern = self.in_channels * self.kernel_size_number
-        self.in_kern = in_kern
+        # per group: out_group x in_kern (in_kern = in_channels // groups * prod(kernel_size))
+        g, out, in_kern = self.group_shape, self.out_group, self.in_kern
         self.pretrain = pretrain
         if pretrain:
+            # same layout as the weight of nn.ConvNd: out_channels x in_kern
             self.fullweight = nn.Parameter(
                 torch.empty(out_channels, in_kern),
                 requires_grad=True,
@@ -608,6 +748,7 @@ class DLRTConv2dAdaptive(_ConvNd):
         # ONLY create the parameters, reset_parameters fills them
         self.s_hat = nn.Parameter(
             torch.empty(
+                *g,
                 self.rmax,
                 self.rmax,
                 **factory_kwargs,
@@ -615,35 +756,35 @@ class DLRTConv2dAdaptive(_ConvNd):
             requires_grad=False,
         )
         self.u = nn.Parameter(
-            torch.empty(self.out_channels, self.rmax, **factory_kwargs),
+            torch.empty(*g, out, self.rmax, **factory_kwargs),
             requires_grad=False,
         )
         self.u_hat = nn.Parameter(
-            torch.empty(self.out_channels, 2 * self.rmax, **factory_kwargs),
+            torch.empty(*g, out, 2 * self.rmax, **factory_kwargs),
             requires_grad=False,
         )
         self.v = nn.Parameter(
-            torch.empty(in_kern, self.rmax, **factory_kwargs),
+            torch.empty(*g, in_kern, self.rmax, **factory_kwargs),
             requires_grad=False,
         )
         self.v_hat = nn.Parameter(
-            torch.empty(in_kern, 2 * self.rmax, **factory_kwargs),
+            torch.empty(*g, in_kern, 2 * self.rmax, **factory_kwargs),
             requires_grad=False,
         )
         self.k = nn.Parameter(
-            torch.empty(self.out_channels, self.rmax, **factory_kwargs),
+            torch.empty(*g, out, self.rmax, **factory_kwargs),
             requires_grad=False,
         )
         self.l = torch.nn.Parameter(  # noqa: E741
-            torch.empty(in_kern, self.rmax, **factory_kwargs),
+            torch.empty(*g, in_kern, self.rmax, **factory_kwargs),
             requires_grad=False,
         )
         self.n_hat = torch.nn.Parameter(
-            torch.empty(2 * self.rmax, self.rmax, **factory_kwargs),
+            torch.empty(*g, 2 * self.rmax, self.rmax, **factory_kwargs),
             requires_grad=False,
         )
         self.m_hat = torch.nn.Parameter(
-            torch.empty(2 * self.rmax, self.rmax, **factory_kwargs),
+            torch.empty(*g, 2 * self.rmax, self.rmax, **factory_kwargs),
             requires_grad=False,
         )
         self.reset_parameters()
@@ -655,22 +796,71 @@ class DLRTConv2dAdaptive(_ConvNd):
         #         starting_rank=None, #low_rank_percent,  # self.low_rank,
         #     )
 
+    def _factor_shapes(self, rmax: int) -> dict:
+        g, out, in_kern = self.group_shape, self.out_group, self.in_kern
+        return {
+            "s_hat": (*g, rmax, rmax),
+            "u": (*g, out, rmax),
+            "u_hat": (*g, out, 2 * rmax),
+            "v": (*g, in_kern, rmax),
+            "v_hat": (*g, in_kern, 2 * rmax),
+            "k": (*g, out, rmax),
+            "l": (*g, in_kern, rmax),
+            "n_hat": (*g, 2 * rmax, rmax),
+            "m_hat": (*g, 2 * rmax, rmax),
+        }
+
+    def _min_rmax(self, low_rank: int) -> int:
+        # s_hat is only rmax x rmax but the S step uses 2 * low_rank
+        return 2 * low_rank
+
+    def checkpoint_shapes(self) -> dict:
+        # between two steps the layer is U[..., :r] @ S[..., :r, :r] @ V[..., :r].T (+ bias), K, L,
+        #   and the augmented bases are rebuilt by the pre-/postprocessing of the next step
+        g, lr = self.group_shape, self.low_rank
+        if self.pretrain:
+            shapes = {"fullweight": tuple(self.fullweight.shape)}
+        else:
+            shapes = {
+                "u": (*g, self.out_group, lr),
+                "s_hat": (*g, lr, lr),
+                "v": (*g, self.in_kern, lr),
+            }
+        if self.bias is not None:
+            shapes["bias"] = tuple(self.bias.shape)
+        return shapes
+
+    def optimizer_state_shapes(self) -> dict:
+        # trained blocks at the current rank: K and L, and the augmented S of the S step
+        #   the state of the directions beyond the rank is zero (see zero_beyond_rank)
+        g, lr = self.group_shape, self.low_rank
+        shapes = {
+            "k": (*g, self.out_group, lr),
+            "l": (*g, self.in_kern, lr),
+            "s_hat": (*g, 2 * lr, 2 * lr),
+        }
+        if self.pretrain:
+            shapes["fullweight"] = tuple(self.fullweight.shape)
+        if self.bias is not None:
+            shapes["bias"] = tuple(self.bias.shape)
+        return shapes
+
     @torch.no_grad()
     def reset_parameters(self) -> None:
         # # below is with normal initialization?
         if self.pretrain:
             nn.init.kaiming_uniform_(self.fullweight, a=math.sqrt(5))
 
-        nn.init.kaiming_uniform_(self.u, a=math.sqrt(5))
-        nn.init.kaiming_uniform_(self.s_hat, a=math.sqrt(5))
-        nn.init.kaiming_uniform_(self.v, a=math.sqrt(5))
+        self._init_factor(self.u)
+        self._init_factor(self.s_hat)
+        self._init_factor(self.v)
 
-        nn.init.kaiming_uniform_(self.u_hat, a=math.sqrt(5))
-        nn.init.kaiming_uniform_(self.v_hat, a=math.sqrt(5))
-        nn.init.kaiming_uniform_(self.k, a=math.sqrt(5))
-        nn.init.kaiming_uniform_(self.l, a=math.sqrt(5))
-        nn.init.kaiming_uniform_(self.n_hat, a=math.sqrt(5))
-        nn.init.kaiming_uniform_(self.m_hat, a=math.sqrt(5))
+        self._init_factor(self.u_hat)
+        self._init_factor(self.v_hat)
+        self._init_factor(self.k)
+        self._init_factor(self.l)
+        self._init_factor(self.n_hat)
+        self._init_factor(self.m_hat)
 
         # for testing
         if self.bias is not None:  # and not self.existing_bias:
@@ -695,51 +885,70 @@ class DLRTConv2dAdaptive(_ConvNd):
         phases for the steps 'K','L' and 'S' in order to be optimizable using dlrt.
 
         """
-        # batch_size = input.shape[0]
-        batch_size, shp1, shp2, shp3 = tuple(input.shape)
-        pad0, dil0, kern0 = self.padding[0], self.dilation[0], self.kernel_size[0]
-        pad1, dil1, kern1 = self.padding[1], self.dilation[1], self.kernel_size[1]
-        stride0 = self.stride[0]
-        stride1 = self.stride[1]
-        out_h = int((shp2 + 2 * pad0 - dil0 * (kern0 - 1) - 1) // stride0) + 1
-        out_w = int((shp3 + 2 * pad1 - dil1 * (kern1 - 1) - 1) // stride1) + 1
-        # out_h = int(np.floor(((input.shape[2] + 2 * self.padding[0] - self.dilation[0] * (
-        #                 self.kernel_size[0] - 1) - 1) / self.stride[0]) + 1))
-        # out_w = int(np.floor(((input.shape[3] + 2 * self.padding[1] - self.dilation[1] * (
-        #                   self.kernel_size[1] - 1) - 1) / self.stride[1]) + 1))
-
-        inp_unf = (
-            F.unfold(
-                input,
-                self.kernel_size,
-                padding=self.padding,
-                stride=self.stride,
-            )
-            .to(input.device)
-            .transpose(1, 2)
-        )
+        if self.forward_impl == "unfold":
+            return self._forward_unfold(input)
+        lr = self.forward_rank
+        if self.train_case == "pretrain":
+            weight = self.fullweight.view(self.out_channels, -1, *self.kernel_size)
+            return self._conv(input, weight, self.bias)
+        elif self.train_case == "k" or not self.training:
+            return self._factored_conv(input, self.v[..., :lr], self.k[..., :lr], self.bias)
+        elif self.train_case in ["kl", "kls"]:  # parallel integrator: k-, l- (and s-) step
+            inp_v = self._conv(input, self._kernel(self.v[..., :lr]))
+            ret = self._expand(inp_v, self.k[..., :lr], self.bias)
+            # the l- and s-step values cancel out, they only add the gradients for L and S
+            #   the input is detached -> the input gradient only comes from the k-step
+            u = self.u[..., :lr]
+            extra = self._factored_conv(input.detach(), self.l[..., :lr], u)
+            if self.train_case == "kls":
+                extra = extra + self._expand(inp_v.detach(), u @ self.s_hat[..., :lr, :lr])
+            return ret + (extra - extra.detach())
+        elif self.train_case == "l":
+            return self._factored_conv(input, self.l[..., :lr], self.u[..., :lr], self.bias)
+        elif self.train_case == "s":
+            # W = U_hat @ S @ V_hat.T
+            lr2 = 2 * lr
+            second = self.u_hat[..., :lr2] @ self.s_hat[..., :lr2, :lr2]
+            return self._factored_conv(input, self.v_hat[..., :lr2], second, self.bias)
+        raise ValueError(f"Pretraining? {self.pretrain}...Invalid step value: {self.train_case}")
+
+    def _forward_unfold(self, input: Tensor) -> Tensor:
+        batch_size = input.shape[0]
+        inp_unf, out_h, out_w = self._unfold(input)
         eps = torch.finfo(inp_unf.dtype).eps  # noqa: F841
         if self.train_case == "pretrain":
             out_unf = inp_unf @ self.fullweight.T
         elif self.train_case == "k" or not self.training:
             # TODO: fastest method: (inp_unf @ v) @ k.T
-            k, v = self.k[:, : self.low_rank].T, self.v[:, : self.low_rank]
+            k, v = self.k[:, : self.forward_rank].T, self.v[:, : self.forward_rank]
             # second = v @ k
             # second[(second <= eps) & (second >= -eps)] *= 0
             # out_unf = inp_unf @ second  # @ v @ k
             # Transposed k in line above
             out_unf = (inp_unf @ v) @ k
+        elif self.train_case in ["kl", "kls"]:  # parallel integrator: k-, l- (and s-) step
+            lr = self.forward_rank
+            inp_v = inp_unf @ self.v[:, :lr]
+            out_unf = inp_v @ self.k[:, :lr].T
+            # the l- and s-step values cancel out, they only add the gradients for L and S
+            #   the input is detached -> the input gradient only comes from the k-step
+            ut = self.u[:, :lr].T
+            extra = (inp_unf.detach() @ self.l[:, :lr]) @ ut
+            if self.train_case == "kls":
+                extra = extra + (inp_v.detach() @ self.s_hat[:lr, :lr].T) @ ut
+            out_unf = out_unf + (extra - extra.detach())
         elif self.train_case == "l" and self.training:
-            l, ut = self.l[:, : self.low_rank], self.u[:, : self.low_rank].T
+            l, ut = self.l[:, : self.forward_rank], self.u[:, : self.forward_rank].T
             # second = l @ ut
             # second[(second <= eps) & (second >= -eps)] *= 0
             # out_unf = inp_unf @ second
             out_unf = (inp_unf @ l) @ ut
         elif self.train_case == "s" or not self.training:
             # TODO: is this set to 2*lr to enable the ability to grow lr?
-            u_hat = self.u_hat[:, : 2 * self.low_rank]
-            s_hat = self.s_hat[: 2 * self.low_rank, : 2 * self.low_rank]
-            v_hat = self.v_hat[:, : 2 * self.low_rank]
+            lr2 = 2 * self.forward_rank
+            u_hat = self.u_hat[:, :lr2]
+            s_hat = self.s_hat[:lr2, :lr2]
+            v_hat = self.v_hat[:, :lr2]
             # fastest method uses multi_dot A x (B X (C x D))
             second = torch.linalg.multi_dot([v_hat, s_hat.T, u_hat.T])
             # second[(second <= eps) & (second >= -eps)] *= 0
@@ -754,6 +963,12 @@ class DLRTConv2dAdaptive(_ConvNd):
         out_unf.transpose_(1, 2)
         return out_unf.view(batch_size, self.out_channels, out_h, out_w)
 
+    @torch.no_grad()
+    def inference_factors(self) -> tuple[Tensor, Tensor]:
+        # W = U @ S @ V.T (out x in_kern) -> first = S @ V.T, second = U
+        lr = self.low_rank
+        return self._flat_factors(self.s_hat[..., :lr, :lr] @ self.v[..., :lr].mT, self.u[..., :lr])
+
     def set_dlrt_requires_grad(self, requires):
         self.k.requires_grad = requires
         self.s_hat.requires_grad = requires
@@ -774,38 +989,78 @@ class DLRTConv2dAdaptive(_ConvNd):
         self._change_params_requires_grad(False)
         # k prepro
         # k -> aux_U @ s
-        k = self.u[:, : self.low_rank] @ self.s_hat[: self.low_rank, : self.low_rank]
+        k = self.u[..., : self.low_rank] @ self.s_hat[..., : self.low_rank, : self.low_rank]
         # self.k.zero_()
-        self.k[:, : self.low_rank] = k
+        self.k[..., : self.low_rank] = k
         self.k.requires_grad = True
 
     @torch.no_grad()
     def l_preprocess(self):
         self._change_params_requires_grad(False)
-        L = self.v[:, : self.low_rank] @ self.s_hat[: self.low_rank, : self.low_rank].T
+        L = self.v[..., : self.low_rank] @ self.s_hat[..., : self.low_rank, : self.low_rank].mT
         # self.l.zero_()
-        self.l[:, : self.low_rank] = L
+        self.l[..., : self.low_rank] = L
         self.l.requires_grad = True
 
     @torch.no_grad()
-    def k_postprocess(self):
+    def kl_preprocess(self):
+        self.k_preprocess()
+        self.l_preprocess()
+        self.k.requires_grad = True
+
+    @torch.no_grad()
+    def kls_preprocess(self):
+        self.kl_preprocess()
+        self.s_hat.requires_grad = True
+        self.bias.requires_grad = True
+
+    @torch.no_grad()
+    def postprocess_qr_input(self, case: str):
         lr = self.low_rank
-        lr2 = 2 * self.low_rank
-        u_hat, _ = torch.linalg.qr(torch.hstack((self.k[:, :lr], self.u[:, :lr])))
-        # self.u_hat.zero_()
-        # self.m_hat.zero_()
-        self.u_hat[:, :lr2] = u_hat
-        self.m_hat[:lr2, :lr] = self.u_hat[:, :lr2].T @ self.u[:, :lr]
+        if case == "k":
+            return torch.cat((self.k[..., :lr], self.u[..., :lr]), dim=-1)
+        return torch.cat((self.l[..., :lr], self.v[..., :lr]), dim=-1)
 
     @torch.no_grad()
-    def l_postprocess(self):
+    def postprocess_from_qr(self, case: str, q: Tensor):
+        lr = self.low_rank
+        lr2 = 2 * self.low_rank
+        if case == "k":
+            # self.u_hat.zero_()
+            # self.m_hat.zero_()
+            self.u_hat[..., :lr2] = q
+            self.m_hat[..., :lr2, :lr] = self.u_hat[..., :lr2].mT @ self.u[..., :lr]
+            if self.rank_bucket:
+                self.u_hat[..., lr2:] = 0
+        else:
+            # self.v_hat.zero_()
+            # self.n_hat.zero_()
+            self.v_hat[..., :lr2] = q
+            self.n_hat[..., :lr2, :lr] = self.v_hat[..., :lr2].mT @ self.v[..., :lr]
+            if self.rank_bucket:
+                self.v_hat[..., lr2:] = 0
+
+    def postprocess_tensors(self, case: str) -> list[Tensor]:
         lr = self.low_rank
         lr2 = 2 * self.low_rank
-        v_hat, _ = torch.linalg.qr(torch.hstack((self.l[:, :lr], self.v[:, :lr])))
-        # self.v_hat.zero_()
-        # self.n_hat.zero_()
-        self.v_hat[:, :lr2] = v_hat
-        self.n_hat[:lr2, :lr] = self.v_hat[:, :lr2].T @ self.v[:, :lr]
+        ret = []
+        if case in ("k", "kl", "kls"):
+            ret += [self.u_hat[..., :lr2], self.m_hat[..., :lr2, :lr]]
+        if case in ("l", "kl", "kls"):
+            ret += [self.v_hat[..., :lr2], self.n_hat[..., :lr2, :lr]]
+        if case == "kls":
+            ret.append(self.s_hat[..., :lr2, :lr2])
+        return [t.detach() for t in ret]
+
+    @torch.no_grad()
+    def k_postprocess(self):
+        u_hat = qr(self.postprocess_qr_input("k"), self.linalg_dtype)
+        self.postprocess_from_qr("k", u_hat)
+
+    @torch.no_grad()
+    def l_postprocess(self):
+        v_hat = qr(self.postprocess_qr_input("l"), self.linalg_dtype)
+        self.postprocess_from_qr("l", v_hat)
 
     @torch.no_grad()
     def s_preprocess(self):
@@ -814,15 +1069,10 @@ class DLRTConv2dAdaptive(_ConvNd):
         lr = self.low_rank
         lr2 = 2 * self.low_rank
 
-        s = torch.linalg.multi_dot(
-            [
-                self.m_hat[:lr2, :lr],
-                self.s_hat[:lr, :lr],
-                self.n_hat[: 2 * lr, :lr].T,
-            ],
-        )
+        # multi_dot has no batch dimensions (grouped factors)
+        s = (self.m_hat[..., :lr2, :lr] @ self.s_hat[..., :lr, :lr]) @ self.n_hat[..., : 2 * lr, :lr].mT
         # self.s_hat.zero_()
-        self.s_hat[:lr2, :lr2] = s
+        self.s_hat[..., :lr2, :lr2] = s
 
         # bias is trainable for the s step
         # set s -> (aux_N @ s) @ aux_M.T
@@ -830,42 +1080,73 @@ class DLRTConv2dAdaptive(_ConvNd):
         self.bias.requires_grad = True
 
     @torch.no_grad()
-    def rank_adaption(self, skip=False):
+    def kls_postprocess(self):
+        # parallel integrator: augmented bases from K and L, then the augmented S is assembled
+        #   from the S, K, and L of the same step (no second pass for S):
+        #   S_aug = M @ S @ N.T + U_hat.T @ (I - U @ U.T) @ K @ N.T + M @ L.T @ (I - V @ V.T) @ V_hat
+        self.kl_postprocess()
+        self.parallel_s_assemble()
+
+    @torch.no_grad()
+    def parallel_s_assemble(self):
+        # second half of kls_postprocess, after the augmented bases are set
+        lr = self.low_rank
+        lr2 = 2 * self.low_rank
+        u, v = self.u[..., :lr], self.v[..., :lr]
+        m, n = self.m_hat[..., :lr2, :lr], self.n_hat[..., :lr2, :lr]
+        k_new = self.k[..., :lr] - u @ (u.mT @ self.k[..., :lr])
+        l_new = self.l[..., :lr] - v @ (v.mT @ self.l[..., :lr])
+        s = (m @ self.s_hat[..., :lr, :lr]) @ n.mT
+        s += (self.u_hat[..., :lr2].mT @ k_new) @ n.mT
+        s += m @ (l_new.mT @ self.v_hat[..., :lr2])
+        self.s_hat[..., :lr2, :lr2] = s
+
+    @torch.no_grad()
+    def rank_adaption_svd_input(self):
+        return self.s_hat[..., : 2 * self.low_rank, : 2 * self.low_rank]  # .clone().detach()
+
+    @torch.no_grad()
+    def rank_adaption_prepare(self, skip=False):
         # 1) compute SVD of S
         # d=singular values, u2 = left singuar vecs, v2= right singular vecs
         # TODO: 64 bit?
-        s_small = self.s_hat[: 2 * self.low_rank, : 2 * self.low_rank]  # .clone().detach()
         try:
-            u2, sing, vh2 = torch.linalg.svd(
-                s_small,
-                full_matrices=False,
+            u2, sing, vh2 = svd(
+                self.rank_adaption_svd_input(),
+                self.linalg_dtype,
                 # driver="gesvdj",
             )
         except torch._C._LinAlgError as e:
             print(f"LinAlgError during SVD -> {e}")
-            return
-        v2 = vh2.T.to(self.s_hat.dtype, non_blocking=True)
+            return None
+        return self.rank_adaption_from_svd(u2, sing, vh2, skip=skip)
+
+    @torch.no_grad()
+    def rank_adaption_from_svd(self, u2: Tensor, sing: Tensor, vh2: Tensor, skip=False):
+        v2 = vh2.mT.to(self.s_hat.dtype, non_blocking=True)
         u2 = u2.to(self.s_hat.dtype, non_blocking=True)
+        self._svd = (u2, sing, v2)
 
-        # absolute value treshold (try also relative one)
-        # TODO: different threshold methods
-
-        if not skip:
-            tol = self.eps_adapt * torch.linalg.norm(sing)
-            new_lr = sing.shape[0] // 2
-            for j in range(0, 2 * new_lr - 1):
-                tmp = torch.linalg.norm(sing[j : 2 * new_lr - 1])
-                if tmp < tol:
-                    new_lr = j
-                    break
-        else:
-            new_lr = self.low_rank
+        if skip:
+            return self.low_rank
+        # new rank stays on the device, read back by the network for all layers at once
+        # new lr should only be a minimum of 2! (but it shouldn't really ever get here....)
+        # grouped: all groups share the rank -> the largest rank of the groups
+        return truncation_rank(
+            sing,
+            self.eps_adapt,
+            criterion=self.truncation,
+            min_rank=2,
+            max_rank=self.low_rank,
+            default=self.low_rank,
+        ).amax()
 
-        # new_lr = max(min(new_lr, self.rmax), 2)  # -> handled by the 2 in the for loop above
+    @torch.no_grad()
+    def rank_adaption_apply(self, new_lr: int):
+        u2, sing, v2 = self._svd
+        del self._svd
+        self.last_singular_values = sing
         # update s
-
-        # new lr should only be a minimum of 2! (but it shouldn't really ever get here....)
-        new_lr = max([min([new_lr, self.low_rank]), 2])
         if new_lr > 2 * self.low_rank:
             print("new lr > 2*old lr!!")
             # self.u.set_(self.u_hat.data)
@@ -905,14 +1186,37 @@ class DLRTConv2dAdaptive(_ConvNd):
         #     w0 = loc_fwrep
         # dist.broadcast(w0, src=0)
 
-        self.s_hat[:new_lr, :new_lr] = torch.diag(sing[:new_lr]).to(
+        self.s_hat[..., :new_lr, :new_lr] = torch.diag_embed(sing[..., :new_lr]).to(
             device=self.s_hat.device,
             dtype=self.s_hat.dtype,
         )
-        self.u[:, :new_lr] = self.u_hat[:, : 2 * self.low_rank] @ u2[:, :new_lr]
-        self.v[:, :new_lr] = self.v_hat[:, : 2 * self.low_rank] @ v2[:, :new_lr]
+        self.u[..., :new_lr] = self.u_hat[..., : 2 * self.low_rank] @ u2[..., :new_lr]
+        self.v[..., :new_lr] = self.v_hat[..., : 2 * self.low_rank] @ v2[..., :new_lr]
 
+        self.rank_stable_steps = self.rank_stable_steps + 1 if new_lr == self.low_rank else 0
         self.low_rank = int(new_lr)
+        if self.rank_bucket:
+            self._zero_rank_padding()
+
+    def _max_forward_rank(self) -> int:
+        # the s-step slices s_hat (rmax x rmax) to 2 * rank
+        return self.rmax // 2
+
+    @torch.no_grad()
+    def _zero_rank_padding(self):
+        # the forward slices to forward_rank >= low_rank, the bases are zero beyond the rank
+        #   -> the padded parts of K, L, and S do not change the output and get no gradients
+        lr = self.low_rank
+        self.u[..., lr:] = 0
+        self.v[..., lr:] = 0
+        self.u_hat[..., 2 * lr :] = 0
+        self.v_hat[..., 2 * lr :] = 0
+
+    @torch.no_grad()
+    def rank_adaption(self, skip=False):
+        new_lr = self.rank_adaption_prepare(skip=skip)
+        if new_lr is not None:
+            self.rank_adaption_apply(int(new_lr))
 
     @torch.no_grad()
     def all_reduce(self, method: str = "average"):
@@ -920,44 +1224,13 @@ class DLRTConv2dAdaptive(_ConvNd):
             # early out if not working distributed
             return
         #   (full weight and bias are changed 'as expected' for a nn
-        # this has no effect if in pretraining
-
-        # TODO: groups?
-        sz = float(dist.get_world_size())
         if method == "average":
-            # if dist.get_rank() == 0:
-            # console.rule("u")
-            # s = ""
-            # for d in torch.diag(self.u)[:10].tolist():
-            #     s += f" {d:.3f}"
-            # console.print(s)
-            # print(self.u)
-            # raise ValueError
-
-            self.u.true_divide_(sz)
-            self.s_hat.true_divide_(sz)
-            self.v.true_divide_(sz)
-            self.u_hat.true_divide_(sz)
-            self.v_hat.true_divide_(sz)
-            self.k.true_divide_(sz)
-            self.l.true_divide_(sz)
-            self.n_hat.true_divide_(sz)
-            self.m_hat.true_divide_(sz)
-            dist.all_reduce(self.u, op=dist.ReduceOp.SUM, async_op=True)
-            dist.all_reduce(self.s_hat, op=dist.ReduceOp.SUM, async_op=True)
-            dist.all_reduce(self.v, op=dist.ReduceOp.SUM, async_op=True)
-            dist.all_reduce(self.u_hat, op=dist.ReduceOp.SUM, async_op=True)
-            dist.all_reduce(self.v_hat, op=dist.ReduceOp.SUM, async_op=True)
-            dist.all_reduce(self.k, op=dist.ReduceOp.SUM, async_op=True)
-            dist.all_reduce(self.l, op=dist.ReduceOp.SUM, async_op=True)
-            dist.all_reduce(self.n_hat, op=dist.ReduceOp.SUM, async_op=True)
-            dist.all_reduce(self.m_hat, op=dist.ReduceOp.SUM, async_op=True)
-            # if dist.get_rank() == 0:
-            #     console.print(torch.diag(self.s_hat)[:10].tolist())
+            # rank slices of U, S, V (and the bias) in one bucket, waited before returning
+            super().all_reduce(method)
         elif method == "projection":
             # TODO: transpose V?
             # 1. get full weight representation
-            fwr = self.u @ self.s_hat @ self.v.T  # full weight representation
+            fwr = self.u @ self.s_hat @ self.v.mT  # full weight representation
             # 2. pad weight representation into
             mxsz = max(tuple(fwr.shape))
             loc_fwrep = torch.eye(mxsz).to(device=fwr.device)
@@ -977,8 +1250,9 @@ class DLRTConv2dAdaptive(_ConvNd):
         # factory = {"dtype": weight.dtype, "device": weight.device}
         # self.to(**factory)
         # fullweight: out x in_kern -> .T : in_kern x out
-        u, sing, vh = torch.linalg.svd(
-            self.fullweight.T,
+        u, sing, vh = svd(
+            self.fullweight.view(*self.group_shape, self.out_group, self.in_kern).mT,
+            self.linalg_dtype,
             full_matrices=True,  # FIXME?
             # driver="gesvdj",
         )
@@ -990,21 +1264,21 @@ class DLRTConv2dAdaptive(_ConvNd):
         # sing = sing.to(**factory, non_blocking=True)
         # v = vh.T
 
-        new_lr = min(sing.shape[0], self.s_hat.shape[0])
+        new_lr = min(sing.shape[-1], self.s_hat.shape[-1])
 
         # new
-        nn.init.eye_(self.s_hat)
-        self.s_hat[:new_lr, :new_lr] = torch.diag(sing[:new_lr]).to(
+        self.s_hat.copy_(torch.eye(self.rmax, dtype=self.s_hat.dtype, device=self.s_hat.device))
+        self.s_hat[..., :new_lr, :new_lr] = torch.diag_embed(sing[..., :new_lr]).to(
             device=self.s_hat.device,
             dtype=self.s_hat.dtype,
         )
 
         # u: output x rank
         # v: in_kern x rank
-        self.u[:, :new_lr] = vh[:, :new_lr]
-        self.u_hat[:, :new_lr] = vh[:, :new_lr]
-        self.v[:, :new_lr] = u[:, :new_lr]
-        self.v_hat[:, :new_lr] = u[:, :new_lr]
+        self.u[..., :new_lr] = vh[..., :new_lr]
+        self.u_hat[..., :new_lr] = vh[..., :new_lr]
+        self.v[..., :new_lr] = u[..., :new_lr]
+        self.v_hat[..., :new_lr] = u[..., :new_lr]
 
         # self.u[:, :new_lr] = self.u_hat[:, : 2 * self.low_rank] @ u[:, :new_lr]
         # self.v[:, :new_lr] = self.v_hat[:, : 2 * self.low_rank] @ vh[:, :new_lr]
@@ -1015,3 +1289,36 @@ class DLRTConv2dAdaptive(_ConvNd):
 
         del self.fullweight
         # self.low_rank = int(new_lr)
+        if self.rank_bucket:
+            self._zero_rank_padding()
+
+
+class DLRTConv1dFixed(_FixedConvNd):
+    _ndim = 1
+
+
+class DLRTConv2dFixed(_FixedConvNd):
+    _ndim = 2
+
+
+class DLRTConv3dFixed(_FixedConvNd):
+    _ndim = 3
+
+
+class DLRTConv1dAdaptive(_AdaptiveConvNd):
+    _ndim = 1
+
+
+class DLRTConv2dAdaptive(_AdaptiveConvNd):
+    _ndim = 2
+
+
+class DLRTConv3dAdaptive(_AdaptiveConvNd):
+    _ndim = 3
+
+
+_CONV_CLASSES = {
+    1: (DLRTConv1dAdaptive, DLRTConv1dFixed),
+    2: (DLRTConv2dAdaptive, DLRTConv2dFixed),
+    3: (DLRTConv3dAdaptive, DLRTConv3dFixed),
+}
@@ -0,0 +1,266 @@
+from __future__ import annotations
+
+import torch
+import torch.nn as nn
+from rich.console import Console
+from rich.table import Table
+
+from .conv import _FixedConvNd
+from .linear import DLRTLinearFixed
+
+console = Console(width=140)
+
+__all__ = ["cost_report", "layer_cost"]
+
+CASES = ("k", "l", "s", "kl", "kls")
+
+
+def _dims(layer) -> dict | None:
+    # per group: n x m weight (in x out), n_flops: input size which costs FLOPs (lookups are free)
+    if not hasattr(layer, "inference_factors") or not hasattr(layer, "low_rank"):
+        return None
+    if hasattr(layer, "num_embeddings"):
+        dims = {"groups": 1, "n": layer.num_embeddings, "m": layer.embedding_dim, "n_flops": 0}
+    elif hasattr(layer, "kernel_size"):
+        dims = {"groups": layer.groups, "n": layer.in_kern, "m": layer.out_group}
+        dims["n_flops"] = layer.in_kern
+    elif hasattr(layer, "in_features"):
+        dims = {"groups": 1, "n": layer.in_features, "m": layer.out_features, "n_flops": layer.in_features}
+    else:
+        return None
+    # the S step of the adaptive layers trains the augmented 2r x 2r S
+    dims["fixed"] = isinstance(layer, (DLRTLinearFixed, _FixedConvNd))
+    return dims
+
+
+def _flops(n: int, m: int, r: int, s: int, case: str) -> tuple[int, int]:
+    # forward and backward FLOPs (2 * multiply-adds) per position of one group
+    #   chain: products which the output and the input gradient go through, extra: products of
+    #   the parallel cases which only add gradients, trained: sizes of the factors with a gradient
+    #   (the weight gradient of a factor costs one product of its size per position)
+    if case == "k":
+        chain, extra, trained = [n * r, r * m], [], [n * r]
+    elif case == "l":
+        chain, extra, trained = [n * r, r * m], [], [r * m]
+    elif case == "s":
+        chain, extra, trained = [n * s, s * s, s * m], [], [s * s]
+    elif case == "kl":
+        chain, extra, trained = [n * r, r * m], [n * r, r * m], [n * r, r * m]
+    elif case == "kls":
+        chain, extra, trained = [n * r, r * m], [n * r, r * m, r * r, r * m], [n * r, r * m, r * r]
+    elif case == "inference":
+        chain, extra, trained = [n * r, r * m], [], []
+    else:  # dense
+        chain, extra, trained = [n * m], [], [n * m]
+    return 2 * (sum(chain) + sum(extra)), 2 * (sum(chain) + sum(trained))
+
+
+def _ratio(a, b):
+    return a / b if b else None
+
+
+def layer_cost(layer, positions: int = 1) -> dict | None:
+    """
+    Cost of a DLRT linear/conv/embedding layer at its current rank vs. the dense layer it replaces.
+
+    params: stored (all parameters and buffers, i.e. up to rmax), active (U, S, Vt at the current
+    rank and the bias), and dense. bytes: reserved (stored), used (active), and dense.
+    flops: forward and backward FLOPs (2 * multiply-adds) of every training case (at the forward
+    rank, see rank_bucket) and of the dense layer, and the forward FLOPs of inference (factored) for
+    `positions` positions (linear: rows of the input, conv: output pixels, embedding: lookups,
+    which cost no FLOPs themselves). None if the layer is not a linear/conv/embedding layer.
+    """
+    dims = _dims(layer)
+    if dims is None:
+        return None
+    g, n, m, n_flops = dims["groups"], dims["n"], dims["m"], dims["n_flops"]
+    r = layer.low_rank
+    fr = getattr(layer, "forward_rank", r)
+    s = fr if dims["fixed"] else 2 * fr
+    pretrain = getattr(layer, "pretrain", False)
+    bias = layer.bias.numel() if getattr(layer, "bias", None) is not None else 0
+
+    tensors = [*layer.parameters(recurse=False), *layer.buffers(recurse=False)]
+    itemsize = tensors[0].element_size() if tensors else 4
+    dense_params = g * n * m + bias
+    active = dense_params if pretrain else g * (r * n + r * r + r * m) + bias
+    stored = sum(t.numel() for t in tensors)
+
+    dense_fwd, dense_bwd = (g * positions * f for f in _flops(n_flops, m, r, s, "dense"))
+    flops = {"dense": {"forward": dense_fwd, "backward": dense_bwd}}
+    for case in CASES:
+        fwd, bwd = (g * positions * f for f in _flops(n_flops, m, fr, s, case))
+        flops[case] = {"forward": fwd, "backward": bwd}
+    # layers which are still pretraining are exported dense
+    inference = g * positions * _flops(n_flops, m, fr, s, "inference")[0]
+    flops["inference"] = {"forward": dense_fwd if pretrain else inference}
+    return {
+        "type": type(layer).__name__,
+        "rank": r,
+        "forward_rank": fr,
+        "rmax": getattr(layer, "rmax", r),
+        "pretrain": pretrain,
+        "shape": {"groups": g, "in": n, "out": m},
+        "positions": positions,
+        "params": {"stored": stored, "active": active, "dense": dense_params},
+        "bytes": {
+            "reserved": sum(t.nbytes for t in tensors),
+            "used": active * itemsize,
+            "dense": dense_params * itemsize,
+        },
+        "flops": flops,
+        "vs_dense": {
+            "stored": _ratio(stored, dense_params),
+            "active": _ratio(active, dense_params),
+            "inference_flops": _ratio(flops["inference"]["forward"], dense_fwd),
+            **{
+                f"{case}_step_flops": _ratio(sum(flops[case].values()), dense_fwd + dense_bwd)
+                for case in CASES
+            },
+        },
+    }
+
+
+@torch.no_grad()
+def _positions(model: nn.Module, example_input) -> dict:
+    # number of positions (rows / output pixels / lookups) of every layer for example_input
+    #   (eval forward, nothing is changed in the model)
+    positions, hooks = {}, []
+
+    def hook(module, inp, out):
+        if hasattr(module, "num_embeddings"):
+            positions[module] = inp[0].numel()
+        elif isinstance(module, nn.modules.conv._ConvNd) or hasattr(module, "kernel_size"):
+            positions[module] = out.numel() // out.shape[1]
+        else:
+            positions[module] = out.numel() // out.shape[-1]
+
+    for module in model.modules():
+        if hasattr(module, "dlrt") or isinstance(module, (nn.Linear, nn.modules.conv._ConvNd, nn.Embedding)):
+            hooks.append(module.register_forward_hook(hook))
+    modes = {module: module.training for module in model.modules()}
+    model.eval()
+    try:
+        model(example_input)
+    finally:
+        for handle in hooks:
+            handle.remove()
+        for module, mode in modes.items():
+            module.training = mode
+    return positions
+
+
+def _dense_layer_cost(module, positions: int) -> tuple[int, int]:
+    # forward and backward FLOPs of a plain Linear/ConvNd layer
+    if isinstance(module, nn.Linear):
+        n, m = module.in_features, module.out_features
+    elif isinstance(module, nn.modules.conv._ConvNd):
+        n, m = module.weight[0].numel(), module.out_channels
+    else:
+        return 0, 0
+    return tuple(positions * f for f in _flops(n, m, 0, 0, "dense"))
+
+
+def cost_report(network, example_input=None, print_report: bool = False) -> dict:
+    """
+    Parameters, memory, and FLOPs of the DLRT layers of `network` at their current ranks vs. the
+    dense layers they replace (see `layer_cost`), per layer and for the whole network.
+
+    Without `example_input`, the FLOPs are per position (row / output pixel / lookup) of each layer
+    and there is no network total for them. With `example_input`, the positions of every layer are
+    taken from an eval forward of it and the network total includes the plain Linear/ConvNd layers
+    (same FLOPs in the DLRT and the dense model).
+
+    Parameters
+    ----------
+    network: DLRTNetwork
+    """
+    model = network.dlrt_model
+    positions = _positions(model, example_input) if example_input is not None else None
+    names = {module: name for name, module in model.named_modules()}
+    layers = {}
+    for module in network._dlrt_layers():
+        cost = layer_cost(module, positions.get(module, 0) if positions is not None else 1)
+        if cost is not None:
+            layers[names[module]] = cost
+
+    covered = {id(t) for module in network._dlrt_layers() for t in module.parameters()}
+    covered |= {id(t) for module in network._dlrt_layers() for t in module.buffers()}
+    other = [t for t in (*model.parameters(), *model.buffers()) if id(t) not in covered]
+    other_params = sum(t.numel() for t in other)
+    other_bytes = sum(t.nbytes for t in other)
+
+    def total(key, sub):
+        return sum(c[key][sub] for c in layers.values())
+
+    net = {
+        "params": {
+            "stored": total("params", "stored") + other_params,
+            "active": total("params", "active") + other_params,
+            "dense": total("params", "dense") + other_params,
+        },
+        "bytes": {
+            "reserved": total("bytes", "reserved") + other_bytes,
+            "used": total("bytes", "used") + other_bytes,
+            "dense": total("bytes", "dense") + other_bytes,
+        },
+        "flops": None,
+    }
+    if positions is not None:
+        plain = [
+            _dense_layer_cost(module, count)
+            for module, count in positions.items()
+            if not hasattr(module, "dlrt") and not any(hasattr(p, "dlrt") for p in module.modules())
+        ]
+        plain_fwd, plain_bwd = sum(f for f, _ in plain), sum(b for _, b in plain)
+        net["flops"] = {
+            case: {
+                "forward": sum(c["flops"][case]["forward"] for c in layers.values()) + plain_fwd,
+                "backward": sum(c["flops"][case]["backward"] for c in layers.values()) + plain_bwd,
+            }
+            for case in ("dense", *CASES)
+        }
+        net["flops"]["inference"] = {
+            "forward": sum(c["flops"]["inference"]["forward"] for c in layers.values()) + plain_fwd
+        }
+    net["vs_dense"] = {
+        "stored": _ratio(net["params"]["stored"], net["params"]["dense"]),
+        "active": _ratio(net["params"]["active"], net["params"]["dense"]),
+        "inference_flops": (
+            _ratio(net["flops"]["inference"]["forward"], net["flops"]["dense"]["forward"])
+            if net["flops"] is not None
+            else None
+        ),
+    }
+    report = {"layers": layers, "network": net, "per_position": positions is None}
+    if print_report:
+        _print(report)
+    return report
+
+
+def _fmt(value, spec=",") -> str:
+    return "-" if value is None else format(value, spec)
+
+
+def _print(report: dict):
+    unit = " / position" if report["per_position"] else ""
+    table = Table(title="DLRT cost at the current ranks")
+    for col in ("layer", "rank", "stored", "active", "dense", "active / dense"):
+        table.add_column(col)
+    for col in (f"inference FLOPs{unit}", f"dense FLOPs{unit}", "inference / dense"):
+        table.add_column(col)
+    rows = list(report["layers"].items()) + [("network", report["network"])]
+    for name, cost in rows:
+        flops = cost["flops"]
+        table.add_row(
+            name,
+            str(cost.get("rank", "")),
+            _fmt(cost["params"]["stored"]),
+            _fmt(cost["params"]["active"]),
+            _fmt(cost["params"]["dense"]),
+            _fmt(cost["vs_dense"]["active"], ".3f"),
+            "-" if flops is None else _fmt(flops["inference"]["forward"]),
+            "-" if flops is None else _fmt(flops["dense"]["forward"]),
+            _fmt(cost["vs_dense"]["inference_flops"], ".3f"),
+        )
+    console.print(table)
@@ -0,0 +1,277 @@
+from __future__ import annotations
+
+import math
+
+import torch
+import torch.distributed as dist
+from torch import Tensor
+
+__all__ = ["BucketedAllReduce", "OwnerBroadcast", "PhaseGradReducer", "assign_owners"]
+
+
+class BucketedAllReduce:
+    """
+    All-reduce many (small) tensors in a few flat buckets.
+
+    `add` copies the tensors into a flat bucket per device and dtype, every bucket which reaches
+    `bucket_bytes` is all-reduced asynchronously right away (overlapping with the work done before
+    the next `add`). `wait` launches the remaining buckets, waits for all of them, and copies the
+    results back into the tensors. The tensors must not be changed between `add` and `wait`, and
+    all processes have to add tensors of the same shapes in the same order.
+
+    Parameters
+    ----------
+    bucket_bytes: int
+        size at which a bucket is launched
+    average: bool
+        average the tensors over the processes (otherwise: sum)
+    group
+        process group, default: the world
+    """
+
+    def __init__(self, bucket_bytes: int = 25 * 2**20, average: bool = True, group=None):
+        self.bucket_bytes = bucket_bytes
+        self.average = average
+        self.group = group
+        self.world_size = dist.get_world_size(group) if dist.is_initialized() else 1
+        # open buckets: (device, dtype) -> [tensors, bytes], launched buckets: (flat, tensors, work)
+        self._open = {}
+        self._launched = []
+        # number of collectives and bytes all-reduced
+        self.num_collectives = 0
+        self.num_bytes = 0
+
+    def add(self, tensors: list[Tensor]):
+        if self.world_size == 1:
+            return
+        for t in tensors:
+            if t.numel() == 0:
+                continue
+            key = (t.device, t.dtype)
+            bucket = self._open.setdefault(key, [[], 0])
+            bucket[0].append(t)
+            bucket[1] += t.numel() * t.element_size()
+            if bucket[1] >= self.bucket_bytes:
+                self._launch(self._open.pop(key)[0])
+
+    def _launch(self, tensors: list[Tensor]):
+        flat = torch.cat([t.reshape(-1) for t in tensors])
+        work = dist.all_reduce(flat, op=dist.ReduceOp.SUM, group=self.group, async_op=True)
+        self._launched.append((flat, tensors, work))
+        self.num_collectives += 1
+        self.num_bytes += flat.nbytes
+
+    @torch.no_grad()
+    def wait(self):
+        # the open buckets are launched in the same order on all processes (order of the keys)
+        for key in list(self._open):
+            self._launch(self._open.pop(key)[0])
+        for flat, tensors, work in self._launched:
+            work.wait()
+            if self.average:
+                flat.div_(self.world_size)
+            offset = 0
+            for t in tensors:
+                t.copy_(flat[offset : offset + t.numel()].view_as(t))
+                offset += t.numel()
+        self._launched = []
+
+
+def assign_owners(costs: list[float], world_size: int) -> list[int]:
+    """
+    Deterministic load balancing: the items are assigned in order of decreasing cost (ties: in
+    order) to the process with the smallest total so far. The same costs give the same owners on
+    all processes, no communication is needed.
+    """
+    owners = [0] * len(costs)
+    loads = [0.0] * world_size
+    for i in sorted(range(len(costs)), key=lambda i: -costs[i]):
+        owner = min(range(world_size), key=lambda r: loads[r])
+        owners[i] = owner
+        loads[owner] += costs[i]
+    return owners
+
+
+class OwnerBroadcast:
+    """
+    Broadcast tensors from the process which computed them (their owner) to all other processes.
+
+    `add` collects the tensors of an owner, `wait` broadcasts one flat buffer per owner, device, and
+    dtype (asynchronously, then waits for all of them) and copies the results back into the tensors
+    on the other processes. All processes have to add tensors of the same shapes and owners in the
+    same order, only the values on the owner matter.
+
+    Parameters
+    ----------
+    group
+        process group, default: the world
+    """
+
+    def __init__(self, group=None):
+        self.group = group
+        self.rank = dist.get_rank(group)
+        # (owner, device, dtype) -> tensors
+        self._buckets = {}
+        # number of collectives and bytes broadcast
+        self.num_collectives = 0
+        self.num_bytes = 0
+
+    def add(self, owner: int, tensors: list[Tensor]):
+        for t in tensors:
+            if t.numel() == 0:
+                continue
+            self._buckets.setdefault((owner, t.device, t.dtype), []).append(t)
+
+    @torch.no_grad()
+    def wait(self):
+        launched = []
+        for (owner, device, dtype), tensors in self._buckets.items():
+            if owner == self.rank:
+                flat = torch.cat([t.reshape(-1) for t in tensors])
+            else:
+                flat = torch.empty(sum(t.numel() for t in tensors), device=device, dtype=dtype)
+            src = owner if self.group is None else dist.get_global_rank(self.group, owner)
+            work = dist.broadcast(flat, src=src, group=self.group, async_op=True)
+            launched.append((owner, flat, tensors, work))
+            self.num_collectives += 1
+            self.num_bytes += flat.nbytes
+        for owner, flat, tensors, work in launched:
+            work.wait()
+            if owner == self.rank:
+                continue
+            offset = 0
+            for t in tensors:
+                t.copy_(flat[offset : offset + t.numel()].view_as(t))
+                offset += t.numel()
+        self._buckets = {}
+
+
+def _block(t: Tensor, shape) -> Tensor:
+    return t[tuple(slice(0, sz) for sz in shape)]
+
+
+class PhaseGradReducer:
+    """
+    Data-parallel gradient averaging for the K/L/S phases of a DLRTNetwork (replaces DDP).
+
+    `prepare(case)` makes a static bucket plan for the phase: the parameters which require a
+    gradient in this phase (reverse order ~ order of the backward) and the active block of their
+    gradient (`optimizer_state_shapes` of the DLRT layers, e.g. K[:, :r], Lt[:r], S[:2r, :2r], the
+    other parameters whole). During the backward, a hook on every parameter counts the finished
+    gradients, the buckets are all-reduced asynchronously in plan order as soon as they are
+    complete. `finish` launches the rest (parameters without a gradient contribute zeros, no graph
+    traversal as with find_unused_parameters), waits, and writes the averages back before the
+    optimizer step.
+
+    Sparse gradients (DLRTEmbedding with sparse=True) are reduced as dense blocks and replaced by
+    dense gradients.
+
+    Parameters
+    ----------
+    network: DLRTNetwork
+    bucket_mb: float
+        size of the buckets in MB
+    group
+        process group, default: the world
+    """
+
+    def __init__(self, network, bucket_mb: float = 25.0, group=None):
+        self.network = network
+        self.bucket_bytes = int(bucket_mb * 2**20)
+        self.group = group
+        self.world_size = dist.get_world_size(group)
+        # hooks are registered when a parameter first requires a gradient (parameter -> handle)
+        self._handles = {}
+        self._plan = None
+        # totals over all phases
+        self.num_collectives = 0
+        self.num_bytes = 0
+        self.refresh()
+
+    def refresh(self):
+        # drop the hooks of replaced parameters (e.g. after compact_factors)
+        self.remove()
+
+    @torch.no_grad()
+    def broadcast_parameters(self, src: int = 0):
+        # same starting point on all processes (what DDP does when it is created)
+        for t in [*self.network.dlrt_model.parameters(), *self.network.dlrt_model.buffers()]:
+            dist.broadcast(t.data, src=src, group=self.group)
+
+    def prepare(self, case: str):
+        layers = {name: m for name, m in self.network.dlrt_model.named_modules() if hasattr(m, "dlrt")}
+        shapes = {name: m.optimizer_state_shapes() for name, m in layers.items()}
+        buckets, size = [[]], 0
+        for name, p in reversed(list(self.network.dlrt_model.named_parameters())):
+            if not p.requires_grad:
+                continue
+            owner, _, attr = name.rpartition(".")
+            shape = shapes[owner].get(attr, p.shape) if owner in shapes else p.shape
+            nbytes = math.prod(shape) * p.element_size()
+            if size and size + nbytes > self.bucket_bytes:
+                buckets.append([])
+                size = 0
+            buckets[-1].append((p, tuple(shape)))
+            size += nbytes
+            if p not in self._handles:
+                self._handles[p] = p.register_post_accumulate_grad_hook(self._on_grad)
+        self._plan = {
+            "case": case,
+            "buckets": [b for b in buckets if b],
+            "where": {p: i for i, b in enumerate(buckets) for p, _ in b},
+        }
+        self._plan["ready"] = [0] * len(self._plan["buckets"])
+        self._plan["launched"] = []
+
+    def _on_grad(self, p):
+        plan = self._plan
+        if plan is None or p not in plan["where"]:
+            return
+        i = plan["where"][p]
+        plan["ready"][i] += 1
+        # launch in plan order -> the same sequence of collectives on all processes
+        while len(plan["launched"]) < len(plan["buckets"]):
+            j = len(plan["launched"])
+            if plan["ready"][j] < len(plan["buckets"][j]):
+                break
+            self._launch(j)
+
+    @torch.no_grad()
+    def _launch(self, i: int):
+        parts = []
+        for p, shape in self._plan["buckets"][i]:
+            if p.grad is None:
+                parts.append(torch.zeros(math.prod(shape), device=p.device, dtype=p.dtype))
+            elif p.grad.is_sparse:
+                parts.append(_block(p.grad.to_dense(), shape).reshape(-1))
+            else:
+                parts.append(_block(p.grad, shape).reshape(-1))
+        flat = torch.cat(parts)
+        work = dist.all_reduce(flat, op=dist.ReduceOp.SUM, group=self.group, async_op=True)
+        self._plan["launched"].append((flat, work))
+        self.num_collectives += 1
+        self.num_bytes += flat.nbytes
+
+    @torch.no_grad()
+    def finish(self):
+        plan = self._plan
+        if plan is None:
+            return
+        for i in range(len(plan["launched"]), len(plan["buckets"])):
+            self._launch(i)
+        for (flat, work), bucket in zip(plan["launched"], plan["buckets"]):
+            work.wait()
+            flat.div_(self.world_size)
+            offset = 0
+            for p, shape in bucket:
+                if p.grad is None or p.grad.is_sparse:
+                    p.grad = torch.zeros_like(p) if p.grad is None else p.grad.to_dense()
+                n = math.prod(shape)
+                _block(p.grad, shape).copy_(flat[offset : offset + n].view(shape))
+                offset += n
+        self._plan = None
+
+    def remove(self):
+        for handle in self._handles.values():
+            handle.remove()
+        self._handles = {}
@@ -0,0 +1,227 @@
+from __future__ import annotations
+
+import math
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch import Tensor
+
+from .basic import DLRTModule
+from .basic import TRUNCATION_CRITERIA
+from .basic import svd
+from .linear import DLRTLinearAdaptive
+
+__all__ = ["DLRTEmbedding"]
+
+
+class DLRTEmbedding(DLRTLinearAdaptive):
+    """
+    Rank-adaptive embedding, the num_embeddings x embedding_dim table is stored as U @ S @ Vt.
+
+    A lookup is a linear layer on one-hot inputs: the rows of the vocabulary-side factor (K, U, or
+    the augmented U) are gathered and projected with the small factors, the full table is never
+    built. The K/L/S steps, the postprocessing, and the rank adaption are the ones of
+    `DLRTLinearAdaptive` with in_features = num_embeddings and out_features = embedding_dim.
+    """
+
+    __constants__ = ["num_embeddings", "embedding_dim", "padding_idx", "scale_grad_by_freq", "sparse"]
+    num_embeddings: int
+    embedding_dim: int
+
+    def __init__(
+        self,
+        num_embeddings: int,
+        embedding_dim: int,
+        padding_idx: int = None,
+        scale_grad_by_freq: bool = False,
+        sparse: bool = False,
+        low_rank_percent: float = None,
+        eps_adapt: float = 0.1,
+        device=None,
+        dtype=None,
+        pretrain: bool = False,
+        truncation: str = "relative",
+    ) -> None:
+        """
+        Parameters
+        ----------
+        num_embeddings
+        embedding_dim
+        padding_idx
+            the row of this index is zero and gets no gradient (as in nn.Embedding)
+        scale_grad_by_freq
+            scale the gradients of the gathered rows by the inverse of their frequency in the batch
+        sparse
+            the gradient of K (the only trained factor with a row per embedding) is a sparse
+            tensor of the gathered rows. needs an optimizer with sparse support (e.g. SGD, Adagrad)
+        low_rank_percent
+            starting rank as a fraction of the largest rank min(embedding_dim // 8,
+            num_embeddings // 2), the rank can grow to twice that (at most the largest rank).
+            default: starting rank embedding_dim // 16, max rank embedding_dim // 8 (the
+            vocabulary-side factors K, U, and the augmented U hold 4 * rmax values per row -> at
+            most half of the dense table, for embedding_dim >= 32)
+        eps_adapt
+            epsilon to use in adaptive methods.
+        device
+        dtype
+        pretrain
+            train the dense table first, see `stop_pretraining`
+        truncation
+            criterion for the rank adaption, one of "absolute", "relative", or "energy".
+            see `basic.truncation_rank`
+        """
+        DLRTModule.__init__(self)
+        if truncation not in TRUNCATION_CRITERIA:
+            raise ValueError(f"truncation must be one of {TRUNCATION_CRITERIA}, not: {truncation}")
+        if padding_idx is not None:
+            if not -num_embeddings <= padding_idx < num_embeddings:
+                raise ValueError(f"padding_idx must be within num_embeddings, currently: {padding_idx}")
+            padding_idx = padding_idx % num_embeddings
+        self.truncation = truncation
+        factory_kwargs = {"device": device, "dtype": dtype}
+        self.num_embeddings = num_embeddings
+        self.embedding_dim = embedding_dim
+        self.padding_idx = padding_idx
+        self.scale_grad_by_freq = scale_grad_by_freq
+        self.sparse = sparse
+        # the table is the in x out weight of a linear layer on one-hot inputs
+        #   -> the factor shapes, the postprocessing, and the rank adaption are the linear ones
+        self.in_features = num_embeddings
+        self.out_features = embedding_dim
+        self.forward_mode = "factored"
+        self.register_parameter("bias", None)
+
+        # K, U, and the augmented U have 4 * rmax values per row of the vocabulary, the table has
+        #   embedding_dim -> rmax <= embedding_dim // 8 keeps them at half of the table or less.
+        #   the augmented U has 2 * rmax columns -> rmax is at most half the vocabulary
+        largest = max(min(embedding_dim // 8, num_embeddings // 2), 4)
+        if low_rank_percent is None:
+            self.rmax = largest
+        else:
+            self.rmax = min(max(2 * int(largest * low_rank_percent), 4), largest)
+        self.low_rank = self.rmax // 2
+
+        self.basic_number_weights = num_embeddings * embedding_dim
+        self.eps_adapt = eps_adapt
+        self.dlrt = True
+
+        self.pretrain = pretrain
+        if pretrain:
+            self.fullweight = nn.Parameter(torch.empty(num_embeddings, embedding_dim, **factory_kwargs))
+
+        for name, shape in self._factor_shapes(self.rmax).items():
+            trained = name in ("k", "s", "lt")
+            setattr(self, name, nn.Parameter(torch.zeros(shape, **factory_kwargs), requires_grad=trained))
+
+        self.reset_parameters()
+        self.train_case = "k"
+
+    def extra_repr(self) -> str:
+        s = f"{self.num_embeddings}, {self.embedding_dim}, low_rank={self.low_rank}"
+        if self.padding_idx is not None:
+            s += f", padding_idx={self.padding_idx}"
+        if self.scale_grad_by_freq:
+            s += ", scale_grad_by_freq=True"
+        if self.sparse:
+            s += ", sparse=True"
+        return s
+
+    @torch.no_grad()
+    def reset_parameters(self) -> None:
+        # orthonormal U, Vt and S = c * I with c**2 = num_embeddings * embedding_dim / rank
+        #   -> the entries of the table have unit variance, like the N(0, 1) init of nn.Embedding
+        lr = self.low_rank
+        nn.init.orthogonal_(self.u)
+        nn.init.orthogonal_(self.vt)
+        self.s.zero_()
+        self.s[:lr, :lr] = math.sqrt(self.num_embeddings * self.embedding_dim / lr) * torch.eye(
+            lr, device=self.s.device, dtype=self.s.dtype
+        )
+        for name in ("k", "lt", "unp1", "vtnp1", "n", "m"):
+            getattr(self, name).zero_()
+        if self.pretrain:
+            nn.init.normal_(self.fullweight)
+        self._zero_padding_row()
+
+    @torch.no_grad()
+    def _zero_padding_row(self):
+        # the padding row of the bases is zero -> the row is zero in K, L, S, and the table
+        if self.padding_idx is None:
+            return
+        self.u[self.padding_idx] = 0
+        self.unp1[self.padding_idx] = 0
+        if self.pretrain:
+            self.fullweight[self.padding_idx] = 0
+
+    def _change_params_requires_grad(self, requires_grad):
+        self.k.requires_grad = requires_grad
+        self.s.requires_grad = requires_grad
+        self.lt.requires_grad = requires_grad
+
+    def _lookup(self, input: Tensor, factor: Tensor) -> Tensor:
+        # whole rows are gathered (slicing the factor first would make the gradient a dense view)
+        #   -> with sparse=True the gradient of the parameter itself is sparse
+        return F.embedding(
+            input,
+            factor,
+            padding_idx=self.padding_idx,
+            scale_grad_by_freq=self.scale_grad_by_freq,
+            sparse=self.sparse,
+        )
+
+    def forward(self, input: Tensor) -> Tensor:
+        if self.train_case == "pretrain":
+            return self._lookup(input, self.fullweight)
+        lr = self.forward_rank
+        if self.train_case == "k":  # k-step
+            return self._lookup(input, self.k)[..., :lr] @ self.vt[:lr]
+        if self.train_case == "l":  # l-step
+            return self._lookup(input, self.u)[..., :lr] @ self.lt[:lr]
+        if self.train_case in ["kl", "kls"]:  # parallel integrator: k-, l- (and s-) step
+            ret = self._lookup(input, self.k)[..., :lr] @ self.vt[:lr]
+            # the l- and s-step values cancel out, they only add the gradients for L and S
+            xu = self._lookup(input, self.u)[..., :lr]
+            extra = xu @ self.lt[:lr]
+            if self.train_case == "kls":
+                extra = extra + (xu @ self.s[:lr, :lr]) @ self.vt[:lr]
+            return ret + (extra - extra.detach())
+        # s-step
+        lr2 = 2 * lr
+        return (self._lookup(input, self.unp1)[..., :lr2] @ self.s[:lr2, :lr2]) @ self.vtnp1[:lr2]
+
+    @torch.no_grad()
+    def s_preprocess(self):
+        self._change_params_requires_grad(False)
+        lr = self.low_rank
+        lr2 = 2 * self.low_rank
+        self.s[:lr2, :lr2] = self.n[:lr2, :lr] @ self.s[:lr, :lr] @ self.m[:lr2, :lr].T
+        self.s.requires_grad = True
+        self.s.training = True
+
+    @torch.no_grad()
+    def postprocess_from_qr(self, case: str, q: Tensor):
+        super().postprocess_from_qr(case, q)
+        if case == "k":
+            # Q of a zero row is only zero up to round-off (or not at all if [K, U] is rank deficient)
+            self._zero_padding_row()
+
+    @torch.no_grad()
+    def stop_pretraining(self):
+        self.pretrain = False
+        # thin SVD, the full U of a large vocabulary would not fit in memory
+        u, sing, vh = svd(self.fullweight, self.linalg_dtype)
+        new_lr = min(sing.shape[0], self.s.shape[0])
+        nn.init.eye_(self.s)
+        self.s[:new_lr, :new_lr] = torch.diag(sing[:new_lr]).to(device=self.s.device, dtype=self.s.dtype)
+        # 2 * rmax can be larger than embedding_dim, the rest of the bases stays zero
+        for name, basis in (("u", u), ("unp1", u)):
+            cols = min(basis.shape[1], getattr(self, name).shape[1])
+            getattr(self, name).zero_()[:, :cols] = basis[:, :cols]
+        for name in ("vt", "vtnp1"):
+            rows = min(vh.shape[0], getattr(self, name).shape[0])
+            getattr(self, name).zero_()[:rows] = vh[:rows]
+        del self.fullweight
+        self._zero_padding_row()
+        if self.rank_bucket:
+            self._zero_rank_padding()
@@ -0,0 +1,264 @@
+from __future__ import annotations
+
+import copy
+import time
+
+import torch
+import torch.nn as nn
+from rich.console import Console
+from rich.table import Table
+
+console = Console(width=140)
+
+__all__ = ["export_inference", "fold_batchnorm", "inference_report", "save_inference"]
+
+_CONVS = {1: nn.Conv1d, 2: nn.Conv2d, 3: nn.Conv3d}
+
+
+@torch.no_grad()
+def export_layer(layer: nn.Module, dense_threshold: float = 1.0) -> nn.Module:
+    """
+    Convert a trained DLRT linear/conv/embedding layer into plain torch modules for inference.
+
+    The low-rank weight W = second @ first becomes two layers of width r (linear: Linear(in, r)
+    -> Linear(r, out), conv: ConvNd(in, r, kernel) -> 1x1 ConvNd(r, out), both with the groups
+    of the layer, embedding: Embedding(num, r) -> Linear(r, dim)). If the factors are not smaller than `dense_threshold` times the dense weight
+    (break-even point), a single dense layer is used instead. Layers which are still in
+    pretraining are exported dense.
+    """
+    groups = getattr(layer, "groups", 1)
+    if hasattr(layer, "fullweight"):
+        first, second = None, layer.fullweight
+    else:
+        first, second = layer.inference_factors()
+        rank, in_size = first.shape
+        out_size = second.shape[0]
+        if first.numel() + second.numel() >= dense_threshold * in_size * out_size:
+            # grouped: block diagonal W -> product of the factors of every group
+            r = second.shape[1]
+            dense = second.view(groups, -1, r) @ first.view(groups, r, in_size)
+            first, second = None, dense.reshape(out_size, in_size)
+    factory = {"device": second.device, "dtype": second.dtype}
+    bias = layer.bias is not None
+
+    if hasattr(layer, "num_embeddings"):
+        # linear layout: W.T is the table -> Embedding(num, r) -> Linear(r, dim)
+        emb = {"padding_idx": layer.padding_idx, "scale_grad_by_freq": layer.scale_grad_by_freq}
+        emb["sparse"] = layer.sparse
+        if first is None:
+            table = second if hasattr(layer, "fullweight") else second.T
+            out = nn.Embedding(layer.num_embeddings, layer.embedding_dim, **emb, **factory)
+            out.weight.copy_(table)
+        else:
+            reduce = nn.Embedding(layer.num_embeddings, rank, **emb, **factory)
+            reduce.weight.copy_(first.T)
+            expand = nn.Linear(rank, layer.embedding_dim, bias=False, **factory)
+            expand.weight.copy_(second)
+            out = nn.Sequential(reduce, expand)
+    elif hasattr(layer, "kernel_size"):
+        conv_cls = _CONVS[len(layer.kernel_size)]
+        conv = {"stride": layer.stride, "padding": layer.padding, "dilation": layer.dilation}
+        conv["padding_mode"] = layer.padding_mode
+        conv["groups"] = groups
+        if first is None:
+            out = conv_cls(
+                layer.in_channels, layer.out_channels, layer.kernel_size, bias=bias, **conv, **factory
+            )
+            out.weight.copy_(second.reshape(out.weight.shape))
+        else:
+            reduce = conv_cls(layer.in_channels, rank, layer.kernel_size, bias=False, **conv, **factory)
+            reduce.weight.copy_(first.reshape(reduce.weight.shape))
+            expand = conv_cls(rank, layer.out_channels, 1, bias=bias, groups=groups, **factory)
+            expand.weight.copy_(second.reshape(expand.weight.shape))
+            out = nn.Sequential(reduce, expand)
+    else:
+        if first is None:
+            out = nn.Linear(layer.in_features, layer.out_features, bias=bias, **factory)
+            out.weight.copy_(second)
+        else:
+            reduce = nn.Linear(layer.in_features, rank, bias=False, **factory)
+            reduce.weight.copy_(first)
+            expand = nn.Linear(rank, layer.out_features, bias=bias, **factory)
+            expand.weight.copy_(second)
+            out = nn.Sequential(reduce, expand)
+    if bias:
+        (out[-1] if isinstance(out, nn.Sequential) else out).bias.copy_(layer.bias)
+    return out
+
+
+@torch.no_grad()
+def fold_batchnorm(model: nn.Module) -> int:
+    """
+    Fold eval-mode BatchNorm layers into the Linear/ConvNd directly in front of them (in place).
+    The model is traced with torch.fx to find the pairs, nothing is folded if it cannot be traced.
+
+    Returns
+    -------
+    the number of folded BatchNorm layers
+    """
+    try:
+        graph = torch.fx.symbolic_trace(model).graph
+    except Exception as e:  # noqa: B902
+        console.print(f"could not trace the model, BatchNorm is not folded: {e}")
+        return 0
+    modules = dict(model.named_modules())
+    folded = 0
+    for node in graph.nodes:
+        bn = modules.get(node.target) if node.op == "call_module" else None
+        if not isinstance(bn, nn.modules.batchnorm._BatchNorm) or bn.running_mean is None:
+            continue
+        prev = node.args[0]
+        if not isinstance(prev, torch.fx.Node) or prev.op != "call_module" or len(prev.users) > 1:
+            continue
+        layer = modules[prev.target]
+        if not isinstance(layer, (nn.Linear, *_CONVS.values())):
+            continue
+        # y = (W x + b - mean) * gamma / sqrt(var + eps) + beta
+        scale = torch.rsqrt(bn.running_var + bn.eps)
+        shift = -bn.running_mean * scale
+        if bn.affine:
+            scale, shift = scale * bn.weight, shift * bn.weight + bn.bias
+        layer.weight.mul_(scale.reshape(-1, *([1] * (layer.weight.ndim - 1))))
+        if layer.bias is None:
+            layer.bias = nn.Parameter(shift.clone())
+        else:
+            layer.bias.mul_(scale).add_(shift)
+        parent, _, name = node.target.rpartition(".")
+        setattr(model.get_submodule(parent), name, nn.Identity())
+        folded += 1
+    return folded
+
+
+@torch.no_grad()
+def export_inference(model: nn.Module, dense_threshold: float = 1.0, fold_bn: bool = True) -> nn.Module:
+    """
+    Copy of `model` for inference: the DLRT layers are replaced by plain torch modules (see
+    `export_layer`) and BatchNorm is folded into the layers in front of it. The copy is in eval mode
+    and does not contain any of the DLRT training buffers.
+    """
+    # the DLRT layers are swapped in during the copy -> their buffers are never copied
+    memo = {}
+    for module in model.modules():
+        if hasattr(module, "dlrt"):
+            try:
+                memo[id(module)] = export_layer(module, dense_threshold=dense_threshold)
+            except NotImplementedError:
+                pass
+    exported = copy.deepcopy(model, memo).eval()
+    if fold_bn:
+        fold_batchnorm(exported)
+    for p in exported.parameters():
+        p.requires_grad = False
+    return exported
+
+
+def _count_flops(model: nn.Module, example_input) -> int:
+    # FLOPs (2 * multiply-adds) of all Linear and ConvNd layers for one forward of example_input
+    flops = []
+
+    def linear_hook(module, inp, out):
+        flops.append(2 * out.numel() * module.in_features)
+
+    def conv_hook(module, inp, out):
+        flops.append(2 * out.numel() * module.weight[0].numel())
+
+    handles = []
+    for module in model.modules():
+        if isinstance(module, nn.Linear):
+            handles.append(module.register_forward_hook(linear_hook))
+        elif isinstance(module, tuple(_CONVS.values())):
+            handles.append(module.register_forward_hook(conv_hook))
+    with torch.no_grad():
+        model(example_input)
+    for handle in handles:
+        handle.remove()
+    return sum(flops)
+
+
+def _latency(fn, example_input, repeats: int) -> float:
+    # median seconds per forward
+    with torch.no_grad():
+        for _ in range(3):
+            fn(example_input)
+        times = []
+        for _ in range(repeats):
+            if example_input.is_cuda:
+                torch.cuda.synchronize()
+            t0 = time.perf_counter()
+            fn(example_input)
+            if example_input.is_cuda:
+                torch.cuda.synchronize()
+            times.append(time.perf_counter() - t0)
+    return sorted(times)[len(times) // 2]
+
+
+def _numel(model: nn.Module) -> int:
+    return sum(t.numel() for t in model.parameters()) + sum(t.numel() for t in model.buffers())
+
+
+def inference_report(
+    network,
+    exported: nn.Module,
+    example_input,
+    repeats: int = 20,
+    print_report: bool = True,
+) -> dict:
+    """
+    Compare the exported model with the DLRT training model and the dense model with the same
+    weights: number of stored values (parameters and buffers), forward FLOPs of the Linear/ConvNd
+    layers, and the median forward latency for `example_input`.
+
+    Parameters
+    ----------
+    network: DLRTNetwork
+        the trained network which `exported` was created from
+    """
+    dense = export_inference(network.dlrt_model, dense_threshold=0.0, fold_bn=False)
+    training = network.dlrt_model.training
+    network.eval()
+    network.set_layer_case("k")
+    network.run_preprocess("k")
+    report = {
+        "values": {"dlrt": _numel(network.dlrt_model), "dense": _numel(dense), "exported": _numel(exported)},
+        "flops": {
+            "dense": _count_flops(dense, example_input),
+            "exported": _count_flops(exported, example_input),
+        },
+        "latency_ms": {
+            "dlrt": 1e3 * _latency(lambda x: network.dlrt_model(x), example_input, repeats),
+            "dense": 1e3 * _latency(dense, example_input, repeats),
+            "exported": 1e3 * _latency(exported, example_input, repeats),
+        },
+    }
+    network.train(training)
+    if print_report:
+        table = Table(title="inference export")
+        for col in ("model", "params + buffers", "FLOPs", "latency [ms]"):
+            table.add_column(col)
+        for name in ("dlrt", "dense", "exported"):
+            flops = report["flops"].get(name)
+            table.add_row(
+                name,
+                f"{report['values'][name]:,}",
+                "-" if flops is None else f"{flops:,}",
+                f"{report['latency_ms'][name]:.3f}",
+            )
+        console.print(table)
+    return report
+
+
+def save_inference(exported: nn.Module, path, example_input=None, torchscript: bool = False):
+    """
+    Save an exported model with torch.save, or as TorchScript (traced if `example_input` is given,
+    scripted otherwise). The saved model only needs torch (and the classes of the original model
+    for torch.save) to be loaded.
+    """
+    if not torchscript:
+        torch.save(exported, path)
+        return
+    with torch.no_grad():
+        if example_input is not None:
+            scripted = torch.jit.trace(exported, example_input)
+        else:
+            scripted = torch.jit.script(exported)
+    torch.jit.save(scripted, path)
@@ -0,0 +1,244 @@
+from __future__ import annotations
+
+import os
+import queue
+import threading
+
+import numpy as np
+import torch
+
+from .basic import truncation_threshold
+
+__all__ = ["RankHistory", "load_rank_history"]
+
+HISTORY_VERSION = 1
+# columns of every chunk in the file, in order
+COLUMNS = ("step", "rank", "tolerance", "singular_values")
+
+
+class RankHistory:
+    """
+    Record the rank dynamics of the DLRT layers: per layer and step the rank, the truncation
+    tolerance (bound on the norm of the cut singular values, see `basic.truncation_threshold`), and
+    the `top_k` largest singular values of the last rank adaption.
+
+    The values are written into a ring buffer of the last `capacity` records which is preallocated
+    on the device of the network, `record` does not sync with the host. If a `path` is given, the
+    records are copied to the host every `capacity` records (and on `flush` / `close`) and appended
+    to the file by a background thread, as columns of numpy arrays (see `load_rank_history`).
+    Without a path, `snapshot` gives the records in the ring buffer.
+
+    Layers without a fresh SVD (fixed layers, pretraining, failed SVD, layers of other processes
+    with shard_linalg) have NaN singular values and tolerance. Grouped convolutions record the
+    largest values over the groups.
+
+    Parameters
+    ----------
+    path: str
+        file the records are written to (overwritten), None -> only the ring buffer
+    top_k: int
+        number of singular values per layer and record
+    capacity: int
+        number of records in the ring buffer (= records per chunk in the file)
+    every: int
+        record every this many steps
+    """
+
+    def __init__(self, path: str = None, top_k: int = 8, capacity: int = 256, every: int = 1):
+        if capacity < 1 or top_k < 1 or every < 1:
+            raise ValueError(f"capacity, top_k, and every must be positive: {capacity}, {top_k}, {every}")
+        self.path = path
+        self.top_k = top_k
+        self.capacity = capacity
+        self.every = every
+        self.layers = None
+        # records written into the ring buffer / handed to the writer
+        self.count = 0
+        self._flushed = 0
+        self._jobs = queue.Queue()
+        self._error = None
+        self._thread = None
+        if path is not None:
+            self._thread = threading.Thread(target=self._run, name="rank-history-writer", daemon=True)
+            self._thread.start()
+
+    def _allocate(self, names: list, device):
+        # ring buffer, the steps and ranks are known on the host, the rest stays on the device
+        self.layers = names
+        num = len(names)
+        self.device = device
+        self._steps = np.zeros(self.capacity, dtype=np.int64)
+        self._ranks = np.zeros((self.capacity, num), dtype=np.int32)
+        self._tol = torch.full((self.capacity, num), float("nan"), device=device)
+        self._sing = torch.full((self.capacity, num, self.top_k), float("nan"), device=device)
+        self._nan = torch.full((), float("nan"), device=device)
+        if self.path is not None:
+            self._jobs.put(("header", np.array(names, dtype=str), None))
+
+    @torch.no_grad()
+    def record(self, step: int, network):
+        """
+        Record the current state of all DLRT layers of `network` (DLRTNetwork), call it after the
+        rank adaption
+        """
+        if step % self.every != 0:
+            return
+        self._raise_error()
+        layers = network._dlrt_layers()
+        layers = [
+            (path, layer) for path, layer in zip(network._layer_paths, layers) if hasattr(layer, "low_rank")
+        ]
+        if self.layers is None:
+            self._allocate([path for path, _ in layers], next(network.dlrt_model.parameters()).device)
+        elif len(layers) != len(self.layers):
+            raise RuntimeError(f"the number of DLRT layers changed: {len(self.layers)} -> {len(layers)}")
+        if self.count - self._flushed == self.capacity:
+            # the oldest record would be overwritten before it is written
+            self.flush()
+        slot = self.count % self.capacity
+        self._steps[slot] = step
+        self._sing[slot] = float("nan")
+        tols = []
+        for i, (_, layer) in enumerate(layers):
+            self._ranks[slot, i] = layer.low_rank
+            # set by rank_adaption_apply, reset here -> NaN if there was no rank adaption since
+            sing = getattr(layer, "last_singular_values", None)
+            layer.last_singular_values = None
+            if sing is None:
+                tols.append(self._nan)
+                continue
+            sing = sing.reshape(-1, sing.shape[-1]).amax(0).float()
+            tols.append(truncation_threshold(sing, layer.eps_adapt, layer.truncation).float())
+            k = min(self.top_k, sing.shape[0])
+            self._sing[slot, i, :k] = sing[:k]
+        if tols:
+            self._tol[slot] = torch.stack(tols)
+        self.count += 1
+
+    def _pending(self) -> list:
+        # slots of the records which were not handed to the writer yet, oldest first
+        return [(self._flushed + j) % self.capacity for j in range(self.count - self._flushed)]
+
+    def flush(self):
+        """
+        Hand the records since the last flush to the writer thread (copied asynchronously)
+        """
+        if self.path is None or self.layers is None or self.count == self._flushed:
+            self._flushed = self.count
+            return
+        slots = self._pending()
+        index = torch.tensor(slots, device=self.device)
+        cuda = self._tol.is_cuda
+        tol = torch.empty((len(slots), len(self.layers)), pin_memory=cuda)
+        sing = torch.empty((len(slots), len(self.layers), self.top_k), pin_memory=cuda)
+        tol.copy_(self._tol[index], non_blocking=cuda)
+        sing.copy_(self._sing[index], non_blocking=cuda)
+        event = None
+        if cuda:
+            event = torch.cuda.Event()
+            event.record()
+        columns = (self._steps[slots], self._ranks[slots], tol, sing)
+        self._jobs.put(("chunk", columns, event))
+        self._flushed = self.count
+
+    def snapshot(self) -> dict:
+        """
+        Records in the ring buffer (the last `capacity`), oldest first, as numpy arrays (one sync),
+        same layout as `load_rank_history`
+        """
+        if self.layers is None:
+            return None
+        num = min(self.count, self.capacity)
+        slots = [(self.count - num + j) % self.capacity for j in range(num)]
+        index = torch.tensor(slots, device=self.device)
+        return {
+            "layers": list(self.layers),
+            "step": self._steps[slots],
+            "rank": self._ranks[slots],
+            "tolerance": self._tol[index].cpu().numpy(),
+            "singular_values": self._sing[index].cpu().numpy(),
+        }
+
+    def _run(self):
+        with open(self.path, "wb") as f:
+            while True:
+                job = self._jobs.get()
+                if job is None:
+                    self._jobs.task_done()
+                    return
+                kind, data, event = job
+                try:
+                    if kind == "header":
+                        np.save(f, np.array([HISTORY_VERSION]), allow_pickle=False)
+                        np.save(f, data, allow_pickle=False)
+                    else:
+                        if event is not None:
+                            event.synchronize()
+                        for col in data:
+                            np.save(f, col.numpy() if torch.is_tensor(col) else col, allow_pickle=False)
+                    f.flush()
+                except Exception as e:  # noqa: B902
+                    self._error = e
+                finally:
+                    self._jobs.task_done()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError("writing the rank history failed") from error
+
+    def wait(self):
+        """
+        Flush and block until everything is written
+        """
+        self.flush()
+        self._jobs.join()
+        self._raise_error()
+
+    def close(self):
+        """
+        Write the pending records and stop the writer thread
+        """
+        self.flush()
+        if self._thread is not None and self._thread.is_alive():
+            self._jobs.put(None)
+            self._thread.join()
+        self._raise_error()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def load_rank_history(path: str) -> dict:
+    """
+    Load a file written by RankHistory
+
+    Returns
+    -------
+    dict with the layer names ("layers", paths in the model) and the columns as numpy arrays:
+        step: (records,), rank: (records, layers), tolerance: (records, layers),
+        singular_values: (records, layers, top_k)
+    """
+    size = os.path.getsize(path)
+    chunks = {col: [] for col in COLUMNS}
+    with open(path, "rb") as f:
+        version = int(np.load(f)[0])
+        if version != HISTORY_VERSION:
+            raise ValueError(f"unsupported rank history version: {version}")
+        layers = [str(name) for name in np.load(f)]
+        while f.tell() < size:
+            for col in COLUMNS:
+                chunks[col].append(np.load(f))
+    empty = {
+        "step": np.zeros(0, dtype=np.int64),
+        "rank": np.zeros((0, len(layers)), dtype=np.int32),
+        "tolerance": np.zeros((0, len(layers)), dtype=np.float32),
+        "singular_values": np.zeros((0, len(layers), 0), dtype=np.float32),
+    }
+    out = {"layers": layers}
+    for col in COLUMNS:
+        out[col] = np.concatenate(chunks[col]) if chunks[col] else empty[col]
+    return out
@@ -0,0 +1,209 @@
+from __future__ import annotations
+
+import time
+import weakref
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+from rich.console import Console
+from rich.table import Table
+
+from .basic import qr
+from .basic import svd
+
+console = Console(width=140)
+
+__all__ = ["GroupedLinalg"]
+
+
+class GroupedLinalg:
+    """
+    Batched linear algebra for the KLS integrator across all DLRT layers of a network.
+
+    The QRs of the k/l postprocessing and the SVDs of the rank adaption are collected from all
+    layers and grouped by (shape, dtype, device), i.e. by layer shape and current rank. Each group
+    with more than one layer is stacked and decomposed with a single batched call. The remaining
+    layers (unique shapes) are decomposed concurrently on a thread pool, torch releases the GIL
+    in the decompositions.
+
+    Parameters
+    ----------
+    num_threads: int
+        size of the thread pool for the layers which cannot be batched (<= 1 -> sequential)
+    timing: bool
+        record the time of each phase. On the GPU this synchronizes the device after every phase.
+    dtype: torch.dtype
+        precision of the decompositions, None -> the dtype of the factors, but at least fp32
+    """
+
+    def __init__(self, num_threads: int = 4, timing: bool = False, dtype: torch.dtype = None):
+        self.num_threads = num_threads
+        self.dtype = dtype
+        self.pool = ThreadPoolExecutor(num_threads) if num_threads > 1 else None
+        # stop the threads of the pool if the object is dropped without close()
+        self._finalizer = weakref.finalize(self, self.pool.shutdown, wait=False) if self.pool else None
+        self.timing = timing
+        # phase -> [calls, seconds, batched groups, batched layers, single layers]
+        self.stats = defaultdict(lambda: [0, 0.0, 0, 0, 0])
+
+    def _decompose(self, phase: str, mats: list, op) -> list:
+        # run `op` on all matrices, batched where the shapes allow it
+        #   returns the results of `op` per matrix (None if the decomposition failed)
+        stats = self.stats[phase]
+        groups = defaultdict(list)
+        for i, mat in enumerate(mats):
+            groups[(tuple(mat.shape), mat.dtype, mat.device)].append(i)
+
+        results = [None] * len(mats)
+        singles = []
+        for idx in groups.values():
+            if len(idx) == 1:
+                singles.append(idx[0])
+                continue
+            try:
+                out = op(torch.stack([mats[i] for i in idx]))
+            except torch._C._LinAlgError:
+                # one bad matrix fails the whole batch -> retry them one by one
+                singles.extend(idx)
+                continue
+            for b, i in enumerate(idx):
+                results[i] = tuple(o[b] for o in out)
+            stats[2] += 1
+            stats[3] += len(idx)
+
+        def single(i):
+            try:
+                return tuple(op(mats[i]))
+            except torch._C._LinAlgError as e:
+                print(f"LinAlgError during {phase} -> {e}")
+                return None
+
+        if self.pool is not None and len(singles) > 1:
+            for i, out in zip(singles, self.pool.map(single, singles)):
+                results[i] = out
+        else:
+            for i in singles:
+                results[i] = single(i)
+        stats[4] += len(singles)
+        return results
+
+    def close(self):
+        """
+        Shut down the thread pool, the layers which cannot be batched are decomposed one by one after
+        this
+        """
+        if self.pool is not None:
+            self._finalizer.detach()
+            self.pool.shutdown()
+            self.pool = None
+
+    def _start(self):
+        if not self.timing:
+            return None
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def _stop(self, phase: str, start):
+        self.stats[phase][0] += 1
+        if start is None:
+            return
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        self.stats[phase][1] += time.perf_counter() - start
+
+    @torch.no_grad()
+    def postprocess(self, layers: list, case: str):
+        """
+        Run the `case` postprocessing of all `layers` with the QRs batched across layers.
+        `case` is one of k, l, kl, kls (kl and kls do the k and l QRs in one go).
+        """
+        start = self._start()
+        cases = ("k", "l") if case in ("kl", "kls") else (case,)
+        jobs, mats = [], []
+        for layer in layers:
+            for c in cases:
+                mat = layer.postprocess_qr_input(c)
+                if mat is None:
+                    # layer without the split -> does its own postprocessing
+                    getattr(layer, f"{c}_postprocess")()
+                    continue
+                jobs.append((layer, c))
+                mats.append(mat)
+        qrs = self._decompose(f"{case}_postprocess", mats, lambda m: (qr(m, self.dtype),))
+        for (layer, c), res in zip(jobs, qrs):
+            layer.postprocess_from_qr(c, res[0])
+        if case == "kls":
+            for layer in layers:
+                if hasattr(layer, "parallel_s_assemble"):
+                    layer.parallel_s_assemble()
+        self._stop(f"{case}_postprocess", start)
+
+    @torch.no_grad()
+    def rank_adaption_prepare(self, layers: list, skip: bool = False) -> tuple[list, list]:
+        """
+        First half of the rank adaption for all `layers` with the SVDs batched across layers.
+
+        Returns
+        -------
+        the layers which have a new rank and their new ranks (tensors on the device or ints)
+        """
+        start = self._start()
+        jobs, mats = [], []
+        for layer in layers:
+            mat = layer.rank_adaption_svd_input()
+            if mat is not None:
+                jobs.append(layer)
+                mats.append(mat)
+        svds = self._decompose(
+            "rank_adaption",
+            mats,
+            lambda m: svd(m, self.dtype),
+        )
+        pending, new_ranks = [], []
+        for layer, res in zip(jobs, svds):
+            if res is None:
+                continue
+            new_rank = layer.rank_adaption_from_svd(*res, skip=skip)
+            if new_rank is not None:
+                pending.append(layer)
+                new_ranks.append(new_rank)
+        self._stop("rank_adaption", start)
+        return pending, new_ranks
+
+    def report(self) -> dict:
+        """
+        Per-phase statistics: number of calls, total and mean time (only with `timing`), number of
+        batched groups, and number of layers decomposed in batches / one by one.
+        """
+        out = {}
+        for phase, (calls, total, groups, batched, singles) in self.stats.items():
+            out[phase] = {
+                "calls": calls,
+                "total_s": total if self.timing else None,
+                "mean_ms": 1e3 * total / calls if self.timing and calls else None,
+                "batched_groups": groups,
+                "batched_layers": batched,
+                "single_layers": singles,
+            }
+        return out
+
+    def print_report(self):
+        table = Table(title="grouped linear algebra")
+        for col in ("phase", "calls", "total [s]", "mean [ms]", "groups", "batched", "single"):
+            table.add_column(col)
+        for phase, st in self.report().items():
+            table.add_row(
+                phase,
+                str(st["calls"]),
+                "-" if st["total_s"] is None else f"{st['total_s']:.3f}",
+                "-" if st["mean_ms"] is None else f"{st['mean_ms']:.3f}",
+                str(st["batched_groups"]),
+                str(st["batched_layers"]),
+                str(st["single_layers"]),
+            )
+        console.print(table)
+
+    def reset(self):
+        self.stats.clear()
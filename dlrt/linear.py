@@ -1,5 +1,6 @@
 from __future__ import annotations
 
+import functools
 import math
 
 import numpy as np
@@ -14,9 +15,60 @@ from torch import Tensor
 console = Console(width=140)
 
 from .basic import DLRTModule
+from .basic import TRUNCATION_CRITERIA
+from .basic import qr
+from .basic import svd
+from .basic import truncation_rank
 
 __all__ = ["DLRTLinear", "DLRTLinearFixed", "DLRTLinearAdaptive"]
 
+_FORWARD_MODES = ("factored", "dense", "auto")
+
+
+@functools.lru_cache(maxsize=1024)
+def _chain_order(dims: tuple[int, ...], allow_dense: bool) -> int | tuple:
+    """
+    Get the cheapest evaluation order for the chain `input @ f_0 @ ... @ f_n`
+
+    Standard matrix-chain dynamic program. `dims` holds the number of rows of the input followed
+    by the number of columns of every matrix in the chain. If `allow_dense` is False, the
+    product of all the weight factors (i.e. the dense weight) is never formed. Results are cached,
+    the ranks only change after `rank_adaption`.
+
+    Returns
+    -------
+    nested tuples of matrix indices, e.g. ((0, 1), 2) for (input @ f_0) @ f_1
+    """
+    n = len(dims) - 1
+    cost = {(i, i): 0 for i in range(n)}
+    split = {}
+    for length in range(2, n + 1):
+        for i in range(n - length + 1):
+            j = i + length - 1
+            if not allow_dense and n > 2 and i == 1 and j == n - 1:
+                cost[(i, j)] = math.inf
+                continue
+            cost[(i, j)] = math.inf
+            for k in range(i, j):
+                c = cost[(i, k)] + cost[(k + 1, j)] + dims[i] * dims[k + 1] * dims[j + 1]
+                if c < cost[(i, j)]:
+                    cost[(i, j)] = c
+                    split[(i, j)] = k
+
+    def build(i, j):
+        if i == j:
+            return i
+        k = split[(i, j)]
+        return build(i, k), build(k + 1, j)
+
+    return build(0, n - 1)
+
+
+def _run_chain(order, mats):
+    if isinstance(order, int):
+        return mats[order]
+    return _run_chain(order[0], mats) @ _run_chain(order[1], mats)
+
 
 def DLRTLinear(
     in_features: int,
@@ -29,11 +81,15 @@ def DLRTLinear(
     dtype=None,
     eps_adapt: float = 0.01,
     pretrain: bool = False,
+    forward_mode: str = "factored",
+    truncation: str = "relative",
 ):
     """
     Gets a linear layer with the given features
 
     Args:
+        forward_mode: only used for adaptive layers, see `DLRTLinearAdaptive`
+        truncation: only used for adaptive layers, see `DLRTLinearAdaptive`
     """
     if not adaptive:
         if low_rank_percent is not None:
@@ -60,6 +116,8 @@ def DLRTLinear(
             device=device,
             dtype=dtype,
             pretrain=pretrain,
+            forward_mode=forward_mode,
+            truncation=truncation,
         )
 
 
@@ -97,13 +155,13 @@ class DLRTLinearFixed(DLRTModule):
             for the math, this is the inner dim of the decomp
         """
 
+        super().__init__()
         self.low_rank = low_rank if low_rank is not None else min([in_features, out_features])
         if low_rank > in_features:
             raise ValueError(
                 f"rank > in_features ({low_rank} > {in_features}) use nn.Linear or reduce rank",
             )
         factory_kwargs = {"device": device, "dtype": dtype}
-        super().__init__()
 
         self.in_features = in_features
         self.out_features = out_features
@@ -202,6 +260,12 @@ class DLRTLinearFixed(DLRTModule):
             return self.k @ torch.diag(self.s) @ self.lt
         return self.k @ self.s @ self.lt
 
+    @torch.no_grad()
+    def inference_factors(self) -> tuple[Tensor, Tensor]:
+        # W = U @ S @ Vt (in x out) -> torch layout: first = (U @ S).T, second = Vt.T
+        s = torch.diag(self.s) if self.s.ndim == 1 else self.s
+        return (self.u @ s).T, self.vt.T
+
     @torch.no_grad()
     def reset_parameters(self):
         nn.init.kaiming_uniform_(self.u, a=math.sqrt(5))
@@ -229,6 +293,11 @@ class DLRTLinearFixed(DLRTModule):
         elif self.train_case == "l":  # l-step
             ret = torch.linalg.multi_dot([input, self.u, self.lt])
             # ret = (input @ self.u) @ self.lt
+        elif self.train_case == "kl":  # parallel k- and l-step
+            ret = torch.linalg.multi_dot([input, self.k, self.vt])
+            # the l-step values cancel out, only adds the gradients for L
+            lret = (input.detach() @ self.u) @ self.lt
+            ret = ret + (lret - lret.detach())
         else:  # s-step
             ret = torch.linalg.multi_dot([input, self.unp1, self.s, self.vtnp1])
             # ret = ((input @ self.unp1) @ self.s) @ self.vtnp1
@@ -266,13 +335,19 @@ class DLRTLinearFixed(DLRTModule):
         self.lt.set_(self.s @ self.vt)
         self.lt.requires_grad = True
 
+    @torch.no_grad()
+    def kl_preprocess(self):
+        self.k_preprocess()
+        self.l_preprocess()
+        self.k.requires_grad = True
+
     @torch.no_grad()
     def k_postprocess(self):
         # NOTE must run after 'l' forward step b/c self.u is used in the l forward step
         self._change_params_requires_grad(False)
         # aux_Unp1 -> q from qr(k)
         #   aux_Unp1 used in s-step forward, can keep in u
-        self.unp1.set_(torch.linalg.qr(self.k)[0])
+        self.unp1.set_(qr(self.k, self.linalg_dtype))
         # aux_N -> aux_Unp1.T @ aux_U
         #   used in setting s,
         self.n.set_(self.unp1.T @ self.u)
@@ -281,7 +356,7 @@ class DLRTLinearFixed(DLRTModule):
     def l_postprocess(self):
         self._change_params_requires_grad(False)
         # aux_Vtnp1 -> q from qr(lt.T)
-        self.vtnp1.set_(torch.linalg.qr(self.lt.T)[0].T)
+        self.vtnp1.set_(qr(self.lt.T, self.linalg_dtype).T)
         # aux_M -> aux_Vtnp1 @ aux_Vt.T
         self.m.set_(self.vtnp1 @ self.vt.T)
 
@@ -319,6 +394,8 @@ class DLRTLinearAdaptive(DLRTModule):
         device=None,
         dtype=None,
         pretrain: bool = True,
+        forward_mode: str = "factored",
+        truncation: str = "relative",
     ) -> None:
         """
         TODO: this
@@ -340,11 +417,27 @@ class DLRTLinearAdaptive(DLRTModule):
             init with svd or with random for K, L.T, and S
         device
         dtype
+        forward_mode
+            how the K/L/S forward is evaluated:
+            - "factored": chain the rank-r GEMMs starting from the input, the dense weight
+              is never allocated. the order of the chain is chosen per call from the batch size,
+              rank, and layer shape
+            - "dense": build the dense in_features x out_features weight, then one GEMM
+            - "auto": cheapest order from the FLOP count, may build the dense weight
+        truncation
+            criterion for the rank adaption, one of "absolute", "relative", or "energy".
+            see `basic.truncation_rank`
         """
         super().__init__()
+        if forward_mode not in _FORWARD_MODES:
+            raise ValueError(f"forward_mode must be one of {_FORWARD_MODES}, not: {forward_mode}")
+        if truncation not in TRUNCATION_CRITERIA:
+            raise ValueError(f"truncation must be one of {TRUNCATION_CRITERIA}, not: {truncation}")
+        self.truncation = truncation
         factory_kwargs = {"device": device, "dtype": dtype}
         self.in_features = in_features
         self.out_features = out_features
+        self.forward_mode = forward_mode
         if (isinstance(bias, bool) and bias) or bias is not None:
             self.bias = nn.Parameter(torch.empty(out_features, **factory_kwargs))
         else:
@@ -424,13 +517,57 @@ class DLRTLinearAdaptive(DLRTModule):
             f"out_features={self.out_features}, bias={self.bias is not None}"
         )
 
+    def _factor_shapes(self, rmax: int) -> dict:
+        return {
+            "k": (self.in_features, rmax),
+            "s": (2 * rmax, 2 * rmax),
+            "lt": (rmax, self.out_features),
+            "u": (self.in_features, rmax),
+            "unp1": (self.in_features, 2 * rmax),
+            "vt": (rmax, self.out_features),
+            "vtnp1": (2 * rmax, self.out_features),
+            "n": (2 * rmax, rmax),
+            "m": (2 * rmax, rmax),
+        }
+
     def get_classic_weight_repr(self):
         return self.k @ self.s @ self.lt
 
+    def checkpoint_shapes(self) -> dict:
+        # between two steps the layer is U[:, :r] @ S[:r, :r] @ Vt[:r] (+ bias), K, L, and the
+        #   augmented bases are rebuilt by the pre-/postprocessing of the next step
+        if self.pretrain:
+            shapes = {"fullweight": tuple(self.fullweight.shape)}
+        else:
+            lr = self.low_rank
+            shapes = {"u": (self.in_features, lr), "s": (lr, lr), "vt": (lr, self.out_features)}
+        if self.bias is not None:
+            shapes["bias"] = tuple(self.bias.shape)
+        return shapes
+
+    def optimizer_state_shapes(self) -> dict:
+        # trained blocks at the current rank: K and L, and the augmented S of the S step
+        #   the state of the directions beyond the rank is zero (see zero_beyond_rank)
+        lr = self.low_rank
+        shapes = {"k": (self.in_features, lr), "lt": (lr, self.out_features), "s": (2 * lr, 2 * lr)}
+        if self.pretrain:
+            shapes["fullweight"] = tuple(self.fullweight.shape)
+        if self.bias is not None:
+            shapes["bias"] = tuple(self.bias.shape)
+        return shapes
+
+    @torch.no_grad()
+    def inference_factors(self) -> tuple[Tensor, Tensor]:
+        # W = U @ S @ Vt (in x out) -> torch layout: first = (U @ S).T, second = Vt.T
+        lr = self.low_rank
+        return (self.u[:, :lr] @ self.s[:lr, :lr]).T, self.vt[:lr].T
+
     def reset_parameters(self) -> None:
         # Setting a=sqrt(5) in kaiming_uniform is the same as initializing with
         # uniform(-1/sqrt(in_features), 1/sqrt(in_features)). For details, see
         # https://github.com/pytorch/pytorch/issues/57109
+        if self.pretrain:
+            nn.init.kaiming_uniform_(self.fullweight, a=math.sqrt(5))
         nn.init.kaiming_uniform_(self.u, a=math.sqrt(5))
         nn.init.kaiming_uniform_(self.s, a=math.sqrt(5))
         nn.init.kaiming_uniform_(self.vt, a=math.sqrt(5))
@@ -463,37 +600,43 @@ class DLRTLinearAdaptive(DLRTModule):
         # switch -> if current train case is k/l, do post for
         self.train_case = case
 
+    def _low_rank_matmul(self, input: Tensor, factors: list[Tensor]) -> Tensor:
+        # input @ factors[0] @ ... @ factors[-1]
+        if self.forward_mode == "dense":
+            return input @ torch.linalg.multi_dot(factors)
+        dims = (input.numel() // self.in_features, self.in_features, *(f.shape[1] for f in factors))
+        # torch.compile: the cache is not traceable, the plain DP is folded into the graph
+        chain_order = _chain_order.__wrapped__ if torch.compiler.is_compiling() else _chain_order
+        order = chain_order(dims, allow_dense=self.forward_mode == "auto")
+        return _run_chain(order, [input, *factors])
+
     # @torch.jit.script
     def forward(self, input: Tensor) -> Tensor:
-        eps = torch.finfo(input.dtype).eps
         if self.train_case == "pretrain":
             ret = input @ self.fullweight.T
         elif self.train_case == "k":  # k-step
-            # remove elements close to 0
-            second = self.k[:, : self.low_rank] @ self.vt[: self.low_rank]
-            second[(second >= eps) & (second <= -eps)] *= 0
-            ret = input @ second
-            # ret = torch.linalg.multi_dot(
-            #     [input, self.k[:, : self.low_rank], self.vt[: self.low_rank]],
-            # )
+            lr = self.forward_rank
+            ret = self._low_rank_matmul(input, [self.k[:, :lr], self.vt[:lr]])
         elif self.train_case == "l":  # l-step
-            second = self.u[:, : self.low_rank] @ self.lt[: self.low_rank]
-            second[(second >= eps) & (second <= -eps)] *= 0
-            ret = input @ second
-            # ret = torch.linalg.multi_dot(
-            #     [input, self.u[:, : self.low_rank], self.lt[: self.low_rank]],
-            # )
+            lr = self.forward_rank
+            ret = self._low_rank_matmul(input, [self.u[:, :lr], self.lt[:lr]])
+        elif self.train_case in ["kl", "kls"]:  # parallel integrator: k-, l- (and s-) step
+            lr = self.forward_rank
+            ret = self._low_rank_matmul(input, [self.k[:, :lr], self.vt[:lr]])
+            # the l- and s-step values cancel out, they only add the gradients for L and S
+            #   the input is detached -> the input gradient only comes from the k-step
+            xu = input.detach() @ self.u[:, :lr]
+            extra = xu @ self.lt[:lr]
+            if self.train_case == "kls":
+                extra = extra + (xu @ self.s[:lr, :lr]) @ self.vt[:lr]
+            ret = ret + (extra - extra.detach())
         else:  # s-step
             # TODO: should this be only low_rank??? (not x2)
-            lr2 = 2 * self.low_rank
-            second = torch.linalg.multi_dot(
+            lr2 = 2 * self.forward_rank
+            ret = self._low_rank_matmul(
+                input,
                 [self.unp1[:, :lr2], self.s[:lr2, :lr2], self.vtnp1[:lr2]],
             )
-            second[(second >= eps) & (second <= -eps)] *= 0
-            ret = input @ second
-            # ret = torch.linalg.multi_dot(
-            #     [input, self.unp1[:, :lr2], self.s[:lr2, :lr2], self.vtnp1[:lr2]],
-            # )
 
         if self.bias is not None:
             ret.add_(self.bias)
@@ -521,31 +664,70 @@ class DLRTLinearAdaptive(DLRTModule):
         self.lt.training = True
 
     @torch.no_grad()
-    def k_postprocess(self):
+    def kl_preprocess(self):
+        self.k_preprocess()
+        self.l_preprocess()
+        self.k.requires_grad = True
+
+    @torch.no_grad()
+    def kls_preprocess(self):
+        self.kl_preprocess()
+        self.s.requires_grad = True
+        if self.bias is not None:
+            self.bias.requires_grad = True
+
+    @torch.no_grad()
+    def postprocess_qr_input(self, case: str):
         lr = self.low_rank
-        lr2 = 2 * self.low_rank
-        # ------- k postpro ----------------------------------
-        # aux_Unp1 -> q from qr(k)
-        #   aux_Unp1 used in s-step forward, can keep in u
-        k_extended = torch.cat((self.k[:, :lr], self.u[:, :lr]), dim=1)
-        prev_u, _ = torch.linalg.qr(k_extended)
-        # aux_N -> aux_Unp1.T @ aux_U
-        # self.unp1.zero_()
-        self.unp1[:, :lr2] = prev_u
-        #   used in setting s,
-        # self.n.zero_()
-        self.n[:lr2, :lr] = self.unp1[:, :lr2].T @ self.u[:, :lr]
+        if case == "k":
+            # ------- k postpro ----------------------------------
+            # aux_Unp1 -> q from qr(k)
+            #   aux_Unp1 used in s-step forward, can keep in u
+            return torch.cat((self.k[:, :lr], self.u[:, :lr]), dim=1)
+        return torch.cat((self.lt[:lr].T, self.vt[:lr].T), dim=1)
 
     @torch.no_grad()
-    def l_postprocess(self):
+    def postprocess_from_qr(self, case: str, q: Tensor):
         lr = self.low_rank
         lr2 = 2 * self.low_rank
-        l_extended = torch.cat((self.lt[:lr].T, self.vt[:lr].T), dim=1)
-        aux_Vnp1, _ = torch.linalg.qr(l_extended)
-        # self.vtnp1.zero_()
-        self.vtnp1[:lr2] = aux_Vnp1.T
-        self.m.zero_()
-        self.m[:lr2, :lr] = self.vtnp1[:lr2] @ self.vt[:lr].T
+        if case == "k":
+            # aux_N -> aux_Unp1.T @ aux_U
+            # self.unp1.zero_()
+            self.unp1[:, :lr2] = q
+            #   used in setting s,
+            # self.n.zero_()
+            self.n[:lr2, :lr] = self.unp1[:, :lr2].T @ self.u[:, :lr]
+            if self.rank_bucket:
+                self.unp1[:, lr2:] = 0
+        else:
+            # self.vtnp1.zero_()
+            self.vtnp1[:lr2] = q.T
+            self.m.zero_()
+            self.m[:lr2, :lr] = self.vtnp1[:lr2] @ self.vt[:lr].T
+            if self.rank_bucket:
+                self.vtnp1[lr2:] = 0
+
+    def postprocess_tensors(self, case: str) -> list[Tensor]:
+        lr = self.low_rank
+        lr2 = 2 * self.low_rank
+        ret = []
+        if case in ("k", "kl", "kls"):
+            ret += [self.unp1[:, :lr2], self.n[:lr2, :lr]]
+        if case in ("l", "kl", "kls"):
+            ret += [self.vtnp1[:lr2], self.m[:lr2, :lr]]
+        if case == "kls":
+            ret.append(self.s[:lr2, :lr2])
+        return [t.detach() for t in ret]
+
+    @torch.no_grad()
+    def k_postprocess(self):
+        prev_u = qr(self.postprocess_qr_input("k"), self.linalg_dtype)
+        self.postprocess_from_qr("k", prev_u)
+
+    @torch.no_grad()
+    def l_postprocess(self):
+        aux_Vnp1 = qr(self.postprocess_qr_input("l"), self.linalg_dtype)
+        self.postprocess_from_qr("l", aux_Vnp1)
 
     @torch.no_grad()
     def s_preprocess(self):
@@ -560,36 +742,69 @@ class DLRTLinearAdaptive(DLRTModule):
         self.bias.training = True
 
     @torch.no_grad()
-    def rank_adaption(self, skip=False):
+    def kls_postprocess(self):
+        # parallel integrator: augmented bases from K and L, then the augmented S is assembled
+        #   from the S, K, and L of the same step (no second pass for S):
+        #   S_aug = N @ S @ M.T + Unp1.T @ (I - U @ U.T) @ K @ M.T + N @ Lt @ (I - Vt.T @ Vt) @ Vtnp1.T
+        self.kl_postprocess()
+        self.parallel_s_assemble()
+
+    @torch.no_grad()
+    def parallel_s_assemble(self):
+        # second half of kls_postprocess, after the augmented bases are set
+        lr = self.low_rank
+        lr2 = 2 * self.low_rank
+        u, vt = self.u[:, :lr], self.vt[:lr]
+        n, m = self.n[:lr2, :lr], self.m[:lr2, :lr]
+        k_new = self.k[:, :lr] - u @ (u.T @ self.k[:, :lr])
+        lt_new = self.lt[:lr] - (self.lt[:lr] @ vt.T) @ vt
+        s = torch.linalg.multi_dot([n, self.s[:lr, :lr], m.T])
+        s += (self.unp1[:, :lr2].T @ k_new) @ m.T
+        s += n @ (lt_new @ self.vtnp1[:lr2].T)
+        self.s[:lr2, :lr2] = s
+
+    @torch.no_grad()
+    def rank_adaption_svd_input(self):
+        return self.s[: 2 * self.low_rank, : 2 * self.low_rank]
+
+    @torch.no_grad()
+    def rank_adaption_prepare(self, skip=False):
         # 1) compute SVD of S
         # d=singular values, u2 = left singuar vecs, v2= right singular vecs
         # TODO: 64 bit?
-        s_small = self.s[: 2 * self.low_rank, : 2 * self.low_rank]
         try:
-            u2, sing, vh2 = torch.linalg.svd(s_small, full_matrices=False)
+            u2, sing, vh2 = svd(self.rank_adaption_svd_input(), self.linalg_dtype)
             # driver="gesvdj")
         except torch._C._LinAlgError as e:
             print(f"LinAlgError during SGD -> {e}")
-            return
+            return None
+        return self.rank_adaption_from_svd(u2, sing, vh2, skip=skip)
+
+    @torch.no_grad()
+    def rank_adaption_from_svd(self, u2: Tensor, sing: Tensor, vh2: Tensor, skip=False):
         v2 = vh2.T.to(self.s.dtype, non_blocking=True)
         u2 = u2.to(self.s.dtype, non_blocking=True)
         # d, u2, v2 = tf.linalg.svd(s_small)
+        self._svd = (u2, sing, v2)
+
+        if skip:
+            return self.low_rank
+        # new rank stays on the device, read back by the network for all layers at once
+        #   the rank can grow up to rmax (the size of the buffers)
+        return truncation_rank(
+            sing,
+            self.eps_adapt,
+            criterion=self.truncation,
+            min_rank=2,
+            max_rank=self.rmax,
+            default=self.low_rank,
+        )
 
-        if not skip:
-            # absolute value treshold (try also relative one)
-            tol = self.eps_adapt * torch.linalg.norm(sing)
-            new_lr = sing.shape[0] // 2
-            max_lr = 2 * new_lr - 1
-            for j in range(2, max_lr):
-                tmp = torch.linalg.norm(sing[j : 2 * new_lr - 1])
-                if tmp < tol:
-                    new_lr = j
-                    break
-        else:
-            new_lr = self.low_rank
-
-        # rmax = max(min(rmax, self.rmax), 2)  # -> handled by the 2 in the for loop above
-        # new_sz = int(new_lr * 2)
+    @torch.no_grad()
+    def rank_adaption_apply(self, new_lr: int):
+        u2, sing, v2 = self._svd
+        del self._svd
+        self.last_singular_values = sing
         # update s
         # self.s.zero_()
         self.s[:new_lr, :new_lr] = torch.diag(sing[:new_lr]).to(device=self.s.device, dtype=self.s.dtype)
@@ -597,7 +812,26 @@ class DLRTLinearAdaptive(DLRTModule):
         self.u[:, :new_lr] = self.unp1[:, : 2 * self.low_rank] @ u2[:, :new_lr]
         # self.vt.zero_()
         self.vt[:new_lr] = v2[:new_lr, :] @ self.vtnp1[: 2 * self.low_rank, :]
+        self.rank_stable_steps = self.rank_stable_steps + 1 if new_lr == self.low_rank else 0
         self.low_rank = int(new_lr)
+        if self.rank_bucket:
+            self._zero_rank_padding()
+
+    @torch.no_grad()
+    def _zero_rank_padding(self):
+        # the forward slices to forward_rank >= low_rank, the bases are zero beyond the rank
+        #   -> the padded parts of K, L, and S do not change the output and get no gradients
+        lr = self.low_rank
+        self.u[:, lr:] = 0
+        self.vt[lr:] = 0
+        self.unp1[:, 2 * lr :] = 0
+        self.vtnp1[2 * lr :] = 0
+
+    @torch.no_grad()
+    def rank_adaption(self, skip=False):
+        new_lr = self.rank_adaption_prepare(skip=skip)
+        if new_lr is not None:
+            self.rank_adaption_apply(int(new_lr))
 
     @torch.no_grad()
     def stop_pretraining(self):
@@ -607,8 +841,9 @@ class DLRTLinearAdaptive(DLRTModule):
         # factory = {"dtype": weight.dtype, "device": weight.device}
         # self.to(**factory)
         # fullweight: out x in -> .T : in x out
-        u, sing, vh = torch.linalg.svd(
+        u, sing, vh = svd(
             self.fullweight.T,
+            self.linalg_dtype,
             full_matrices=True,  # FIXME?
             # driver="gesvdj",
         )
@@ -646,3 +881,5 @@ class DLRTLinearAdaptive(DLRTModule):
 
         del self.fullweight
         # self.low_rank = int(new_lr)
+        if self.rank_bucket:
+            self._zero_rank_padding()
@@ -1,5 +1,6 @@
 from __future__ import annotations
 
+import math
 import time
 from collections import namedtuple
 
@@ -11,13 +12,41 @@ from rich.columns import Columns
 from rich.console import Console
 from rich.pretty import Pretty
 
+from . import cost
+from . import export
+from .conv import DLRTConv1d
 from .conv import DLRTConv2d
+from .conv import DLRTConv3d
+from .distributed import BucketedAllReduce
+from .distributed import OwnerBroadcast
+from .distributed import PhaseGradReducer
+from .distributed import assign_owners
+from .embedding import DLRTEmbedding
+from .linalg import GroupedLinalg
 from .linear import DLRTLinear
+from .profiling import PhaseProfiler
 
 console = Console(width=140)
 
 __all__ = ["DLRTNetwork"]
 
+_DLRT_CONVS = {1: DLRTConv1d, 2: DLRTConv2d, 3: DLRTConv3d}
+
+
+def _keep_dense_conv(module: nn.Conv1d | nn.Conv2d | nn.Conv3d) -> bool:
+    # depthwise convolutions (and groups whose blocks are too small for a rank of at least 2) have
+    #   nothing to gain from low-rank factors -> they stay dense
+    if module.groups > 1 and module.groups == module.in_channels:
+        return True
+    in_kern = module.in_channels // module.groups * math.prod(module.kernel_size)
+    return min(module.out_channels // module.groups, in_kern) < 4
+
+
+def _keep_dense_embedding(module: nn.Embedding) -> bool:
+    # max_norm renormalizes the looked up rows of the table in place, which has no factored
+    #   equivalent. below 32 dims, the factors at the smallest rmax (4) are as large as the table
+    return module.max_norm is not None or module.embedding_dim < 32
+
 
 class DLRTNetwork(nn.Module):
     # abstraction of a wrapped torch network. Thiw will be used to call the functions for all the
@@ -32,6 +61,18 @@ class DLRTNetwork(nn.Module):
         dense_first_layer: bool = False,
         dense_last_layer: bool = False,
         pretrain_count: int = 0,
+        truncation: str = "relative",
+        batched_linalg: bool = False,
+        linalg_threads: int = 4,
+        linalg_timing: bool = False,
+        rank_bucket: int = None,
+        conv_forward: str = "conv",
+        linalg_dtype: torch.dtype = None,
+        sync_dlrt_layers: bool = False,
+        sync_bucket_mb: float = 25.0,
+        phase_grad_sync: bool = False,
+        shard_linalg: bool = False,
+        profiler: PhaseProfiler = None,
     ):
         super().__init__()
         self.adaptive = adaptive
@@ -52,6 +93,45 @@ class DLRTNetwork(nn.Module):
         self.adaptive = adaptive
         self.rank_percent = rank_percent
         self.epsilon = epsilon
+        # truncation criterion of the rank adaption, see basic.truncation_rank
+        self.truncation = truncation
+        # conv_forward: forward of the DLRT conv layers, "conv" (rank-r convolution, then 1x1
+        #   convolution) or "unfold" (im2col and matrix products), see conv._FORWARD_IMPLS
+        self.conv_forward = conv_forward
+        # batched_linalg: do the QRs of the postprocessing and the SVDs of the rank adaption for
+        #   all layers with the same shape and rank in one batched call, see linalg.GroupedLinalg
+        # linalg_dtype: precision of the QRs and SVDs, None -> the dtype of the factors, but at least
+        #   fp32 (the factors are fp32 master copies with mixed precision, only the GEMMs of the
+        #   forward and backward run in half precision)
+        self.linalg_dtype = linalg_dtype
+        # sync_dlrt_layers: average the state of the DLRT layers over the processes after every rank
+        #   adaption (the QRs/SVDs of the processes can drift apart). The new ranks are agreed on
+        #   first (max over the processes), then the active rank slices of all layers are
+        #   all-reduced in flat buckets of sync_bucket_mb, overlapping with the rank adaption of the
+        #   remaining layers. sync_stats: collectives and bytes of the last sync
+        self.sync_dlrt_layers = sync_dlrt_layers
+        self.sync_bucket_mb = sync_bucket_mb
+        self.sync_stats = {"collectives": 0, "bytes": 0}
+        # phase_grad_sync: average the gradients with a PhaseGradReducer instead of DDP (only the
+        #   active blocks of the parameters trained in the current phase, in buckets of
+        #   sync_bucket_mb which are all-reduced during the backward), see distributed.py
+        self.phase_grad_sync = phase_grad_sync and dist.is_initialized()
+        self.grad_reducer = None
+        # shard_linalg: the QRs of the postprocessing and the SVDs of the rank adaption of the
+        #   adaptive layers are split between the processes (balanced by the size of the factors),
+        #   the owner of a layer broadcasts the new bases / factors and the new rank -> the state is
+        #   the same on all processes by construction. shard_stats: collectives and bytes of the last
+        #   sharded postprocessing and rank adaption
+        self.shard_linalg = shard_linalg and dist.is_initialized() and dist.get_world_size() > 1
+        self.shard_stats = {}
+        # profiler: timing of the phases (set_layer_case, pre-/postprocessing, rank adaption) and of
+        #   the layers in them, disabled by default (see profiling.PhaseProfiler)
+        self.profiler = profiler if profiler is not None else PhaseProfiler(enabled=False)
+        self.linalg = (
+            GroupedLinalg(num_threads=linalg_threads, timing=linalg_timing, dtype=linalg_dtype)
+            if batched_linalg
+            else None
+        )
 
         # replace linear layers
         self.torch_model = torch_model
@@ -70,6 +150,12 @@ class DLRTNetwork(nn.Module):
         self._dfl_wait = dense_first_layer
 
         self.current_layer_train_case = "pretrain" if self.in_pretrain() else "k"
+        # rank_bucket: the forward of the adaptive layers uses the rank rounded up to a multiple
+        #   of this (zero-padded factors) -> few distinct shapes for torch.compile
+        self.rank_bucket = rank_bucket
+        # set by compile_model
+        self._compile_kwargs = None
+        self.num_compiles = 0
         self.wrap_model()
 
     @torch.no_grad()
@@ -81,50 +167,119 @@ class DLRTNetwork(nn.Module):
         )
         if self.dense_last_layer:
             self.dlrt_model = self._reset_last_layer_to_dense(self.dlrt_model)
+        self.invalidate_layers()
 
-        self.__run_command_on_dlrt_layers(
-            module=self.dlrt_model,
-            command="set_dlrt_requires_grad",
-            kwargs={"requires": False},
-        )
+        self._run_command("set_dlrt_requires_grad", requires=False)
+        if self.rank_bucket:
+            self._run_command("set_rank_bucket", bucket=self.rank_bucket)
+        if self.linalg_dtype is not None:
+            self._run_command("set_linalg_dtype", dtype=self.linalg_dtype)
 
         if dist.is_initialized():
-            # need a seperate DDP instance for each training case, only way to have diff buckets
-            # self.pretrainmodel = torch.nn.parallel.DistributedDataParallel(
-            #     self.dlrt_model,
-            #     find_unused_parameters=False,
-            # )
-
-            self.set_layer_case("k")
-            self.run_preprocess(case="k")
-            self.kmodel = torch.nn.parallel.DistributedDataParallel(
-                self.dlrt_model,
-                find_unused_parameters=True,
-            )
-            self.lmodel = self.kmodel
-            self.smodel = self.kmodel
-            self.pretrainmodel = self.kmodel
-            # self.set_layer_case("l")
-            # self.run_preprocess(case="l")
-            # # self.lmodel = torch.nn.parallel.DistributedDataParallel(
-            # #     self.dlrt_model,
-            # #     find_unused_parameters=False,
-            # # )
-            # self.set_layer_case("s")
-            # self.run_preprocess(case="s")
-            # self.smodel = torch.nn.parallel.DistributedDataParallel(
-            #     self.dlrt_model,
-            #     find_unused_parameters=False,
-            # )
+            self._wrap_ddp()
             for layer in self.dlrt_model.children():
                 if hasattr(layer, "reset_parameters"):
                     layer.reset_parameters()
+            if self.grad_reducer is not None:
+                # no DDP broadcast -> same starting point on all processes
+                self.grad_reducer.broadcast_parameters()
         else:
             # pass
             self.pretrainmodel = self.dlrt_model
             self.kmodel = self.dlrt_model
             self.lmodel = self.dlrt_model
             self.smodel = self.dlrt_model
+            # parallel integrator cases
+            self.klmodel = self.dlrt_model
+            self.klsmodel = self.dlrt_model
+        # the initial factors beyond the starting ranks are never used
+        self.zero_beyond_rank(force=True)
+
+    def _wrap_ddp(self):
+        self.invalidate_layers()
+        if self.phase_grad_sync:
+            # the gradients are averaged by the PhaseGradReducer, no DDP wrapper
+            for case in ("pretrain", "k", "l", "s", "kl", "kls"):
+                setattr(self, f"{case}model", self.dlrt_model)
+            if self.grad_reducer is None:
+                self.grad_reducer = PhaseGradReducer(self, bucket_mb=self.sync_bucket_mb)
+            else:
+                self.grad_reducer.refresh()
+            if self._compile_kwargs is not None:
+                self._compile_case_models()
+            return
+        # need a seperate DDP instance for each training case, only way to have diff buckets
+        # self.pretrainmodel = torch.nn.parallel.DistributedDataParallel(
+        #     self.dlrt_model,
+        #     find_unused_parameters=False,
+        # )
+
+        self.set_layer_case("k")
+        self.run_preprocess(case="k")
+        self.kmodel = torch.nn.parallel.DistributedDataParallel(
+            self.dlrt_model,
+            find_unused_parameters=True,
+        )
+        self.lmodel = self.kmodel
+        self.smodel = self.kmodel
+        self.pretrainmodel = self.kmodel
+        # parallel integrator cases
+        self.klmodel = self.kmodel
+        self.klsmodel = self.kmodel
+        if self._compile_kwargs is not None:
+            self._compile_case_models()
+        # self.set_layer_case("l")
+        # self.run_preprocess(case="l")
+        # # self.lmodel = torch.nn.parallel.DistributedDataParallel(
+        # #     self.dlrt_model,
+        # #     find_unused_parameters=False,
+        # # )
+        # self.set_layer_case("s")
+        # self.run_preprocess(case="s")
+        # self.smodel = torch.nn.parallel.DistributedDataParallel(
+        #     self.dlrt_model,
+        #     find_unused_parameters=False,
+        # )
+
+    def compile_model(self, backend="inductor", **compile_kwargs):
+        """
+        Compile the forward of the network with torch.compile.
+
+        The training case of the layers is a plain string -> every case is its own specialized
+        graph which is reused across steps. The ranks are Python ints and change with the rank
+        adaption, which triggers a recompile for every new rank. Use `rank_bucket` to limit the
+        number of distinct ranks (and raise torch._dynamo.config.cache_size_limit if needed).
+        The number of compiled graphs (first compiles and recompiles) is counted in
+        `num_compiles`.
+
+        Parameters
+        ----------
+        backend: str or callable
+            torch.compile backend
+        compile_kwargs:
+            passed to torch.compile
+        """
+        self._compile_kwargs = {"backend": backend, **compile_kwargs}
+        self._compile_case_models()
+
+    def _compile_case_models(self):
+        kwargs = self._compile_kwargs.copy()
+        backend = kwargs.pop("backend")
+        if isinstance(backend, str):
+            backend = torch._dynamo.lookup_backend(backend)
+
+        def counting_backend(gm, example_inputs):
+            self.num_compiles += 1
+            return backend(gm, example_inputs)
+
+        # all cases use the same (DDP) model -> compile it once
+        model = torch.compile(self.kmodel, backend=counting_backend, **kwargs)
+        self.kmodel = model
+        self.lmodel = model
+        self.smodel = model
+        self.pretrainmodel = model
+        self.klmodel = model
+        self.klsmodel = model
 
     def _replace_layers(self, module, pretrain=False, name=None, process_group=None):
         module_output = module
@@ -140,13 +295,16 @@ class DLRTNetwork(nn.Module):
                     low_rank_percent=self.rank_percent,
                     eps_adapt=self.epsilon["linear"],
                     pretrain=pretrain,
+                    truncation=self.truncation,
                 ).to(device=module.weight.device, dtype=module.weight.dtype)
-                self.reset_layers = [module, name]
+                self.reset_layers = [module, name, module_output]
             else:  # dont wait -> is first layer -> should be dense
                 self._dfl_wait = False
-        elif isinstance(module, nn.Conv2d):
+        elif isinstance(module, (nn.Conv1d, nn.Conv2d, nn.Conv3d)) and not _keep_dense_conv(module):
             if not self._dfl_wait:  # if not waiting i.e. already past the first layer
-                module_output = DLRTConv2d(
+                # epsilon["conv1d"] / ["conv3d"] are optional, the conv2d value is the default
+                ndim = len(module.kernel_size)
+                module_output = _DLRT_CONVS[ndim](
                     adaptive=self.adaptive,
                     low_rank_percent=self.rank_percent,
                     in_channels=module.in_channels,
@@ -158,13 +316,32 @@ class DLRTNetwork(nn.Module):
                     groups=module.groups,
                     bias=module.bias is not None,
                     padding_mode=module.padding_mode,
-                    eps_adapt=self.epsilon["conv2d"],
+                    eps_adapt=self.epsilon.get(f"conv{ndim}d", self.epsilon["conv2d"]),
                     pretrain=pretrain,
+                    truncation=self.truncation,
+                    # the unfold forward is only implemented for 2D convolutions
+                    forward_impl=self.conv_forward if ndim == 2 else "conv",
                 ).to(device=module.weight.device, dtype=module.weight.dtype)
-                self.reset_layers = [module, name]
+                self.reset_layers = [module, name, module_output]
                 # del module
             else:  # dont wait -> is first layer -> should be dense
                 self._dfl_wait = False
+        elif isinstance(module, nn.Embedding) and self.adaptive and not _keep_dense_embedding(module):
+            if not self._dfl_wait:  # if not waiting i.e. already past the first layer
+                # epsilon["embedding"] is optional, the linear value is the default
+                module_output = DLRTEmbedding(
+                    num_embeddings=module.num_embeddings,
+                    embedding_dim=module.embedding_dim,
+                    padding_idx=module.padding_idx,
+                    scale_grad_by_freq=module.scale_grad_by_freq,
+                    sparse=module.sparse,
+                    low_rank_percent=self.rank_percent,
+                    eps_adapt=self.epsilon.get("embedding", self.epsilon["linear"]),
+                    pretrain=pretrain,
+                    truncation=self.truncation,
+                ).to(device=module.weight.device, dtype=module.weight.dtype)
+            else:  # dont wait -> is first layer -> should be dense
+                self._dfl_wait = False
 
         for name, child in module.named_children():
             module_output.add_module(
@@ -183,7 +360,9 @@ class DLRTNetwork(nn.Module):
         # if dist.get_rank() == 0:
         #     print("replace", name)
         module_output = module
-        if name == self.reset_layers[1]:
+        # match the replaced layer itself, child names like "1" are not unique (e.g. BatchNorm in
+        #   torchvision's ConvNormActivation blocks)
+        if module is self.reset_layers[2]:
             if hasattr(module, "weight"):
                 device = module.weight.device
                 dtype = module.weight.dtype
@@ -211,61 +390,331 @@ class DLRTNetwork(nn.Module):
 
     def set_layer_case(self, case):
         # set the training case of all DLRT layers (conv/linear)
-        models = [self.dlrt_model]
-        # self.optimizer.zero_grad(set_to_none=True)
-        # self.dlrt_model.train()
-        if case == "k":
-            try:
-                models.append(getattr(self, "kmodel"))
-                # self._set_training_all_params(network=self.kmodel, totrain=True)
-            except AttributeError:
-                pass
-        if case == "l":
-            # turn off training on all layers
-            # self.dlrt_model.eval()
-            # self._set_training_all_params(network=self.dlrt_model, totrain=False)
-            try:
-                models.append(getattr(self, "kmodel"))
-                # self._set_training_all_params(network=self.lmodel, totrain=False)
-            except AttributeError:
-                pass
-        else:  # s case -> train all layers, turn off training of K and L
-            # self.dlrt_model.train()
-            # self._set_training_all_params(network=self.dlrt_model, totrain=True)
-            try:
-                # self.smodel.train()
-                # self._set_training_all_params(network=self.smodel, totrain=False)
-                models.append(self.smodel)
-            except AttributeError:
-                pass
-
-        for m in models:
-            self.__run_command_on_dlrt_layers(
-                module=m,
-                command="change_training_case",
-                kwargs={"case": case},
-            )
-            # self.__run_command_on_dlrt_layers(module=m, command="train")
+        #   the k/l/s models (DDP) wrap the same layers as dlrt_model -> one pass is enough
+        with self.profiler.phase("set_layer_case"):
+            for change_training_case in self._commands("change_training_case"):
+                change_training_case(case=case)
 
     def run_preprocess(self, case):
         # prev: getattr(self, f"{case}model")
-        self.__run_command_on_dlrt_layers(module=self.dlrt_model, command=f"{case}_preprocess")
+        with self.profiler.phase(f"{case}_preprocess"):
+            self._run_command(f"{case}_preprocess")
 
     def run_postprocess(self, case):
-        self.__run_command_on_dlrt_layers(module=self.dlrt_model, command=f"{case}_postprocess")
+        with self.profiler.phase(f"{case}_postprocess"):
+            if self.shard_linalg and case in ("k", "l", "kl", "kls"):
+                self._sharded_postprocess(case)
+            elif self.linalg is not None and case in ("k", "l", "kl", "kls"):
+                self.linalg.postprocess(self._dlrt_layers(), case)
+            else:
+                self._run_command(f"{case}_postprocess")
+
+    def close(self):
+        """
+        Shut down the thread pool of the batched linalg (see GroupedLinalg.close), call it when the
+        network is not trained anymore
+        """
+        if self.linalg is not None:
+            self.linalg.close()
+
+    def invalidate_layers(self):
+        """
+        Drop the cached layer registry, it is rebuilt on the next use. Call it whenever the DLRT layers
+        of `dlrt_model` or their parameters are replaced (wrap_model, compact_factors, loading a
+        checkpoint do it already).
+        """
+        self._layer_names = None
+        self._layer_paths = None
+        self._layers = None
+        self._dispatch = {}
+
+    def _build_layer_registry(self):
+        # flat list of all DLRT layers (in module order) -> no tree walk for every command
+        named = [
+            (name, module) for name, module in self.dlrt_model.named_modules() if hasattr(module, "dlrt")
+        ]
+        self._layer_names = [name.rsplit(".", 1)[-1] if name else None for name, _ in named]
+        self._layer_paths = [name for name, _ in named]
+        self._layers = [module for _, module in named]
+        # bound methods of the layers per command, filled on first use
+        self._dispatch = {}
+
+    def _dlrt_layers(self):
+        if self._layers is None:
+            self._build_layer_registry()
+        return self._layers
+
+    def _commands(self, command):
+        # bound `command` methods of all DLRT layers
+        #   NOTE: the command must be a member function of DLRTModule
+        layers = self._dlrt_layers()
+        try:
+            return self._dispatch[command]
+        except KeyError:
+            table = self._dispatch[command] = [getattr(layer, command) for layer in layers]
+            return table
+
+    def _run_command(self, command, **kwargs):
+        if self.profiler.enabled and self.profiler.per_layer:
+            commands = self._commands(command)
+            for path, fn in zip(self._layer_paths, commands):
+                with self.profiler.layer_phase(command, path):
+                    fn(**kwargs)
+            return
+        for fn in self._commands(command):
+            fn(**kwargs)
+
+    def _syncing(self) -> bool:
+        return self.sync_dlrt_layers and dist.is_initialized() and dist.get_world_size() > 1
+
+    def _linalg_owners(self, layers) -> list:
+        # process which runs the QRs/SVDs of each layer (None -> all processes run them)
+        #   cost ~ (size of the factors) * rank, i.e. the flops of the QR of an n x 2r matrix
+        shardable = [layer.postprocess_tensors("k") is not None for layer in layers]
+        costs = [
+            sum(math.prod(shape) for shape in layer.checkpoint_shapes().values()) * layer.low_rank
+            for layer, ok in zip(layers, shardable)
+            if ok
+        ]
+        owners = iter(assign_owners(costs, dist.get_world_size()))
+        return [next(owners) if ok else None for ok in shardable]
+
+    @torch.no_grad()
+    def _sharded_postprocess(self, case):
+        layers = self._dlrt_layers()
+        owners = self._linalg_owners(layers)
+        local = [layer for layer, owner in zip(layers, owners) if owner in (None, self.rank)]
+        if self.linalg is not None:
+            self.linalg.postprocess(local, case)
+        else:
+            for layer in local:
+                getattr(layer, f"{case}_postprocess")()
+        bcast = OwnerBroadcast()
+        for layer, owner in zip(layers, owners):
+            if owner is not None:
+                bcast.add(owner, layer.postprocess_tensors(case))
+        bcast.wait()
+        for layer, owner in zip(layers, owners):
+            if owner not in (None, self.rank) and layer.rank_bucket:
+                layer._zero_rank_padding()
+        self.shard_stats["postprocess"] = {"collectives": bcast.num_collectives, "bytes": bcast.num_bytes}
+
+    @torch.no_grad()
+    def _sharded_rank_adaption(self, skip=False):
+        # the owners run the SVDs, the new ranks are shared in one all_reduce (-1 on the other
+        #   processes), then the owners broadcast the new U, S, Vt
+        layers = self._dlrt_layers()
+        owners = self._linalg_owners(layers)
+        local = [layer for layer, owner in zip(layers, owners) if owner in (None, self.rank)]
+        if self.linalg is not None:
+            pending, new_ranks = self.linalg.rank_adaption_prepare(local, skip=skip)
+        else:
+            pending, new_ranks = [], []
+            for module in local:
+                new_rank = module.rank_adaption_prepare(skip=skip)
+                if new_rank is not None:
+                    pending.append(module)
+                    new_ranks.append(new_rank)
+        device = next(self.dlrt_model.parameters()).device
+        proposed = torch.full((len(layers),), -1, dtype=torch.int64, device=device)
+        index = {id(layer): i for i, layer in enumerate(layers)}
+        for module, new_rank in zip(pending, new_ranks):
+            proposed[index[id(module)]] = torch.as_tensor(new_rank).to(device=device, dtype=torch.int64)
+        dist.all_reduce(proposed, op=dist.ReduceOp.MAX)
+        agreed = proposed.tolist()
+
+        for module in pending:
+            module.rank_adaption_apply(agreed[index[id(module)]])
+        bcast = OwnerBroadcast()
+        received = []
+        for i, (module, owner) in enumerate(zip(layers, owners)):
+            # -1: the SVD of the owner failed, the layer stays as it is everywhere
+            if owner is None or agreed[i] < 0:
+                continue
+            if owner != self.rank:
+                # same bookkeeping as rank_adaption_apply
+                module.rank_stable_steps = module.rank_stable_steps + 1 if agreed[i] == module.low_rank else 0
+                module.low_rank = agreed[i]
+                received.append(module)
+            bcast.add(owner, module.sync_tensors())
+        bcast.wait()
+        for module in received:
+            if module.rank_bucket:
+                module._zero_rank_padding()
+        self.shard_stats["rank_adaption"] = {
+            "collectives": bcast.num_collectives + 1,
+            "bytes": bcast.num_bytes + proposed.nbytes,
+        }
 
+    @torch.no_grad()
+    def zero_beyond_rank(self, optimizer=None, force: bool = False):
+        """
+        Zero the factors and the optimizer state beyond the rank of all DLRT layers, see
+        DLRTModule.zero_beyond_rank (called by DLRTTrainer after every rank adaption)
+        """
+        self._run_command("zero_beyond_rank", optimizer=optimizer, force=force)
+
+    def _agree_on_ranks(self) -> bool:
+        # the synced state and the gradient buckets of the PhaseGradReducer need the same ranks
+        return self._syncing() or self.grad_reducer is not None
+
+    @torch.no_grad()
     def run_rank_adaption(self, skip=False, all_reduce_method="average"):
-        self.__run_command_on_dlrt_layers(
-            module=self.dlrt_model,
-            command="rank_adaption",
-            kwargs={"skip": skip},
+        with self.profiler.phase("rank_adaption"):
+            self._run_rank_adaption(skip=skip, all_reduce_method=all_reduce_method)
+
+    def _run_rank_adaption(self, skip=False, all_reduce_method="average"):
+        # the new ranks stay on the device until all layers are done, then they are read back to
+        #   the host at once (one sync per step instead of one per layer)
+        if self._syncing() and all_reduce_method != "average":
+            raise ValueError(f"invalid all reduce method: {all_reduce_method}")
+        if self.shard_linalg:
+            # same state on all processes by construction, nothing to average
+            return self._sharded_rank_adaption(skip=skip)
+        if self.linalg is not None:
+            pending, new_ranks = self.linalg.rank_adaption_prepare(self._dlrt_layers(), skip=skip)
+        else:
+            pending, new_ranks = [], []
+            layers = self._dlrt_layers()
+            for path, module in zip(self._layer_paths, layers):
+                with self.profiler.layer_phase("rank_adaption_prepare", path):
+                    new_rank = module.rank_adaption_prepare(skip=skip)
+                if new_rank is not None:
+                    pending.append(module)
+                    new_ranks.append(new_rank)
+        if self._agree_on_ranks():
+            return self._apply_synced_ranks(pending, new_ranks)
+        on_device = [i for i, r in enumerate(new_ranks) if torch.is_tensor(r)]
+        if on_device:
+            device = new_ranks[on_device[0]].device
+            host = torch.stack([new_ranks[i].to(device) for i in on_device]).tolist()
+            for i, rank in zip(on_device, host):
+                new_ranks[i] = rank
+        for module, new_rank in zip(pending, new_ranks):
+            module.rank_adaption_apply(int(new_rank))
+
+    def _apply_synced_ranks(self, pending, new_ranks):
+        # same rank on all processes (max), -1: the SVD failed / no rank adaption on this process
+        layers = self._dlrt_layers()
+        device = next(self.dlrt_model.parameters()).device
+        proposed = torch.full((len(layers),), -1, dtype=torch.int64, device=device)
+        index = {id(layer): i for i, layer in enumerate(layers)}
+        for module, new_rank in zip(pending, new_ranks):
+            proposed[index[id(module)]] = torch.as_tensor(new_rank).to(device=device, dtype=torch.int64)
+        dist.all_reduce(proposed, op=dist.ReduceOp.MAX)
+        agreed = proposed.tolist()
+
+        sync_state = self._syncing()
+        reducer = BucketedAllReduce(bucket_bytes=int(self.sync_bucket_mb * 2**20))
+        applied = set()
+        # the buckets of the updated layers are all-reduced while the next layers are updated
+        for module in pending:
+            module.rank_adaption_apply(agreed[index[id(module)]])
+            if sync_state:
+                reducer.add(module.sync_tensors())
+            applied.add(id(module))
+        for i, module in enumerate(layers):
+            if id(module) in applied:
+                continue
+            if agreed[i] >= 0 and hasattr(module, "low_rank"):
+                # the rank adaption failed here but not on other processes: the slices need the same
+                #   shape everywhere, the averaging fills them in
+                module.low_rank = agreed[i]
+            if sync_state:
+                reducer.add(module.sync_tensors())
+        reducer.wait()
+        self.sync_stats = {"collectives": reducer.num_collectives + 1, "bytes": reducer.num_bytes}
+
+    @torch.no_grad()
+    def sync_layers(self):
+        """
+        Average the active state of all DLRT layers over the processes (see sync_dlrt_layers)
+        """
+        if not dist.is_initialized() or dist.get_world_size() == 1:
+            return
+        reducer = BucketedAllReduce(bucket_bytes=int(self.sync_bucket_mb * 2**20))
+        for module in self._dlrt_layers():
+            reducer.add(module.sync_tensors())
+        reducer.wait()
+        self.sync_stats = {"collectives": reducer.num_collectives, "bytes": reducer.num_bytes}
+
+    @torch.no_grad()
+    def compact_factors(self, optimizer=None, margin: float = 0.1, patience: int = 100) -> bool:
+        """
+        Shrink the factors of all adaptive layers whose rank has been stable for `patience` rank
+        adaptions to the current rank plus a growth `margin` (fraction of the rank). The optimizer
+        state of the factors is cut down with them and DDP is re-wrapped around the new parameters.
+
+        Returns
+        -------
+        if any layer was reallocated
+        """
+        layers, proposed = [], []
+        for module in self._dlrt_layers():
+            rmax = module.compacted_rmax(margin=margin, patience=patience)
+            if rmax is not None:
+                layers.append(module)
+                proposed.append(rmax)
+        if not layers:
+            return False
+        if dist.is_initialized():
+            # DDP needs the same shapes on all processes -> use the largest rmax of all processes
+            device = next(self.dlrt_model.parameters()).device
+            proposed = torch.tensor(proposed, dtype=torch.int64, device=device)
+            dist.all_reduce(proposed, op=dist.ReduceOp.MAX)
+            proposed = proposed.tolist()
+
+        changed = False
+        for layer, rmax in zip(layers, proposed):
+            changed |= layer.shrink_to_fit(rmax, optimizer=optimizer)
+        if changed:
+            # new parameters -> the cached layer commands are rebuilt
+            self.invalidate_layers()
+            if dist.is_initialized():
+                self._wrap_ddp()
+            if torch.cuda.is_available():
+                # give the freed memory back to the device
+                torch.cuda.empty_cache()
+        return changed
+
+    def export_inference(self, dense_threshold: float = 1.0, fold_batchnorm: bool = True) -> nn.Module:
+        """
+        Create a deploy-only copy of the network: every DLRT layer is replaced by two plain layers of
+        the current rank (or one dense layer past the break-even point, scaled by
+        `dense_threshold`), BatchNorm is folded where possible. See `dlrt.export`.
+        """
+        return export.export_inference(
+            self.dlrt_model, dense_threshold=dense_threshold, fold_bn=fold_batchnorm
         )
-        # self.__run_command_on_dlrt_layers(
-        #     module=self.dlrt_model, command="all_reduce", kwargs={"method": all_reduce_method}
-        # )
+
+    def inference_report(self, exported: nn.Module, example_input, repeats: int = 20) -> dict:
+        """
+        Stored values, FLOPs, and latency of the `exported` model vs. this network and its dense
+        equivalent, see `dlrt.export.inference_report`
+        """
+        return export.inference_report(self, exported, example_input, repeats=repeats)
+
+    def cost_report(self, example_input=None, print_report: bool = False) -> dict:
+        """
+        Parameters, memory, and FLOPs (per training case and for inference) of the DLRT layers at
+        their current ranks vs. the dense layers, per layer and in total, see `dlrt.cost.cost_report`
+        """
+        return cost.cost_report(self, example_input=example_input, print_report=print_report)
 
     def stop_pretraining(self):
-        self.__run_command_on_dlrt_layers(module=self.dlrt_model, command="stop_pretraining")
+        self._run_command("stop_pretraining")
+        if self.shard_linalg:
+            # the SVDs of the dense weights can differ between the processes -> take the owners'
+            layers = self._dlrt_layers()
+            bcast = OwnerBroadcast()
+            for layer, owner in zip(layers, self._linalg_owners(layers)):
+                if owner is not None:
+                    bcast.add(owner, layer.sync_tensors())
+            bcast.wait()
+        elif self._syncing():
+            # the SVDs of the dense weights can differ between the processes
+            self.sync_layers()
+        self.zero_beyond_rank(force=True)
 
     def train(self, mode: bool = True):
         if not isinstance(mode, bool):
@@ -292,41 +741,18 @@ class DLRTNetwork(nn.Module):
     def eval(self):
         return self.train(False)
 
-    def __run_command_on_dlrt_layers(self, module, command, kwargs=None):
-        # NOTE: the command must be a member function of DLRTModule
-        if kwargs is None:
-            kwargs = {}
-
-        if hasattr(module, "dlrt"):
-            getattr(module, command)(**kwargs)
-
-        for name, child in module.named_children():
-            self.__run_command_on_dlrt_layers(child, command, kwargs)
-
-    def __collect_ranks(self, module, name=None):
-        if hasattr(module, "dlrt"):
-            # lst = [name, None, None]
-
-            # perc, rnk = module.get_rank_percentage()
-            # lst[1] = perc
-            # lst[2] = rnk
-            self.ranks.append(f"{name} {module.get_rank_percentage()}")
-            # self.ranks.append(lst)
-
-        for name, child in module.named_children():
-            self.__collect_ranks(child, name)
-
     def get_all_ranks(self):
-        self.ranks = []
-        self.__collect_ranks(self.dlrt_model)
-        out_ranks = self.ranks.copy()
-        self.ranks = []
-        return out_ranks
+        layers = self._dlrt_layers()
+        return [f"{name} {layer.get_rank_percentage()}" for name, layer in zip(self._layer_names, layers)]
 
     def __call__(self, inputs, case):
         # if pretrain:
         #     return self.premodel(inputs)
         # if case != self.current_layer_train_case:
         #     self.set_layer_case(case=case)
-        with getattr(self, f"{case}model").no_sync():
-            return getattr(self, f"{case}model")(inputs)
+        model = getattr(self, f"{case}model")
+        if not dist.is_initialized() or self.grad_reducer is not None:
+            # no DDP wrapper -> no no_sync
+            return model(inputs)
+        with model.no_sync():
+            return model(inputs)
@@ -0,0 +1,171 @@
+from __future__ import annotations
+
+import contextlib
+import json
+import time
+from collections import defaultdict
+from collections import deque
+
+import torch
+from rich.console import Console
+from rich.table import Table
+
+console = Console(width=140)
+
+__all__ = ["PhaseProfiler"]
+
+# returned by `phase` when the profiler is off -> a disabled profiler costs one attribute check
+_NULL = contextlib.nullcontext()
+
+
+class PhaseProfiler:
+    """
+    Opt-in timing of the phases of DLRT training (set_layer_case, pre-/postprocessing, forward,
+    backward, gradient sync, optimizer step, rank adaption, ...) and optionally of every layer in
+    the pre-/postprocessing and the rank adaption.
+
+    Every phase is a `torch.profiler.record_function` range (named "dlrt::<phase>", visible in
+    torch.profiler traces) and its wall time is kept in a rolling window of the last `window`
+    calls. `report` gives the statistics per phase, `dump` writes them as a JSON line or prints
+    them, every `dump_every` steps this is done automatically (see `step`).
+
+    On the GPU, the phases are asynchronous: without `sync_cuda`, the times are the ones of the
+    host (launches and the host syncs in the phase). `sync_cuda` synchronizes the device around
+    every phase, which is accurate but slows down the training.
+
+    When disabled, `phase` returns a shared null context, i.e. the profiler can stay in the code.
+
+    Parameters
+    ----------
+    enabled: bool
+    window: int
+        number of calls per phase which the statistics are computed from
+    per_layer: bool
+        also time every layer in the pre-/postprocessing and the rank adaption (the layers which are
+        batched by the GroupedLinalg engine are not timed one by one)
+    sync_cuda: bool
+        synchronize the device before and after every phase
+    dump_every: int
+        dump the report every this many steps (0 -> never)
+    dump_path: str
+        JSON lines file for the dumps, None -> print them (rich table)
+    """
+
+    def __init__(
+        self,
+        enabled: bool = True,
+        window: int = 100,
+        per_layer: bool = False,
+        sync_cuda: bool = False,
+        dump_every: int = 0,
+        dump_path: str = None,
+    ):
+        self.enabled = enabled
+        self.window = window
+        self.per_layer = per_layer
+        self.sync_cuda = sync_cuda and torch.cuda.is_available()
+        self.dump_every = dump_every
+        self.dump_path = dump_path
+        # phase -> durations (seconds) of the last `window` calls, and the totals of all calls
+        self._times = defaultdict(lambda: deque(maxlen=self.window))
+        self._totals = defaultdict(lambda: [0, 0.0])
+        self.steps = 0
+
+    def phase(self, name: str):
+        """
+        Context manager around a phase, e.g. `with profiler.phase("k_forward"): ...`
+        """
+        if not self.enabled:
+            return _NULL
+        return self._timed(name)
+
+    def layer_phase(self, name: str, layer: str):
+        # per-layer range, only if per_layer is set
+        if not self.enabled or not self.per_layer:
+            return _NULL
+        return self._timed(f"{name}/{layer}")
+
+    @contextlib.contextmanager
+    def _timed(self, name: str):
+        if self.sync_cuda:
+            torch.cuda.synchronize()
+        with torch.profiler.record_function(f"dlrt::{name}"):
+            start = time.perf_counter()
+            try:
+                yield
+            finally:
+                if self.sync_cuda:
+                    torch.cuda.synchronize()
+                self.record(name, time.perf_counter() - start)
+
+    def record(self, name: str, seconds: float):
+        # add a measurement which was taken elsewhere
+        self._times[name].append(seconds)
+        total = self._totals[name]
+        total[0] += 1
+        total[1] += seconds
+
+    def step(self):
+        # end of a training step, dumps the report every `dump_every` steps
+        if not self.enabled:
+            return
+        self.steps += 1
+        if self.dump_every and self.steps % self.dump_every == 0:
+            self.dump()
+
+    def report(self, prefix: str = None) -> dict:
+        """
+        Statistics per phase (the phases starting with `prefix`, default: all): number of calls
+        and total seconds of all calls, mean, median, p90, and max milliseconds over the window
+        """
+        out = {}
+        for name, times in self._times.items():
+            if prefix is not None and not name.startswith(prefix):
+                continue
+            ordered = sorted(times)
+            calls, total = self._totals[name]
+            out[name] = {
+                "calls": calls,
+                "total_s": total,
+                "mean_ms": 1e3 * sum(ordered) / len(ordered),
+                "median_ms": 1e3 * ordered[len(ordered) // 2],
+                "p90_ms": 1e3 * ordered[min(len(ordered) - 1, int(0.9 * len(ordered)))],
+                "max_ms": 1e3 * ordered[-1],
+            }
+        return out
+
+    def mean_ms(self, name: str) -> float | None:
+        # rolling mean of a phase, None if it was not recorded
+        times = self._times.get(name)
+        return 1e3 * sum(times) / len(times) if times else None
+
+    def dump(self):
+        """
+        Append the report (with the step) to `dump_path` as a JSON line, or print it
+        """
+        if self.dump_path is None:
+            self.print_report()
+            return
+        with open(self.dump_path, "a") as f:
+            f.write(json.dumps({"step": self.steps, "time": time.time(), "phases": self.report()}) + "\n")
+
+    def print_report(self, prefix: str = None):
+        table = Table(title=f"DLRT phases (step {self.steps}, last {self.window} calls)")
+        for col in ("phase", "calls", "total [s]", "mean [ms]", "median [ms]", "p90 [ms]", "max [ms]"):
+            table.add_column(col)
+        for name, st in self.report(prefix).items():
+            table.add_row(
+                name,
+                str(st["calls"]),
+                f"{st['total_s']:.3f}",
+                f"{st['mean_ms']:.3f}",
+                f"{st['median_ms']:.3f}",
+                f"{st['p90_ms']:.3f}",
+                f"{st['max_ms']:.3f}",
+            )
+        console.print(table)
+
+    def reset(self):
+        self._times.clear()
+        self._totals.clear()
+        self.steps = 0
@@ -11,7 +11,10 @@ from rich.columns import Columns
 from rich.console import Console
 from rich.pretty import Pretty
 
+from . import checkpoint
+from .history import RankHistory
 from .network import DLRTNetwork
+from .profiling import PhaseProfiler
 
 console = Console(width=140)
 
@@ -36,6 +39,24 @@ class DLRTTrainer:
         dense_first_layer: bool = False,
         dense_last_layer: bool = False,
         pretrain_count: int = -1,
+        compact_factors: bool = False,
+        compact_margin: float = 0.1,
+        compact_patience: int = 100,
+        integrator: str = "sequential",
+        truncation: str = "relative",
+        batched_linalg: bool = False,
+        rank_bucket: int = None,
+        compile_model: bool = False,
+        compile_backend: str = "inductor",
+        conv_forward: str = "conv",
+        amp_dtype: torch.dtype | str = None,
+        linalg_dtype: torch.dtype = None,
+        sync_dlrt_layers: bool = False,
+        phase_grad_sync: bool = False,
+        shard_linalg: bool = False,
+        profiler: PhaseProfiler | bool = None,
+        rank_history: RankHistory | str = None,
+        print_ranks: int = 0,
     ):
         if epsilon is None:
             epsilon = {"linear": 0.1, "conv2d": 0.1}
@@ -58,11 +79,34 @@ class DLRTTrainer:
         if split_batch not in ["repeat", "halfs", "thirds"]:
             raise ValueError("Unsupported option for split batch")
         self.split_batch = split_batch
+        # integrator: how the K, L, and S steps are run for each batch
+        #   sequential: K, L, then S in 3 passes
+        #   parallel: K and L from one shared pass (same starting point), then S in a second pass
+        #   parallel-folded: K, L, and S from one shared pass, the augmented S is assembled from
+        #       them (parallel rank-adaptive integrator), only for adaptive layers
+        if integrator not in ["sequential", "parallel", "parallel-folded"]:
+            raise ValueError(
+                f"integrator must be one of sequential, parallel, or parallel-folded, not: {integrator}",
+            )
+        if integrator != "sequential" and split_batch == "thirds":
+            raise ValueError("split_batch='thirds' is only supported by the sequential integrator")
+        if integrator == "parallel-folded" and not adaptive:
+            raise ValueError("the parallel-folded integrator requires adaptive layers")
+        self.integrator = integrator
+        # batched_linalg: batch the QRs/SVDs of layers with the same shape and rank, the timing of
+        #   the phases is in self.dlrt_model.linalg.report()
 
         # replace linear layers
         self.torch_model = torch_model
         self.counter = 0
         self.pretrain_count = pretrain_count  # total number of pretraining steps
+        # compact_factors: reallocate the factors of the adaptive layers to their current rank
+        #   (+ compact_margin * rank) once their rank has been stable for compact_patience rank
+        #   adaptions. this is checked every compact_patience steps
+        self.compact_factors = compact_factors
+        self.compact_margin = compact_margin
+        self.compact_patience = compact_patience
+        self._init_monitoring(profiler, rank_history, print_ranks)
 
         self.dlrt_model = DLRTNetwork(
             torch_model=torch_model,
@@ -73,7 +117,20 @@ class DLRTTrainer:
             dense_first_layer=dense_first_layer,
             dense_last_layer=dense_last_layer,
             pretrain_count=pretrain_count,
+            truncation=truncation,
+            batched_linalg=batched_linalg,
+            rank_bucket=rank_bucket,
+            conv_forward=conv_forward,
+            linalg_dtype=linalg_dtype,
+            sync_dlrt_layers=sync_dlrt_layers,
+            phase_grad_sync=phase_grad_sync,
+            shard_linalg=shard_linalg,
+            profiler=self.profiler,
         )
+        # compile_model: torch.compile the network (see DLRTNetwork.compile_model), use with a
+        #   rank_bucket (e.g. 8, 16, 32) to avoid recompiling after every rank change
+        if compile_model:
+            self.dlrt_model.compile_model(backend=compile_backend)
         self.in_pretrain = lambda: self.counter < self.pretrain_count
 
         # need to rinit the optimizer with the new DLRT parameters
@@ -88,19 +145,74 @@ class DLRTTrainer:
             print(Pretty({"Optimizer": optimizer_name, **optimizer_kwargs}))
 
         self.scheduler = scheduler
-        self.mixed_precision = mixed_precision
-        if mixed_precision:
-            # TODO: should there be different scalers for different parameters?
-            #       i.e. -> one for k, onr for s, one for l
-            self.kscaler = torch.cuda.amp.GradScaler()
-            self.lscaler = torch.cuda.amp.GradScaler()
-            self.sscaler = torch.cuda.amp.GradScaler()
-            self.prescaler = torch.cuda.amp.GradScaler()
+        self._init_mixed_precision(mixed_precision, amp_dtype)
 
         self.return_tuple = namedtuple("Trainer", ["loss", "output"])
 
         self.rank = 0 if not dist.is_initialized() else dist.get_rank()
 
+    def _init_monitoring(self, profiler, rank_history, print_ranks: int):
+        # profiler: timing of the phases of the training steps, True -> PhaseProfiler() with the
+        #   defaults. query with self.profiler.report(), see profiling.PhaseProfiler
+        if isinstance(profiler, bool) or profiler is None:
+            profiler = PhaseProfiler(enabled=bool(profiler))
+        self.profiler = profiler
+        # rank_history: record the ranks, tolerances, and singular values of all layers after every
+        #   rank adaption (on the first process), a path -> RankHistory(path). call
+        #   self.rank_history.close() at the end of the training to write the last records
+        # print_ranks: print the ranks of all layers every this many steps (0 -> never)
+        if isinstance(rank_history, str):
+            first = not dist.is_initialized() or dist.get_rank() == 0
+            rank_history = RankHistory(rank_history) if first else None
+        self.rank_history = rank_history
+        self.print_ranks = print_ranks
+
+    def _init_mixed_precision(self, mixed_precision: bool, amp_dtype):
+        self.mixed_precision = mixed_precision
+        # mixed precision: autocast on the device of the model, amp_dtype defaults to float16 on
+        #   CUDA and bfloat16 elsewhere (CPU). The parameters (bases, S, K, L) stay fp32 master
+        #   copies, only the GEMMs of the forward and backward run in amp_dtype. The QRs and SVDs
+        #   run outside of autocast in at least fp32 (see linalg_dtype)
+        self.amp_device = next(self.dlrt_model.dlrt_model.parameters()).device.type
+        if isinstance(amp_dtype, str):
+            amp_dtype = getattr(torch, amp_dtype)
+        if amp_dtype is None:
+            amp_dtype = torch.float16 if self.amp_device == "cuda" else torch.bfloat16
+        self.amp_dtype = amp_dtype
+        if mixed_precision:
+            low_precision = [
+                n for n, p in self.dlrt_model.dlrt_model.named_parameters() if p.dtype != torch.float32
+            ]
+            if low_precision:
+                raise ValueError(
+                    f"mixed precision needs fp32 parameters (master copies), autocast casts them for "
+                    f"the GEMMs. not fp32: {low_precision}",
+                )
+        # one scaler per phase, the K, L, and S steps train different parameters with different
+        #   gradient magnitudes. only float16 needs loss scaling, the scalers are pass-throughs
+        #   otherwise (no mixed precision or bfloat16)
+        scale = mixed_precision and amp_dtype == torch.float16
+        self.scaler_cases = ("pre", "k", "l", "s", "kl", "kls")
+        for case in self.scaler_cases:
+            setattr(self, f"{case}scaler", torch.amp.GradScaler(self.amp_device, enabled=scale))
+
+    def save_checkpoint(self, path, writer=None, on_done=None, **extra) -> float:
+        """
+        Save a compact checkpoint (DLRT layers at their current rank, optimizer state, step counter,
+        and the keyword arguments in `extra`), see `dlrt.checkpoint.save_checkpoint`. With a
+        `dlrt.AsyncCheckpointWriter` as `writer`, the file is written in the background and
+        `on_done(path)` is called once it is complete. Returns the seconds for which the training
+        is stopped.
+        """
+        return checkpoint.save_checkpoint(self, path, writer=writer, on_done=on_done, **extra)
+
+    def load_checkpoint(self, path, map_location=None) -> dict:
+        """
+        Restore the trainer from `save_checkpoint` and return its `extra` keyword arguments. The
+        trainer must be built from the same model with the same settings.
+        """
+        return checkpoint.load_checkpoint(self, path, map_location=map_location)
+
     def _split_batch(self, inputs, labels):
         if self.split_batch == "repeat":
             # repeat the batch multiple times
@@ -127,26 +239,46 @@ class DLRTTrainer:
         #   4. return
         self.dlrt_model.set_layer_case(case)
         self.dlrt_model.run_preprocess(case)
+        return self._forward_backward_step(inputs, labels, case, getattr(self, f"{case}scaler"))
+
+    def _autocast(self):
+        return torch.autocast(
+            device_type=self.amp_device,
+            dtype=self.amp_dtype,
+            enabled=self.mixed_precision,
+        )
+
+    def _forward_backward_step(self, inputs, labels, case, scaler):
+        # the pre-/postprocessing of the phases runs outside of autocast -> in the dtype of the
+        #   factors (fp32)
         self.optimizer.zero_grad()  # set_to_none=True)
-        if self.mixed_precision:
-            scaler = getattr(self, "kscaler")
-            # scaler = getattr(self, f"{case}scaler")
-            with torch.autocast(device_type="cuda", dtype=torch.float16):
-                output = self.dlrt_model(inputs, case)
-                loss = self.criterion(output, labels)
+        reducer = self.dlrt_model.grad_reducer
+        if reducer is not None:
+            # bucket plan of the parameters trained in this phase (after the preprocessing)
+            reducer.prepare(case)
+        with self.profiler.phase(f"{case}_forward"), self._autocast():
+            output = self.dlrt_model(inputs, case)
+            loss = self.criterion(output, labels)
+        with self.profiler.phase(f"{case}_backward"):
             scaler.scale(loss).backward()
-            # nn.utils.clip_grad_norm_(self.dlrt_model.parameters(), max_norm=0.1)
+        if reducer is not None:
+            # the averaged gradients are written back before the optimizer step
+            with self.profiler.phase(f"{case}_grad_sync"):
+                reducer.finish()
+        # nn.utils.clip_grad_norm_(self.dlrt_model.parameters(), max_norm=0.1)
+        with self.profiler.phase(f"{case}_optimizer_step"):
             scaler.step(self.optimizer)
             scaler.update()
-        else:
-            output = self.dlrt_model(inputs, case)
-            loss = self.criterion(output, labels)
-            loss.backward()
-            # nn.utils.clip_grad_norm_(self.dlrt_model.parameters(), max_norm=0.1)
-            self.optimizer.step()
         return loss, output
 
     def train_step_abs(self, inputs, labels):
+        with self.profiler.phase("step"):
+            ret = self._train_step_abs(inputs, labels)
+        # periodic dump of the phase times
+        self.profiler.step()
+        return ret
+
+    def _train_step_abs(self, inputs, labels):
         fact = {"device": inputs.device, "dtype": inputs.dtype}
         self.kloss, self.lloss, self.sloss = (
             torch.tensor(0, **fact),
@@ -156,26 +288,13 @@ class DLRTTrainer:
         # print(self.counter, self.pretrain_count, self.in_pretrain())
         if self.in_pretrain():
             self.dlrt_model.set_layer_case(case="pretrain")
-            self.optimizer.zero_grad()  # set_to_none=True)
-            if self.mixed_precision:
-                with torch.autocast(device_type="cuda", dtype=torch.float16):
-                    output = self.dlrt_model(inputs, case="pretrain")
-                    loss = self.criterion(output, labels)
-                self.prescaler.scale(loss).backward()
-                # nn.utils.clip_grad_norm_(self.dlrt_model.parameters(), max_norm=0.1)
-                self.prescaler.step(self.optimizer)
-                self.prescaler.update()
-            else:
-                output = self.dlrt_model(inputs, case="pretrain")
-                loss = self.criterion(output, labels)
-                loss.backward()
-                # nn.utils.clip_grad_norm_(self.dlrt_model.parameters(), max_norm=0.1)
-                self.optimizer.step()
+            loss, output = self._forward_backward_step(inputs, labels, "pretrain", self.prescaler)
             self.counter += 1
             if self.counter == self.pretrain_count:
                 # convert the model here!
                 print("stopping pretraining...")
-                self.dlrt_model.stop_pretraining()
+                with self.profiler.phase("stop_pretraining"):
+                    self.dlrt_model.stop_pretraining()
                 # with torch.no_grad():
                 #     self.dlrt_model.set_layer_case(case="k")
                 #     afteroutputk = self.dlrt_model(inputs, case="k")
@@ -193,6 +312,8 @@ class DLRTTrainer:
                 self.return_tuple(loss, output),
             )
         # -------------------------- DLRT --------------------------------
+        if self.integrator != "sequential":
+            return self._train_step_parallel(inputs, labels)
         split_inputs, split_labels = self._split_batch(inputs, labels)
         # TODO: splitting the batch into 3 sections...
         # ===== k step ====================
@@ -203,34 +324,69 @@ class DLRTTrainer:
         lloss, loutput = self._run_model(split_inputs[1], split_labels[1], case="l")
         # lloss, loutput = self._run_model2(inputs, labels, case="l")
 
-        # post process for both k and l
-        self.dlrt_model.run_postprocess("k")
-        self.dlrt_model.run_postprocess("l")
+        # post process for both k and l (in one go -> the QRs can be batched)
+        self.dlrt_model.run_postprocess("kl")
         # === end l === start s ===
         # sloss, soutput = self._run_model2(inputs, labels, case="s")
         sloss, soutput = self._run_model(split_inputs[2], split_labels[2], case="s")
+        self._after_step()
+        if self.split_batch == "thirds":
+            combiout = torch.cat([koutput, loutput, soutput], dim=0)
+            combiloss = (kloss + lloss + sloss) / 3.0
+        else:
+            combiout = soutput
+            combiloss = sloss
+        return (
+            self.return_tuple(kloss, koutput),
+            self.return_tuple(lloss, loutput),
+            self.return_tuple(sloss, soutput),
+            self.return_tuple(combiloss, combiout),
+        )
+
+    def _after_step(self):
         # rank adaptation ( + all reduce all DLRT params)
         if self.adaptive:
             self.dlrt_model.run_rank_adaption()
+            # no stale momentum beyond the new ranks (and nothing the compact checkpoints drop)
+            self.dlrt_model.zero_beyond_rank(self.optimizer)
+            if self.compact_factors and self.counter % self.compact_patience == 0:
+                with self.profiler.phase("compact_factors"):
+                    self.dlrt_model.compact_factors(
+                        optimizer=self.optimizer,
+                        margin=self.compact_margin,
+                        patience=self.compact_patience,
+                    )
 
-            if self.rank == 0 and self.counter % 10 == 0:
+            if self.rank_history is not None and self.rank == 0:
+                self.rank_history.record(self.counter, self.dlrt_model)
+            if self.print_ranks and self.rank == 0 and self.counter % self.print_ranks == 0:
                 console.rule(f"After rank adaptation - {self.counter}")
                 columns = Columns(self.dlrt_model.get_all_ranks(), equal=True, expand=True)
                 console.print(columns)
                 console.rule()
 
         self.counter += 1
-        if self.split_batch == "thirds":
-            combiout = torch.cat([koutput, loutput, soutput], dim=0)
-            combiloss = (kloss + lloss + sloss) / 3.0
+
+    def _train_step_parallel(self, inputs, labels):
+        # parallel integrator, K and L are updated from the same starting point
+        if self.integrator == "parallel-folded":
+            # single pass, the augmented S is assembled in the postprocessing
+            loss, output = self._run_model(inputs, labels, case="kls")
+            self.dlrt_model.run_postprocess("kls")
+            klloss, kloutput = loss, output
+            sloss, soutput = loss, output
         else:
-            combiout = soutput
-            combiloss = sloss
+            # same batches as the K and S steps of the sequential integrator
+            split_inputs, split_labels = self._split_batch(inputs, labels)
+            klloss, kloutput = self._run_model(split_inputs[0], split_labels[0], case="kl")
+            self.dlrt_model.run_postprocess("kl")
+            sloss, soutput = self._run_model(split_inputs[2], split_labels[2], case="s")
+        self._after_step()
         return (
-            self.return_tuple(kloss, koutput),
-            self.return_tuple(lloss, loutput),
+            self.return_tuple(klloss, kloutput),
+            self.return_tuple(klloss, kloutput),
+            self.return_tuple(sloss, soutput),
             self.return_tuple(sloss, soutput),
-            self.return_tuple(combiloss, combiout),
         )
 
     @torch.no_grad()
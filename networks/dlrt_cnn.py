@@ -109,7 +109,9 @@ def main(config):  # noqa: C901
         config["rank"] = 0
 
     if config["rank"] == 0:
-        mlflow.log_params({"world_size": config["world_size"], "rank": config["rank"]})
+        # metrics and params are sent to the tracking store by a background thread
+        mlfutils.start_async_logging()
+        mlfutils.log_params({"world_size": config["world_size"], "rank": config["rank"]})
 
     # create model
     if config["arch"] == "toynet":
@@ -158,6 +160,8 @@ def main(config):  # noqa: C901
         adaptive=config["dlrt"]["adaptive"],
         criterion=nn.CrossEntropyLoss().to(device),
         mixed_precision=config["mixed"],
+        # None -> float16 on CUDA, bfloat16 on the CPU
+        amp_dtype=config.get("amp_dtype"),
         rank_percent=config["dlrt"]["rank_percent"],
         epsilon={"linear": config["dlrt"]["eps_linear"], "conv2d": config["dlrt"]["eps_conv"]},
         split_batch=config["dlrt"]["split_batch"],
@@ -184,39 +188,37 @@ def main(config):  # noqa: C901
     scheduler, warmup_scheduler = opt.get_lr_schedules(config=config, optim=dlrt_trainer.optimizer)
 
     if config["rank"] == 0:
-        mlflow.log_params(config)
+        params = dict(config)
         for cat in ["dlrt", "lr_schedule", "lr_warmup", "optimizer"]:
             for k in config[cat]:
                 if isinstance(config[cat][k], dict):
                     for k2 in config[cat][k]:
-                        mlflow.log_param(f"{cat}-{k}-{k2}", config[cat][k][k2])
+                        params[f"{cat}-{k}-{k2}"] = config[cat][k][k2]
                 else:
-                    mlflow.log_param(f"{cat}-{k}", config[cat][k])
+                    params[f"{cat}-{k}"] = config[cat][k]
+        mlfutils.log_params(params)
 
-    # optionally resume from a checkpoint
-    # TODO: add DLRT checkpointing
+    # optionally resume from a (compact DLRT) checkpoint, see save_checkpoint
+    best_acc1 = 0
     if config["resume"]:
         if os.path.isfile(config["resume"]):
             print(f"=> loading checkpoint: {config['resume']}")
-            if config["gpu"] is None:
-                checkpoint = torch.load(config["resume"])
-            elif torch.cuda.is_available():
-                # Map model to be loaded to specified single gpu.
-                loc = f"cuda:{config['gpu']}"
-                checkpoint = torch.load(config["resume"], map_location=loc)
+            # the tensors are loaded onto the gpu of this process
+            checkpoint = dlrt_trainer.load_checkpoint(config["resume"], map_location=device)
             config["start_epoch"] = checkpoint["epoch"]
             best_acc1 = checkpoint["best_acc1"]
-            if config["gpu"] is not None:
-                # best_acc1 may be from a checkpoint from a different GPU
-                best_acc1 = best_acc1.to(config["gpu"])
-            model.load_state_dict(checkpoint["state_dict"])
-            # optimizer.load_state_dict(checkpoint["optimizer"])
             scheduler.load_state_dict(checkpoint["scheduler"])
             print(
                 "=> loaded checkpoint '{}' (epoch {})".format(config["resume"], checkpoint["epoch"]),
             )
         else:
             print(f"=> no checkpoint found at: {config['resume']}")
+    # checkpoints are written by a background thread on the first rank, the training only stops
+    #   for the copy of the (compact) state
+    writer = None
+    if config["rank"] == 0 and config.get("checkpoint_dir"):
+        os.makedirs(config["checkpoint_dir"], exist_ok=True)
+        writer = dlrt.AsyncCheckpointWriter()
 
     # Data loading code
     # if config['dummy']:
@@ -247,7 +249,7 @@ def main(config):  # noqa: C901
     for epoch in range(config["start_epoch"], config["epochs"]):
         if config["rank"] == 0:
             console.rule(f"Begin epoch {epoch} LR: {dlrt_trainer.optimizer.param_groups[0]['lr']}")
-            mlflow.log_metrics(
+            mlfutils.log_metrics(
                 metrics={"lr": dlrt_trainer.optimizer.param_groups[0]["lr"]},
                 step=epoch,
             )
@@ -281,7 +283,7 @@ def main(config):  # noqa: C901
         # # profiling =====================
 
         # evaluate on validation set
-        _ = validate(val_loader, dlrt_trainer, config, epoch, len(train_loader))
+        acc1 = validate(val_loader, dlrt_trainer, config, epoch, len(train_loader))
         # _ = validate_baseline(val_loader, model, criterion, config, epoch)
         # if epoch == 1:
         #     console.rule("test stuff")
@@ -340,6 +342,26 @@ def main(config):  # noqa: C901
             else:  # StelLR / others
                 scheduler.step()
 
+        if writer is not None:
+            acc1 = float(acc1)
+            is_best = acc1 > best_acc1
+            best_acc1 = max(acc1, best_acc1)
+            save_checkpoint(
+                dlrt_trainer,
+                is_best,
+                config["checkpoint_dir"],
+                writer=writer,
+                epoch=epoch + 1,
+                best_acc1=best_acc1,
+                scheduler=scheduler.state_dict(),
+            )
+    if writer is not None:
+        # wait for the last checkpoint
+        writer.close()
+    dlrt_trainer.dlrt_model.close()
+    if config["rank"] == 0:
+        mlfutils.stop_async_logging()
+
 
 def train_baseline(train_loader, optimizer, model, criterion, epoch, device, config, warmup_scheduler):
     batch_time = AverageMeter("Time", ":6.3f")
@@ -352,6 +374,7 @@ def train_baseline(train_loader, optimizer, model, criterion, epoch, device, con
         [batch_time, data_time, losses, top1, top5],
         prefix=f"Epoch: [{epoch}]",
     )
+    metrics = DeviceMetrics([losses, top1, top5], device)
 
     # switch to train mode
     model.train()
@@ -372,9 +395,7 @@ def train_baseline(train_loader, optimizer, model, criterion, epoch, device, con
 
         # measure accuracy and record loss
         acc1, acc5 = accuracy(output, target, topk=(1, 5))
-        losses.update(loss.item(), images.size(0))
-        top1.update(acc1[0], images.size(0))
-        top5.update(acc5[0], images.size(0))
+        metrics.update([loss, acc1[0], acc5[0]], images.size(0))
 
         # measure elapsed time
         batch_time.update(time.time() - end)
@@ -386,22 +407,17 @@ def train_baseline(train_loader, optimizer, model, criterion, epoch, device, con
             with warmup_scheduler.dampening():
                 pass
 
-        if (i % config["print_freq"] == 0 or i == len(train_loader) - 1) and config["rank"] == 0:
-            # console.rule(f"train step {i}")
-            argmax = torch.argmax(output, dim=1).to(torch.float32)
-            console.print(
-                f"Argmax outputs s "
-                f"mean: {argmax.mean().item():.5f}, max: {argmax.max().item():.5f}, "
-                f"min: {argmax.min().item():.5f}, std: {argmax.std().item():.5f}",
-            )
-            progress.display(i + 1)
+        if i % config["print_freq"] == 0 or i == len(train_loader) - 1:
+            (stats,) = metrics.sync([argmax_stats(output)])
+            if config["rank"] == 0:
+                # console.rule(f"train step {i}")
+                print_argmax_stats("s", stats)
+                progress.display(i + 1)
     if config["rank"] == 0:
-        mlflow.log_metrics(
-            metrics={"train loss": losses.avg, "train top1": top1.avg.item(), "train top5": top5.avg.item()},
+        mlfutils.log_metrics(
+            metrics={"train loss": losses.avg, "train top1": top1.avg, "train top5": top5.avg},
             step=epoch,
         )
-    if dist.is_initialized():
-        losses.all_reduce()
     return losses.avg
 
 
@@ -416,6 +432,8 @@ def train(train_loader, trainer: dlrt.DLRTTrainer, epoch, device, config, warmup
         [batch_time, data_time, losses, top1, top5],
         prefix=f"Epoch: [{epoch}]",
     )
+    # loss and accuracies stay on the device, synced (and checked for NaNs) every print_freq steps
+    metrics = DeviceMetrics([losses, top1, top5], device)
 
     # switch to train mode
     trainer.dlrt_model.train()
@@ -450,13 +468,9 @@ def train(train_loader, trainer: dlrt.DLRTTrainer, epoch, device, config, warmup
         #     f"mean: {argmax.mean().item():.5f}, max: {argmax.max().item():.5f}, "
         #     f"min: {argmax.min().item():.5f}, std: {argmax.std().item():.5f}"
         # )
-        if torch.isnan(combi.loss):
-            raise ValueError("NaN loss", combi.output)
-        # measure accuracy and record loss
+        # measure accuracy and record loss (NaN losses are caught in the next sync)
         acc1, acc5 = accuracy(combi.output, target, topk=(1, 5))
-        losses.update(combi.loss.item(), images.size(0))
-        top1.update(acc1[0], images.size(0))
-        top5.update(acc5[0], images.size(0))
+        metrics.update([combi.loss, acc1[0], acc5[0]], images.size(0))
 
         # measure elapsed time
         batch_time.update(time.time() - end)
@@ -468,54 +482,27 @@ def train(train_loader, trainer: dlrt.DLRTTrainer, epoch, device, config, warmup
             with warmup_scheduler.dampening():
                 pass
 
-        if (i % config["print_freq"] == 0 or i == len(train_loader) - 1) and config["rank"] == 0:
-            # console.rule(f"train step {i}")
+        if i % config["print_freq"] == 0 or i == len(train_loader) - 1:
+            # one host sync (and all-reduce) for the metrics and the argmax statistics
+            outputs = {"combi": combi.output}
             if koutput.output is not None:
-                argmax = torch.argmax(koutput.output, dim=1).to(torch.float32)
-                console.print(
-                    f"Argmax outputs k "
-                    f"mean: {argmax.mean().item():.5f}, max: {argmax.max().item():.5f}, "
-                    f"min: {argmax.min().item():.5f}, std: {argmax.std().item():.5f}",
-                )
-                argmax = torch.argmax(loutput.output, dim=1).to(torch.float32)
-                console.print(
-                    f"Argmax outputs l "
-                    f"mean: {argmax.mean().item():.5f}, max: {argmax.max().item():.5f}, "
-                    f"min: {argmax.min().item():.5f}, std: {argmax.std().item():.5f}",
-                )
-                argmax = torch.argmax(soutput.output, dim=1).to(torch.float32)
-                console.print(
-                    f"Argmax outputs s "
-                    f"mean: {argmax.mean().item():.5f}, max: {argmax.max().item():.5f}, "
-                    f"min: {argmax.min().item():.5f}, std: {argmax.std().item():.5f}",
-                )
-            argmax = torch.argmax(combi.output, dim=1).to(torch.float32)
-            console.print(
-                f"Argmax outputs combi "
-                f"mean: {argmax.mean().item():.5f}, max: {argmax.max().item():.5f}, "
-                f"min: {argmax.min().item():.5f}, std: {argmax.std().item():.5f}",
-            )
-            progress.display(i + 1)
+                outputs = {"k": koutput.output, "l": loutput.output, "s": soutput.output, **outputs}
+            stats = metrics.sync([argmax_stats(out) for out in outputs.values()])
+            if config["rank"] == 0:
+                # console.rule(f"train step {i}")
+                for name, st in zip(outputs, stats):
+                    print_argmax_stats(name, st)
+                progress.display(i + 1)
     # print(f"loss: {losses.avg} top1: {top1.avg} top5: {top5.avg}")
-    if dist.is_initialized():
-        losses.all_reduce()
-        top1.all_reduce()
-        top5.all_reduce()
+    # the meters are the all-reduced averages of the epoch (synced at the last step)
 
     if config["rank"] == 0:
         # mlflow.log_metrics(
         #     metrics={"train loss": losses.avg, "train top1": top1.avg.item(), "train top5": top5.avg.item()},
         #     step=epoch,
         # )
-        avgloss = losses.avg
-        avgtop1 = top1.avg
-        avgtop5 = top5.avg
-        mlflow.log_metrics(
-            metrics={
-                "train loss": avgloss.item() if isinstance(avgloss, torch.Tensor) else avgloss,
-                "train top1": avgtop1.item() if isinstance(avgtop1, torch.Tensor) else avgtop1,
-                "train top5": avgtop5.item() if isinstance(avgtop5, torch.Tensor) else avgtop5,
-            },
+        mlfutils.log_metrics(
+            metrics={"train loss": losses.avg, "train top1": top1.avg, "train top5": top5.avg},
             step=epoch,  # logging right at the end of the
             # last epoch
         )
@@ -599,7 +586,7 @@ def validate_baseline(val_loader, model, criterion, config, epoch):
         top5.all_reduce()
 
     if config["rank"] == 0:
-        mlflow.log_metrics(
+        mlfutils.log_metrics(
             metrics={
                 "val loss": losses.avg,
                 "val top1": top1.avg.item(),
@@ -692,7 +679,7 @@ def validate(val_loader, trainer: dlrt.DLRTTrainer, config, epoch, train_len):
         avgloss = losses.avg
         avgtop1 = top1.avg
         avgtop5 = top5.avg
-        mlflow.log_metrics(
+        mlfutils.log_metrics(
             metrics={
                 "val loss": avgloss.item() if isinstance(avgloss, torch.Tensor) else avgloss,
                 "val top1": avgtop1.item() if isinstance(avgtop1, torch.Tensor) else avgtop1,
@@ -705,10 +692,15 @@ def validate(val_loader, trainer: dlrt.DLRTTrainer, config, epoch, train_len):
     return top1.avg
 
 
-def save_checkpoint(state, is_best, filename="checkpoint.pth.tar"):
-    torch.save(state, filename)
-    if is_best:
-        shutil.copyfile(filename, "model_best.pth.tar")
+def save_checkpoint(trainer, is_best, checkpoint_dir, writer=None, **extra):
+    # compact DLRT checkpoint, written in the background if writer is a dlrt.AsyncCheckpointWriter
+    #   the best model is copied once the file is complete
+    def copy_best(path):
+        if is_best:
+            shutil.copyfile(path, os.path.join(checkpoint_dir, "model_best.pth.tar"))
+
+    filename = os.path.join(checkpoint_dir, "checkpoint.pth.tar")
+    return trainer.save_checkpoint(filename, writer=writer, on_done=copy_best, **extra)
 
 
 class Summary(Enum):
@@ -772,6 +764,55 @@ class AverageMeter:
         return fmtstr.format(**self.__dict__)
 
 
+class DeviceMetrics:
+    """
+    Running sums of per-batch metrics (e.g. loss, top1, top5) which stay on the device, i.e. `update`
+    does not sync with the host. `sync` writes them into the AverageMeters with one host sync and, if
+    distributed, one all-reduce. The NaN check of the first metric (the loss) is done there too.
+    `sync` is a collective -> all processes have to call it at the same steps.
+    """
+
+    def __init__(self, meters: list, device):
+        self.meters = meters
+        self.device = device
+        # sums of metric * n, the count, and the number of NaN batches + the values of the last batch
+        self._sums = torch.zeros(len(meters) + 2, dtype=torch.float32, device=device)
+        self._last = torch.zeros(len(meters), dtype=torch.float32, device=device)
+
+    def update(self, values: list, n: int):
+        vals = torch.stack(
+            [torch.as_tensor(v, device=self.device).detach().float().reshape(()) for v in values]
+        )
+        self._last = vals
+        self._sums[:-2] += vals * n
+        self._sums[-2] += n
+        self._sums[-1] += torch.isnan(vals[0])
+
+    def sync(self, local: list = None) -> list:
+        """
+        All-reduce the sums and write them into the meters (val: last batch, mean over the processes).
+        The `local` tensors (not reduced) are copied to the host in the same sync, returned as lists.
+        """
+        world_size = dist.get_world_size() if dist.is_initialized() else 1
+        buf = torch.cat([self._sums, self._last / world_size])
+        if world_size > 1:
+            dist.all_reduce(buf, dist.ReduceOp.SUM)
+        local = [] if local is None else [t.reshape(-1).float() for t in local]
+        values = torch.cat([buf, *local]).tolist()
+        num = len(self.meters)
+        count, nans = values[num], values[num + 1]
+        if nans > 0:
+            raise ValueError(f"NaN loss in {int(nans)} batches")
+        for meter, total, val in zip(self.meters, values[:num], values[num + 2 : 2 * num + 2]):
+            meter.val, meter.sum, meter.count = val, total, count
+            meter.avg = total / count if count else 0
+        out, pos = [], 2 * num + 2
+        for t in local:
+            out.append(values[pos : pos + t.numel()])
+            pos += t.numel()
+        return out
+
+
 class ProgressMeter:
     def __init__(self, num_batches, meters, prefix=""):
         self.batch_fmtstr = self._get_batch_fmtstr(num_batches)
@@ -799,6 +840,19 @@ class ProgressMeter:
         return "[" + fmt + "/" + fmt.format(num_batches) + "]"
 
 
+def argmax_stats(output) -> torch.Tensor:
+    # mean, max, min, std of the predicted classes, on the device
+    argmax = torch.argmax(output, dim=1).to(torch.float32)
+    return torch.stack([argmax.mean(), argmax.max(), argmax.min(), argmax.std()])
+
+
+def print_argmax_stats(name, stats):
+    console.print(
+        f"Argmax outputs {name} "
+        f"mean: {stats[0]:.5f}, max: {stats[1]:.5f}, min: {stats[2]:.5f}, std: {stats[3]:.5f}",
+    )
+
+
 def accuracy(output, target, topk=(1,)):
     """Computes the accuracy over the k top predictions for the specified values of k"""
     with torch.no_grad():
@@ -30,6 +30,7 @@ from torch.optim.lr_scheduler import ReduceLROnPlateau
 from torch.optim.lr_scheduler import StepLR
 from torch.utils.data import Subset
 
+import dlrt
 from .. import datasets as dsets
 from .. import mlflow_utils as mlfutils
 from .. import optimizer as opt
@@ -295,7 +296,7 @@ def train(train_loader, optimizer, model, criterion, epoch, device, config, warm
 
 
 @torch.no_grad()
-def save_selected_weights(network, epoch):
+def save_selected_weights(network, epoch, writer=None):
     save_list = [
         "module.conv1.weight",
         "module.fc.weight",
@@ -306,33 +307,35 @@ def save_selected_weights(network, epoch):
     save_location = Path(
         "/hkfs/work/workspace/scratch/qv2382-dlrt/saved_models/4gpu-svd-tests/normal/resnet18",
     )
-    rank = dist.get_rank()
-
-    if rank != 0:
-        dist.barrier()
+    # only the first rank saves, the other ranks do not wait for it
+    if dist.is_initialized() and dist.get_rank() != 0:
         return
-    # save location: resnet18/name/epoch/[u, s, vh, weights
-    for n, p in network.named_parameters():
-        if n in save_list:
+    selected = {n: p for n, p in network.named_parameters() if n in save_list}
+
+    def write(weights):
+        # save location: resnet18/name/epoch/[u, s, vh, weights
+        for n, p in weights.items():
             print(n)
             n_save_loc = save_location / n / str(epoch)
             n_save_loc.mkdir(exist_ok=True, parents=True)
             # todo: full matrices?? -> can always slice later
-            if p.data.ndim > 2:
-                tosave = p.view(p.shape[0], -1)
-            else:
-                tosave = p.data
+            tosave = p.reshape(p.shape[0], -1)
             u, s, vh = torch.linalg.svd(tosave, full_matrices=False)
-            torch.save(u, n_save_loc / "u-reduced.pt")
-            torch.save(s, n_save_loc / "s-reduced.pt")
-            torch.save(vh, n_save_loc / "vh-reduced.pt")
+            dlrt.atomic_save(u, n_save_loc / "u-reduced.pt")
+            dlrt.atomic_save(s, n_save_loc / "s-reduced.pt")
+            dlrt.atomic_save(vh, n_save_loc / "vh-reduced.pt")
             u, s, vh = torch.linalg.svd(tosave, full_matrices=True)
-            torch.save(u, n_save_loc / "u.pt")
-            torch.save(s, n_save_loc / "s.pt")
-            torch.save(vh, n_save_loc / "vh.pt")
-            torch.save(tosave.data, n_save_loc / "p.pt")
-    print("finished saving")
-    dist.barrier()
+            dlrt.atomic_save(u, n_save_loc / "u.pt")
+            dlrt.atomic_save(s, n_save_loc / "s.pt")
+            dlrt.atomic_save(vh, n_save_loc / "vh.pt")
+            dlrt.atomic_save(tosave, n_save_loc / "p.pt")
+        print("finished saving")
+
+    if writer is None:
+        write(selected)
+    else:
+        # the SVDs and the files are done by the worker thread on a copy of the weights
+        writer.submit(write, selected)
 
 
 def validate(val_loader, model, criterion, config, epoch):
@@ -429,10 +432,18 @@ def validate(val_loader, model, criterion, config, epoch):
     return top1.avg, losses.avg
 
 
-def save_checkpoint(state, is_best, filename="checkpoint.pth.tar"):
-    torch.save(state, filename)
-    if is_best:
-        shutil.copyfile(filename, "model_best.pth.tar")
+def save_checkpoint(state, is_best, filename="checkpoint.pth.tar", writer=None):
+    # written in the background if writer is a dlrt.AsyncCheckpointWriter, the best model is
+    #   copied once the file is complete
+    def copy_best(path):
+        if is_best:
+            shutil.copyfile(path, "model_best.pth.tar")
+
+    if writer is None:
+        dlrt.atomic_save(state, filename)
+        copy_best(filename)
+    else:
+        writer.save(state, filename, on_done=copy_best)
 
 
 class Summary(Enum):
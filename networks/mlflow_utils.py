@@ -1,15 +1,33 @@
 from __future__ import annotations
 
+import atexit
 import os
+import queue
 import subprocess
+import threading
 import time
 
 import mlflow
+import torch
 import torch.distributed as dist
 
-__all__ = ["setup_mlflow"]
+__all__ = [
+    "AsyncMLflowLogger",
+    "log_metrics",
+    "log_params",
+    "setup_mlflow",
+    "start_async_logging",
+    "stop_async_logging",
+]
 
 from mlflow.entities import Experiment
+from mlflow.entities import Metric
+from mlflow.entities import Param
+from mlflow.tracking import MlflowClient
+
+# limits of one log_batch call (MLflow REST API)
+MAX_BATCH_METRICS = 1000
+MAX_BATCH_PARAMS = 100
 
 
 def print0(*args, sep=" ", end="\n", file=None):
@@ -79,3 +97,161 @@ def restart_mlflow_server(config: dict):
         print("mlflow cmd", mlflow_server_cmd)
         _ = subprocess.Popen(mlflow_server_cmd)
         time.sleep(2)
+
+
+class AsyncMLflowLogger:
+    """
+    Log metrics and params to a run in a background thread.
+
+    `log_metrics` / `log_params` only put the values into a queue (tensors are converted to floats
+    in the worker, i.e. the caller does not sync with the device), the worker sends everything
+    which is queued in `log_batch` calls of at most 1000 metrics / 100 params. The queue holds at
+    most `max_queue` entries, logging blocks while it is full. Errors of the worker are raised by
+    the next call. `close` (registered with atexit) sends the rest and stops the worker.
+
+    Parameters
+    ----------
+    run_id: str
+        run to log to, default: the active run
+    max_queue: int
+        number of metrics/params which can be queued
+    client: MlflowClient
+        default: MlflowClient() (the current tracking URI)
+    """
+
+    def __init__(self, run_id: str = None, max_queue: int = 10000, client: MlflowClient = None):
+        if run_id is None:
+            run = mlflow.active_run()
+            if run is None:
+                raise RuntimeError("no active MLflow run, start one or give a run_id")
+            run_id = run.info.run_id
+        self.run_id = run_id
+        self.client = MlflowClient() if client is None else client
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._error = None
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="mlflow-logger", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def log_metrics(self, metrics: dict, step: int = None):
+        self._check()
+        timestamp = int(time.time() * 1000)
+        for key, value in metrics.items():
+            self._queue.put(("metric", key, value, timestamp, step or 0))
+
+    def log_metric(self, key: str, value, step: int = None):
+        self.log_metrics({key: value}, step=step)
+
+    def log_params(self, params: dict):
+        self._check()
+        for key, value in params.items():
+            self._queue.put(("param", key, value, None, None))
+
+    def log_param(self, key: str, value):
+        self.log_params({key: value})
+
+    def _check(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError("logging to MLflow failed") from error
+        if self._closed:
+            raise RuntimeError("the MLflow logger is closed")
+
+    def _run(self):
+        stop = False
+        while not stop:
+            # block for the first entry, then take everything which is queued
+            entries = [self._queue.get()]
+            while len(entries) < MAX_BATCH_METRICS:
+                try:
+                    entries.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if entries[-1] is None:
+                stop = True
+                entries.pop()
+            try:
+                self._send(entries)
+            except Exception as e:  # noqa: B902
+                self._error = e
+            finally:
+                for _ in range(len(entries) + stop):
+                    self._queue.task_done()
+
+    def _send(self, entries: list):
+        metrics, params = [], {}
+        for kind, key, value, timestamp, step in entries:
+            if kind == "metric":
+                if torch.is_tensor(value):
+                    value = value.item()
+                metrics.append(Metric(key, float(value), timestamp, step))
+            else:
+                # params are immutable in MLflow, a key can only be in a batch once
+                params[key] = Param(key, str(value))
+        params = list(params.values())
+        while metrics or params:
+            batch_params, params = params[:MAX_BATCH_PARAMS], params[MAX_BATCH_PARAMS:]
+            num = MAX_BATCH_METRICS - len(batch_params)
+            batch_metrics, metrics = metrics[:num], metrics[num:]
+            self.client.log_batch(self.run_id, metrics=batch_metrics, params=batch_params)
+
+    def flush(self):
+        """
+        Block until everything which is queued is sent
+        """
+        self._queue.join()
+        self._check()
+
+    def close(self):
+        """
+        Send everything which is queued and stop the worker thread
+        """
+        if self._closed:
+            return
+        self._closed = True
+        atexit.unregister(self.close)
+        self._queue.put(None)
+        self._thread.join()
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError("logging to MLflow failed") from error
+
+
+# logger used by log_metrics / log_params, see start_async_logging
+_logger = None
+
+
+def start_async_logging(**kwargs) -> AsyncMLflowLogger:
+    """
+    Send the metrics and params of `log_metrics` / `log_params` through an AsyncMLflowLogger (to the
+    active run), kwargs are passed to it
+    """
+    global _logger
+    stop_async_logging()
+    _logger = AsyncMLflowLogger(**kwargs)
+    return _logger
+
+
+def stop_async_logging():
+    # send the queued values, log_metrics / log_params are synchronous again
+    global _logger
+    if _logger is not None:
+        logger, _logger = _logger, None
+        logger.close()
+
+
+def log_metrics(metrics: dict, step: int = None):
+    # mlflow.log_metrics, asynchronous after start_async_logging
+    if _logger is not None:
+        _logger.log_metrics(metrics, step=step)
+    else:
+        mlflow.log_metrics({k: v.item() if torch.is_tensor(v) else v for k, v in metrics.items()}, step=step)
+
+
+def log_params(params: dict):
+    # mlflow.log_params, asynchronous after start_async_logging
+    if _logger is not None:
+        _logger.log_params(params)
+    else:
+        mlflow.log_params(params)
@@ -0,0 +1,84 @@
+from __future__ import annotations
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+import dlrt
+
+
+class ToyNet(nn.Module):
+    # small version of the ToyNet of networks/dlrt_cnn.py
+    def __init__(self, in_features: int = 64, num_classes: int = 10):
+        super().__init__()
+        self.fc0 = nn.Linear(in_features, 48)
+        self.fc1 = nn.Linear(48, 32)
+        self.fc3 = nn.Linear(32, num_classes)
+
+    def forward(self, x):
+        x = F.relu(self.fc0(x))
+        x = F.relu(self.fc1(x))
+        return self.fc3(x)
+
+
+def _trainer(seed: int) -> dlrt.DLRTTrainer:
+    torch.manual_seed(seed)
+    return dlrt.DLRTTrainer(
+        torch_model=ToyNet(),
+        optimizer_name="SGD",
+        # as in the configs: the momentum of the directions which are cut by the rank adaption must
+        #   not come back when the rank grows again
+        optimizer_kwargs={"lr": 1.0, "momentum": 0.9, "nesterov": True, "weight_decay": 1e-4},
+        criterion=nn.CrossEntropyLoss(),
+        adaptive=True,
+        # the ranks shrink in the first step and grow afterwards
+        epsilon={"linear": 0.05},
+        mixed_precision=False,
+        dense_last_layer=True,
+    )
+
+
+def _train(trainer, images, labels, steps: int, batch_size: int = 32) -> list:
+    losses = []
+    for _ in range(steps):
+        b = (trainer.counter * batch_size) % images.shape[0]
+        out = trainer.train_step_abs(images[b : b + batch_size], labels[b : b + batch_size])
+        losses.append(out[-1].loss.item())
+    return losses
+
+
+@torch.no_grad()
+def _factors(trainer) -> dict:
+    # U, S, Vt of every DLRT layer at its current rank
+    ret = {}
+    for name, module in trainer.dlrt_model.dlrt_model.named_modules():
+        if hasattr(module, "low_rank"):
+            r = module.low_rank
+            ret[name] = (module.u[:, :r].clone(), module.s[:r, :r].clone(), module.vt[:r].clone())
+    return ret
+
+
+def test_checkpoint_resume(tmp_path):
+    gen = torch.Generator().manual_seed(0)
+    images = torch.randn(256, 64, generator=gen)
+    labels = torch.randint(0, 10, (256,), generator=gen)
+    path = tmp_path / "ckpt.pt"
+
+    reference = _trainer(seed=1)
+    _train(reference, images, labels, steps=1)
+    reference.save_checkpoint(path)
+    ref_losses = _train(reference, images, labels, steps=6)
+
+    # different seed -> everything which is restored has to come from the checkpoint
+    resumed = _trainer(seed=2)
+    resumed.load_checkpoint(path)
+    assert resumed.counter == 1
+    losses = _train(resumed, images, labels, steps=6)
+
+    assert losses == ref_losses
+    ref_factors, factors = _factors(reference), _factors(resumed)
+    assert ref_factors.keys() == factors.keys() and ref_factors
+    for name, (u, s, vt) in ref_factors.items():
+        assert torch.equal(u, factors[name][0]), name
+        assert torch.equal(s, factors[name][1]), name
+        assert torch.equal(vt, factors[name][2]), name
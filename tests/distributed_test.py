@@ -0,0 +1,80 @@
+from __future__ import annotations
+
+import types
+
+import pytest
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import torch.nn as nn
+import torch.nn.functional as F
+
+from dlrt.distributed import PhaseGradReducer
+from dlrt.linear import DLRTLinearAdaptive
+
+pytestmark = pytest.mark.skipif(not dist.is_available(), reason="torch.distributed is not available")
+
+WORLD_SIZE = 2
+
+
+class Net(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.fc = DLRTLinearAdaptive(16, 12, pretrain=False)
+        self.head = nn.Linear(12, 4)
+        # only used by the first process -> no gradient on the others
+        self.extra = nn.Linear(12, 4)
+
+    def forward(self, x, use_extra: bool):
+        h = F.relu(self.fc(x))
+        out = self.head(h)
+        if use_extra:
+            out = out + self.extra(h)
+        return out.square().mean()
+
+
+def _model() -> Net:
+    torch.manual_seed(0)
+    model = Net()
+    model.fc.change_training_case("k")
+    model.fc.k_preprocess()
+    return model
+
+
+def _data():
+    gen = torch.Generator().manual_seed(1)
+    return torch.randn(WORLD_SIZE * 8, 16, generator=gen).chunk(WORLD_SIZE)
+
+
+def _worker(rank: int, init_file: str, out_dir: str):
+    dist.init_process_group("gloo", init_method=f"file://{init_file}", rank=rank, world_size=WORLD_SIZE)
+    try:
+        model = _model()
+        # tiny buckets -> several collectives, launched during the backward and in finish
+        reducer = PhaseGradReducer(types.SimpleNamespace(dlrt_model=model), bucket_mb=2**-14)
+        reducer.prepare("k")
+        model(_data()[rank], use_extra=rank == 0).backward()
+        reducer.finish()
+        assert reducer.num_collectives > 1
+        grads = {name: p.grad for name, p in model.named_parameters() if p.requires_grad}
+        torch.save(grads, f"{out_dir}/grads_{rank}.pt")
+    finally:
+        dist.destroy_process_group()
+
+
+def test_phase_grad_reducer(tmp_path):
+    mp.spawn(_worker, args=(str(tmp_path / "init"), str(tmp_path)), nprocs=WORLD_SIZE)
+
+    # full batch on one process: the mean of the losses of the shards
+    model = _model()
+    shards = _data()
+    loss = sum(model(x, use_extra=rank == 0) for rank, x in enumerate(shards)) / WORLD_SIZE
+    loss.backward()
+    reference = {name: p.grad for name, p in model.named_parameters() if p.requires_grad}
+    assert "extra.weight" in reference
+
+    for rank in range(WORLD_SIZE):
+        grads = torch.load(tmp_path / f"grads_{rank}.pt")
+        assert grads.keys() == reference.keys()
+        for name, grad in grads.items():
+            torch.testing.assert_close(grad, reference[name], msg=f"{name} on process {rank}")
@@ -0,0 +1,75 @@
+from __future__ import annotations
+
+import threading
+
+import pytest
+import torch
+
+mlflow = pytest.importorskip("mlflow")
+
+from mlflow.tracking import MlflowClient  # noqa: E402
+
+from networks import mlflow_utils  # noqa: E402
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.setenv("MLFLOW_ALLOW_FILE_STORE", "true")
+    return MlflowClient(tracking_uri=f"file:{tmp_path / 'mlruns'}")
+
+
+class GatedClient:
+    # the first log_batch blocks until `gate` is set -> the rest is queued and sent in full batches
+    def __init__(self, client):
+        self.client = client
+        self.entered = threading.Event()
+        self.gate = threading.Event()
+        self.batches = []
+
+    def log_batch(self, run_id, metrics=(), params=()):
+        self.entered.set()
+        self.gate.wait()
+        self.batches.append((len(metrics), len(params)))
+        self.client.log_batch(run_id, metrics=metrics, params=params)
+
+
+def test_async_logger_batches(client):
+    run_id = client.create_run(client.create_experiment("async")).info.run_id
+    gated = GatedClient(client)
+    logger = mlflow_utils.AsyncMLflowLogger(run_id=run_id, client=gated)
+    logger.log_metric("acc", 0.0, step=0)
+    gated.entered.wait()
+    # more than one log_batch of metrics (1000) and params (100)
+    logger.log_params({f"p{i}": i for i in range(250)})
+    for step in range(600):
+        logger.log_metrics({"loss": torch.tensor(1.0 / (step + 1))}, step=step)
+        if step > 0:
+            logger.log_metric("acc", step * 0.5, step=step)
+    gated.gate.set()
+    logger.flush()
+    logger.close()
+
+    # (metrics, params) per log_batch: the worker takes 1000 entries at a time (250 params first)
+    assert gated.batches == [(1, 0), (750, 100), (0, 100), (0, 50), (449, 0)]
+
+    loss = sorted(client.get_metric_history(run_id, "loss"), key=lambda m: m.step)
+    acc = sorted(client.get_metric_history(run_id, "acc"), key=lambda m: m.step)
+    assert [m.step for m in loss] == list(range(600))
+    assert [m.value for m in loss] == pytest.approx([1.0 / (step + 1) for step in range(600)])
+    assert [m.value for m in acc] == [step * 0.5 for step in range(600)]
+    assert client.get_run(run_id).data.params == {f"p{i}": str(i) for i in range(250)}
+
+
+def test_async_logger_errors(client):
+    logger = mlflow_utils.AsyncMLflowLogger(run_id="does-not-exist", client=client)
+    logger.log_metrics({"loss": 1.0})
+    with pytest.raises(RuntimeError, match="logging to MLflow failed"):
+        logger.flush()
+    logger.close()
+    with pytest.raises(RuntimeError, match="closed"):
+        logger.log_metric("loss", 1.0)
+
+    logger = mlflow_utils.AsyncMLflowLogger(run_id="does-not-exist", client=client)
+    logger.log_params({"lr": 0.1})
+    with pytest.raises(RuntimeError, match="logging to MLflow failed"):
+        logger.close()